@@ -8,6 +8,7 @@ by exposing them over an API that feels like working with a two-dimensional
 table (think CSV).
 
 Most of the stuff is done in the _DataCube class, but to get data
-in (and out), see converter modules pydatacube.jsonstat and
-pydatacube.pcaxis.
+in (and out), see converter modules pydatacube.jsonstat,
+pydatacube.pcaxis and pydatacube.binary. The timings of the
+hot paths can be collected with pydatacube.metrics.
 """
@@ -0,0 +1,200 @@
+"""Apache Arrow and Parquet conversions
+
+The category dimensions become dictionary encoded columns
+with the categories as the dictionary, and the indices
+computed from the cube's shape. The cube's specification
+is stored in the schema metadata, so the tables convert
+back to identical cubes.
+
+pyarrow is imported only when the conversions are used.
+"""
+from __future__ import absolute_import
+import json
+from collections import OrderedDict
+from pydatacube.pydatacube import _DataCube, dimension_magnitudes
+from pydatacube.binary import numeric_buffer
+
+SPECIFICATION_KEY = 'pydatacube.specification'
+
+class ArrowConversionError(Exception): pass
+
+def _dimension_indices(sizes):
+	"""The category index columns of a full cube of sizes"""
+	import numpy as np
+	magnitudes = dimension_magnitudes(sizes)
+	length = int(np.prod(sizes))
+	rows = np.arange(length, dtype=np.int64)
+	return [((rows//m) % s).astype(np.int32)
+		for (s, m) in zip(sizes, magnitudes)]
+
+def _value_array(values, stored_order):
+	import pyarrow as pa
+	mapped = numeric_buffer(values) if stored_order else None
+	if mapped is not None:
+		# Passed as is from the mapped file. The validity
+		# bitmap is the inverse of the missing bitmap.
+		data, missing = mapped
+		validity = None
+		if missing is not None:
+			validity = pa.py_buffer(str(bytearray(
+				~b & 0xff for b in bytearray(missing))))
+		return pa.Array.from_buffers(pa.from_numpy_dtype(data.dtype),
+			len(data), [validity, pa.py_buffer(data)])
+	return pa.array(list(values))
+
+def to_arrow(cube, category_labels=False):
+	"""
+	Convert a (filtered) cube to a pyarrow.Table
+
+	With category_labels, the dictionaries have the category
+	labels instead of the ids.
+	"""
+	import pyarrow as pa
+	if not hasattr(cube, '_value_columns'):
+		cube = cube._materialize()
+	spec = cube.specification
+	cat_dims = [d for d in spec['dimensions'] if 'categories' in d]
+	value_dims = [d for d in spec['dimensions'] if 'categories' not in d]
+
+	names = []
+	arrays = []
+	indices = _dimension_indices([len(d['categories']) for d in cat_dims])
+	for dim, dim_indices in zip(cat_dims, indices):
+		if category_labels:
+			dictionary = [c.get('label', c['id']) for c in dim['categories']]
+		else:
+			dictionary = [c['id'] for c in dim['categories']]
+		names.append(dim['id'])
+		arrays.append(pa.DictionaryArray.from_arrays(
+			pa.array(dim_indices), pa.array(dictionary)))
+
+	stored_order = cube._in_stored_order()
+	for dim, values in zip(value_dims, cube._value_columns()):
+		names.append(dim['id'])
+		arrays.append(_value_array(values, stored_order))
+
+	table = pa.Table.from_arrays(arrays, names=names)
+	spec = OrderedDict((k, v) for (k, v) in spec.iteritems() if k != 'length')
+	return table.replace_schema_metadata({
+		SPECIFICATION_KEY: json.dumps(spec)})
+
+def _table_specification(table):
+	"""The stored specification, or one derived from the dictionaries"""
+	metadata = table.schema.metadata or {}
+	if SPECIFICATION_KEY in metadata:
+		return json.loads(metadata[SPECIFICATION_KEY],
+			object_pairs_hook=OrderedDict)
+
+	import pyarrow as pa
+	spec = OrderedDict()
+	spec['metadata'] = OrderedDict()
+	spec['dimensions'] = []
+	for field, column in zip(table.schema, table.columns):
+		dim = OrderedDict(id=field.name)
+		if pa.types.is_dictionary(field.type):
+			chunk = column.chunk(0)
+			dim['categories'] = [OrderedDict(id=c)
+				for c in chunk.dictionary.to_pylist()]
+		spec['dimensions'].append(dim)
+	return spec
+
+def _category_positions(dim, column):
+	"""
+	The category indices of the rows of a category column
+
+	The column's values (or dictionary) are matched to the
+	category ids, or to the labels of to_arrow's category_labels.
+	"""
+	import numpy as np
+	import pyarrow as pa
+	ids = dict((c['id'], i) for (i, c) in enumerate(dim['categories']))
+	labels = dict((c.get('label', c['id']), i)
+		for (i, c) in enumerate(dim['categories']))
+	def lookup(values):
+		if set(values) <= set(ids):
+			return np.array([ids[v] for v in values], dtype=np.int64)
+		if set(values) <= set(labels):
+			return np.array([labels[v] for v in values], dtype=np.int64)
+		raise ArrowConversionError("Column '%s' has values that aren't its categories"%(dim['id'],))
+
+	positions = [np.zeros(0, dtype=np.int64)]
+	for chunk in column.chunks:
+		if chunk.null_count > 0:
+			raise ArrowConversionError("Column '%s' has missing categories"%(dim['id'],))
+		if pa.types.is_dictionary(chunk.type):
+			mapping = lookup(chunk.dictionary.to_pylist())
+			positions.append(mapping[chunk.indices.to_numpy()])
+		else:
+			positions.append(lookup(chunk.to_pylist()))
+	return np.concatenate(positions)
+
+def _row_order(table, dims):
+	"""
+	The table's row of each cell in the cube's row order
+
+	None if the rows are in the cube's order already.
+	"""
+	import numpy as np
+	sizes = [len(d['categories']) for d in dims]
+	magnitudes = dimension_magnitudes(sizes)
+	flat = np.zeros(table.num_rows, dtype=np.int64)
+	for dim, magnitude in zip(dims, magnitudes):
+		flat += _category_positions(dim, table.column(dim['id']))*magnitude
+	if np.array_equal(flat, np.arange(table.num_rows)):
+		return None
+	if np.any(np.bincount(flat, minlength=table.num_rows) != 1):
+		raise ArrowConversionError("The table doesn't have a single row for each cell")
+	order = np.empty(table.num_rows, dtype=np.int64)
+	order[flat] = np.arange(table.num_rows)
+	return order
+
+def from_arrow(table):
+	"""
+	Convert a pyarrow.Table to a cube
+
+	The rows can be in any order, as they are placed by their
+	categories. Tables without a stored specification get the
+	dimensions from their dictionary encoded columns.
+	"""
+	spec = _table_specification(table)
+	data = OrderedDict((k, v) for (k, v) in spec.iteritems()
+		if k != 'dimensions')
+	data['dimensions'] = [d for d in spec['dimensions'] if 'categories' in d]
+	data['value_dimensions'] = []
+	length = 1
+	for dim in data['dimensions']:
+		length *= len(dim['categories'])
+	if table.num_rows != length:
+		raise ArrowConversionError("The table has %i rows, the dimensions need %i"%(
+			table.num_rows, length))
+	order = _row_order(table, data['dimensions'])
+	for dim in spec['dimensions']:
+		if 'categories' in dim:
+			continue
+		dim = OrderedDict(dim)
+		values = table.column(dim['id']).to_pylist()
+		if order is not None:
+			values = [values[i] for i in order]
+		dim['values'] = values
+		data['value_dimensions'].append(dim)
+	return _DataCube(data)
+
+def write_parquet(cube, where, category_labels=False, **kwargs):
+	"""
+	Write a cube to a Parquet file
+
+	The row groups are aligned to the categories of the leading
+	dimension, so that its filters can skip the other groups.
+	"""
+	import pyarrow.parquet as pq
+	table = to_arrow(cube, category_labels)
+	sizes = [len(d['categories']) for d in cube.specification['dimensions']
+		if 'categories' in d]
+	if len(sizes) > 0 and sizes[0] > 0:
+		kwargs.setdefault('row_group_size', max(table.num_rows//sizes[0], 1))
+	pq.write_table(table, where, **kwargs)
+
+def read_parquet(source):
+	"""Read a cube from a Parquet file written by write_parquet"""
+	import pyarrow.parquet as pq
+	return from_arrow(pq.read_table(source))
@@ -0,0 +1,255 @@
+"""Native binary cube files
+
+A cube file starts with a JSON header holding the cube's structure,
+followed by a block for each value dimension, aligned to 8 bytes:
+
+	magic | header length (uint32) | header | padding | blocks
+
+A block is a missing value bitmap (set bits for None values)
+followed by the values as little-endian float64 or int64 arrays,
+or, for strings, as an int64 array of n+1 offsets and the UTF-8
+encoded data. Columns mixing types (eg. integers and floats, or
+numbers and strings) are stored like strings, but as the JSON
+encodings of the values, so they load back as they were.
+
+The files are opened with mmap, so only the pages of the values
+a cube touches are read, and the pages are shared through the
+OS page cache.
+"""
+from __future__ import absolute_import
+import json
+import mmap
+import struct
+from collections import OrderedDict
+from pydatacube.pydatacube import _DataCube
+
+MAGIC = "PYDCUBE1"
+ALIGNMENT = 8
+# Values decoded at a time when iterating
+ITER_BLOCK_SIZE = 4096
+_NUMERIC_CODES = {'float64': 'd', 'int64': 'q'}
+
+class BinaryFormatException(Exception): pass
+
+def _align(offset):
+	return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+def _pad(data):
+	return data + "\0"*(_align(len(data)) - len(data))
+
+def _value_type(values):
+	types = set(type(v) for v in values if v is not None)
+	if types <= set([str, unicode]):
+		return 'string'
+	if types <= set([int, long]):
+		return 'int64'
+	if types == set([float]):
+		return 'float64'
+	return 'json'
+
+def _encode_string(value):
+	if value is None:
+		return ""
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return str(value)
+
+def _encode_json(value):
+	if value is None:
+		return ""
+	return json.dumps(value)
+
+def _missing_bitmap(values):
+	"""The missing value bitmap, least significant bit first"""
+	try:
+		import numpy as np
+	except ImportError:
+		missing = bytearray((len(values) + 7)//8)
+		for i, value in enumerate(values):
+			if value is None:
+				missing[i//8] |= 1 << (i%8)
+		return str(missing)
+	flags = np.zeros((len(values) + 7)//8*8, dtype=bool)
+	flags[:len(values)] = np.fromiter((v is None for v in values),
+		dtype=bool, count=len(values))
+	# packbits packs the most significant bit first
+	return np.packbits(flags.reshape(-1, 8)[:, ::-1]).tostring()
+
+def _encode_block(values, value_type):
+	parts = [_pad(_missing_bitmap(values))]
+	if value_type in ('string', 'json'):
+		if value_type == 'json':
+			strings = map(_encode_json, values)
+		else:
+			strings = map(_encode_string, values)
+		offsets = [0]
+		for string in strings:
+			offsets.append(offsets[-1] + len(string))
+		parts.append(struct.pack('<%iq'%len(offsets), *offsets))
+		parts.append(_pad("".join(strings)))
+	else:
+		values = [0 if v is None else v for v in values]
+		parts.append(struct.pack('<%i%s'%(len(values),
+			_NUMERIC_CODES[value_type]), *values))
+	return "".join(parts)
+
+def dump(cube, output):
+	"""Write cube (filtered or not) to the binary file object output"""
+	if not hasattr(cube, '_value_columns'):
+		cube = cube._materialize()
+	spec = cube.specification
+	header = OrderedDict((k, v) for (k, v) in spec.iteritems()
+		if k not in ('dimensions', 'length'))
+	header['dimensions'] = [d for d in spec['dimensions']
+		if 'categories' in d]
+	header['value_dimensions'] = []
+
+	blocks = []
+	offset = 0
+	value_specs = [d for d in spec['dimensions'] if 'categories' not in d]
+	for dim, values in zip(value_specs, cube._value_columns()):
+		value_type = _value_type(values)
+		block = _encode_block(values, value_type)
+		dim = OrderedDict(dim)
+		dim['block'] = dict(type=value_type, offset=offset,
+			length=len(values))
+		header['value_dimensions'].append(dim)
+		blocks.append(block)
+		offset += len(block)
+
+	header = json.dumps(header)
+	output.write(_pad(MAGIC + struct.pack('<I', len(header)) + header))
+	for block in blocks:
+		output.write(block)
+
+class _MappedValues(object):
+	"""Lazy, read-only sequence of the values of a mapped block"""
+	def __init__(self, buf, offset, value_type, length):
+		self._buf = buf
+		self._type = value_type
+		self._length = length
+		self._missing = offset
+		self._values = offset + _align((length + 7)//8)
+		# Start of the string data
+		self._data = self._values + 8*(length + 1)
+
+	def __len__(self):
+		return self._length
+
+	def _is_missing(self, i):
+		return ord(self._buf[self._missing + i//8]) >> (i%8) & 1
+	
+	def _missing_indices(self, start, stop):
+		"""The indices of the missing values in start:stop"""
+		first = start//8
+		bits = self._buf[self._missing + first:self._missing + (stop + 7)//8]
+		if bits.count("\0") == len(bits):
+			return []
+		try:
+			import numpy as np
+		except ImportError:
+			return [i for i in xrange(start, stop) if self._is_missing(i)]
+		flags = np.unpackbits(np.frombuffer(bits, dtype=np.uint8))
+		# unpackbits unpacks the most significant bit first
+		flags = flags.reshape(-1, 8)[:, ::-1].reshape(-1)
+		indices = np.nonzero(flags)[0] + first*8
+		return indices[(indices >= start) & (indices < stop)].tolist()
+
+	def _range(self, start, stop):
+		n = stop - start
+		if n <= 0:
+			return []
+		missing = self._missing_indices(start, stop)
+		if self._type in ('string', 'json'):
+			offsets = struct.unpack_from('<%iq'%(n + 1), self._buf,
+				self._values + 8*start)
+			data = self._buf[self._data + offsets[0]:self._data + offsets[-1]]
+			base = offsets[0]
+			values = [data[a - base:b - base].decode('utf-8')
+				for (a, b) in zip(offsets[:-1], offsets[1:])]
+			if self._type == 'json':
+				missing_set = set(missing)
+				values = [None if i in missing_set else json.loads(v)
+					for (i, v) in enumerate(values, start)]
+		else:
+			values = list(struct.unpack_from('<%i%s'%(n,
+				_NUMERIC_CODES[self._type]), self._buf,
+				self._values + 8*start))
+		for i in missing:
+			values[i - start] = None
+		return values
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(self._length)
+			if step == 1:
+				return self._range(start, stop)
+			return [self[j] for j in xrange(start, stop, step)]
+		if i < 0:
+			i += self._length
+		if not 0 <= i < self._length:
+			raise IndexError("Value index out of range")
+		return self._range(i, i + 1)[0]
+
+	def _ndarray(self):
+		"""
+		A NumPy view of the numeric values, None for strings
+
+		The missing values are left as zeros, see _missing_bits.
+		"""
+		if self._type not in _NUMERIC_CODES:
+			return None
+		import numpy as np
+		return np.frombuffer(self._buf, dtype='<'+_NUMERIC_CODES[self._type],
+			count=self._length, offset=self._values)
+
+	def _missing_bits(self):
+		"""The missing value bitmap, or None without missing values"""
+		bits = self._buf[self._missing:self._missing + (self._length + 7)//8]
+		if bits.count("\0") == len(bits):
+			return None
+		return bits
+
+	def __iter__(self):
+		for start in xrange(0, self._length, ITER_BLOCK_SIZE):
+			stop = min(start + ITER_BLOCK_SIZE, self._length)
+			for value in self._range(start, stop):
+				yield value
+
+def numeric_buffer(values):
+	"""
+	The mapped storage of the values of a loaded cube, or None
+
+	For the numeric value lists of a loaded cube file, returns
+	a NumPy array viewing the mapped values, with the missing
+	values as zeros, and the missing value bitmap (least
+	significant bit first), which is None if none are missing.
+	Other values give None.
+	"""
+	if not isinstance(values, _MappedValues):
+		return None
+	array = values._ndarray()
+	if array is None:
+		return None
+	return array, values._missing_bits()
+
+def load(path):
+	"""Open a cube file with mmap"""
+	with open(path, 'rb') as f:
+		buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	prefix_len = len(MAGIC) + 4
+	if buf[:len(MAGIC)] != MAGIC:
+		raise BinaryFormatException("Not a pydatacube binary file")
+	header_len = struct.unpack_from('<I', buf, len(MAGIC))[0]
+	header = json.loads(buf[prefix_len:prefix_len + header_len],
+		object_pairs_hook=OrderedDict)
+	blocks_start = _align(prefix_len + header_len)
+
+	data = header
+	for dim in data['value_dimensions']:
+		block = dim.pop('block')
+		dim['values'] = _MappedValues(buf,
+			blocks_start + block['offset'],
+			block['type'], block['length'])
+	return _DataCube(data)
@@ -0,0 +1,184 @@
+"""Differences between versions of a cube
+
+diff(old, new) compares two versions of a cube with the same
+dimensions and returns a CubeDelta of the added, removed and
+relabeled categories and the changed cells. A stored cube can
+be brought up to date with SqlDataCube.apply_delta, which writes
+only the differences.
+
+The values are compared with NumPy when it's available.
+"""
+from __future__ import absolute_import
+import itertools
+from pydatacube.pydatacube import dimension_magnitudes
+
+class DeltaException(Exception): pass
+
+def _category_ids(dim):
+	return [c['id'] for c in dim['categories']]
+
+def _category_dims(spec):
+	return [d for d in spec['dimensions'] if 'categories' in d]
+
+class CubeDelta(object):
+	"""
+	The differences between two versions of a cube
+
+	The added and relabeled categories are dicts of dimension
+	ids to category lists of the new version, the removed ones
+	to category id lists. The changed cells are (category ids,
+	values) pairs of the cells in both versions.
+	"""
+	def __init__(self, old_specification, new, added_categories,
+			removed_categories, relabeled_categories, changed_cells):
+		self.old_specification = old_specification
+		self.new = new
+		self.added_categories = added_categories
+		self.removed_categories = removed_categories
+		self.relabeled_categories = relabeled_categories
+		self.changed_cells = changed_cells
+
+	def is_empty(self):
+		return not (self.added_categories or self.removed_categories
+			or self.relabeled_categories or self.changed_cells
+			or self.old_specification['metadata'] != self.new.metadata)
+
+	def matches(self, specification):
+		"""Whether the delta is from a cube of specification"""
+		return map(_category_ids, _category_dims(specification)) == \
+			map(_category_ids, _category_dims(self.old_specification))
+
+	def keeps_row_numbers(self):
+		"""
+		Whether the cells of both versions are in the same row positions
+
+		This holds when the categories are added and removed
+		only at the end of the leading dimension.
+		"""
+		old_dims = _category_dims(self.old_specification)
+		new_dims = _category_dims(self.new.specification)
+		for i, (old, new) in enumerate(zip(old_dims, new_dims)):
+			old_ids, new_ids = _category_ids(old), _category_ids(new)
+			if i > 0:
+				if old_ids != new_ids:
+					return False
+				continue
+			removed = set(self.removed_categories.get(old['id'], []))
+			kept = [c for c in old_ids if c not in removed]
+			if kept != old_ids[:len(kept)] or kept != new_ids[:len(kept)]:
+				return False
+		return True
+
+	def added_cells(self):
+		"""Iterate the (category ids, values) of the cells only in the new version"""
+		new = self.new
+		dims = _category_dims(new.specification)
+		for i, dim in enumerate(dims):
+			added = [c['id'] for c in self.added_categories.get(dim['id'], [])]
+			if len(added) == 0:
+				continue
+			# Cells with added categories in the earlier dimensions
+			# are already listed.
+			filters = {dim['id']: added}
+			for earlier in dims[:i]:
+				new_ids = set(c['id'] for c in
+					self.added_categories.get(earlier['id'], []))
+				filters[earlier['id']] = [c for c in _category_ids(earlier)
+					if c not in new_ids]
+			for row in new.filter(**filters).toTable():
+				yield tuple(row[:len(dims)]), tuple(row[len(dims):])
+
+def _changed_positions(old, new, old_ranges, new_ranges):
+	"""
+	The positions of the cells whose values differ
+
+	The ranges are the category indices of the common cells
+	in both cubes, and the positions are flat indices to
+	their product.
+	"""
+	old_columns = [d['values'] for d in old._data['value_dimensions']]
+	new_columns = [d['values'] for d in new._data['value_dimensions']]
+	try:
+		import numpy as np
+	except ImportError:
+		positions = itertools.izip(
+			itertools.imap(old._flatindex, itertools.product(*old_ranges)),
+			itertools.imap(new._flatindex, itertools.product(*new_ranges)))
+		return [k for (k, (i, j)) in enumerate(positions)
+			if any(o[i] != n[j] for (o, n) in zip(old_columns, new_columns))]
+
+	def flat_indices(cube, ranges):
+		grids = np.ix_(*[np.asarray(r, dtype=np.int64) for r in ranges])
+		flat = sum(g*m for (g, m) in zip(grids, cube._dim_magnitudes))
+		return np.asarray(flat, dtype=np.int64).reshape(-1)
+
+	old_flat = flat_indices(old, old_ranges)
+	new_flat = flat_indices(new, new_ranges)
+	changed = np.zeros(len(old_flat), dtype=bool)
+	for old_values, new_values in zip(old_columns, new_columns):
+		a = old._flat_array(old_values)[old_flat]
+		b = new._flat_array(new_values)[new_flat]
+		if a.dtype.kind != b.dtype.kind:
+			a, b = a.astype(object), b.astype(object)
+		differs = a != b
+		if a.dtype.kind == 'f':
+			# Missing values are NaNs
+			differs &= ~(np.isnan(a) & np.isnan(b))
+		changed |= differs
+	return np.nonzero(changed)[0].tolist()
+
+def diff(old, new):
+	"""
+	Compare two versions of a cube
+
+	The cubes must have the same dimensions and value dimensions
+	in the same order. Of the values, only those of the cells
+	in both versions are compared.
+	"""
+	old = old._materialize()
+	new = new._materialize()
+	old_dims = old._data['dimensions']
+	new_dims = new._data['dimensions']
+	if [d['id'] for d in old_dims] != [d['id'] for d in new_dims]:
+		raise DeltaException("The cubes have different dimensions")
+	if [d['id'] for d in old._data['value_dimensions']] != \
+			[d['id'] for d in new._data['value_dimensions']]:
+		raise DeltaException("The cubes have different value dimensions")
+
+	added, removed, relabeled = {}, {}, {}
+	old_ranges, new_ranges = [], []
+	for old_dim, new_dim in zip(old_dims, new_dims):
+		dim_id = old_dim['id']
+		old_cats = dict((c['id'], c) for c in old_dim['categories'])
+		new_indices = new._cat_indices[dim_id]
+		dim_added = [c for c in new_dim['categories']
+			if c['id'] not in old_cats]
+		dim_removed = [c for c in _category_ids(old_dim)
+			if c not in new_indices]
+		dim_relabeled = [c for c in new_dim['categories']
+			if c['id'] in old_cats and
+				c.get('label') != old_cats[c['id']].get('label')]
+		for changes, dim_changes in ((added, dim_added),
+				(removed, dim_removed), (relabeled, dim_relabeled)):
+			if len(dim_changes) > 0:
+				changes[dim_id] = dim_changes
+
+		common = [(i, new_indices[c['id']])
+			for (i, c) in enumerate(old_dim['categories'])
+			if c['id'] in new_indices]
+		old_ranges.append([i for (i, j) in common])
+		new_ranges.append([j for (i, j) in common])
+
+	sizes = [len(r) for r in old_ranges]
+	magnitudes = dimension_magnitudes(sizes)
+	changed = []
+	for k in _changed_positions(old, new, old_ranges, new_ranges):
+		indices = [k//m % s for (m, s) in zip(magnitudes, sizes)]
+		new_indices = [r[i] for (r, i) in zip(new_ranges, indices)]
+		flat_i = new._flatindex(new_indices)
+		changed.append((
+			tuple(new._category_id(d, i) for (d, i) in enumerate(new_indices)),
+			tuple(d['values'][flat_i] for d in new._data['value_dimensions'])))
+
+	return CubeDelta(old.specification, new, added, removed, relabeled,
+		changed)
@@ -1,7 +1,9 @@
 """JSON-stat to pydatacube conversion"""
+from __future__ import absolute_import
 
 from collections import OrderedDict
-import pydatacube
+from pydatacube.pydatacube import _DataCube
+from pydatacube import metrics
 
 class JsonstatException(Exception): pass
 
@@ -41,6 +43,7 @@ def _load_dimension(dimensions, dim_i):
 
 	return dimension
 
+@metrics.timed('jsonstat.to_cube')
 def to_cube(js_dataset):
 	data = OrderedDict()
 	js_dimensions = js_dataset['dimension']
@@ -59,7 +62,7 @@ def to_cube(js_dataset):
 		dict(id='value', values=js_dataset['value'])
 		]
 
-	return pydatacube._DataCube(data)
+	return _DataCube(data)
 
 class ConversionError(Exception): pass
 
@@ -79,7 +82,8 @@ def _copyif(dst, src, key):
 	if key not in src: return
 	dst[key] = src[key]
 
-def to_jsonstat_dataset(cube):
+def _dataset_structure(cube):
+	"""The JSON-stat dataset of cube without the values"""
 	jsonstat_sanity_check(cube)
 	js = OrderedDict()
 	ds = js['dataset'] = OrderedDict()
@@ -113,9 +117,16 @@ def to_jsonstat_dataset(cube):
 			catlabels[ccat['id']] = ccat['label']
 		if len(catlabels) > 0:
 			cats['label'] = catlabels
-		
+	
+	return ds
 
-	ds['value'] = cube._value_dimension_values()
+def to_jsonstat_dataset(cube):
+	ds = _dataset_structure(cube)
+	values = cube._value_dimension_values()
+	if not isinstance(values, list):
+		# Eg. mapped or appendable values
+		values = list(values)
+	ds['value'] = values
 	return ds
 
 def to_jsonstat(cube, dataset_name='dataset'):
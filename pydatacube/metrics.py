@@ -0,0 +1,223 @@
+"""Timers and counters of the library's hot paths
+
+The conversions, the cube operations, the row iterations and the
+SQL queries report their timings and counts to the registry,
+which passes them on to its sinks:
+
+	stats = metrics.StatsSink()
+	metrics.enable(stats, metrics.LoggingSink())
+	...
+	print stats.stats()
+
+Without sinks the registry is disabled, and the instrumented
+code only checks the enabled flag.
+
+A sink is any object with an emit(kind, name, value, fields)
+method, where kind is 'timing' (value in seconds) or 'count',
+and fields has extra information, such as the SQL query text.
+"""
+import functools
+import logging
+import socket
+import threading
+import time
+
+class Registry(object):
+	"""The sinks of the metrics, enabled when there are any"""
+	def __init__(self):
+		# Replaced instead of modified, so the emitters
+		# can iterate it without locking.
+		self.sinks = ()
+		self.enabled = False
+		self._lock = threading.Lock()
+
+	def add_sink(self, sink):
+		with self._lock:
+			self.sinks = self.sinks + (sink,)
+			self.enabled = True
+
+	def remove_sink(self, sink):
+		with self._lock:
+			self.sinks = tuple(s for s in self.sinks if s is not sink)
+			self.enabled = len(self.sinks) > 0
+
+	def clear(self):
+		with self._lock:
+			self.sinks = ()
+			self.enabled = False
+
+	def emit(self, kind, name, value, fields):
+		for sink in self.sinks:
+			sink.emit(kind, name, value, fields)
+
+	def timing(self, name, seconds, **fields):
+		self.emit('timing', name, seconds, fields)
+
+	def increment(self, name, count=1, **fields):
+		self.emit('count', name, count, fields)
+
+	def timer(self, name, **fields):
+		"""
+		A context manager timing its block
+
+		The block gets the fields dict, and can add
+		eg. row counts to it.
+		"""
+		if not self.enabled:
+			return _NullTimer(fields)
+		return _Timer(self, name, fields)
+
+class _NullTimer(object):
+	def __init__(self, fields):
+		self.fields = fields
+
+	def __enter__(self):
+		return self.fields
+
+	def __exit__(self, *exc_info):
+		pass
+
+class _Timer(object):
+	def __init__(self, registry, name, fields):
+		self.registry = registry
+		self.name = name
+		self.fields = fields
+
+	def __enter__(self):
+		self.start = time.time()
+		return self.fields
+
+	def __exit__(self, *exc_info):
+		self.registry.timing(self.name, time.time() - self.start,
+			**self.fields)
+
+registry = Registry()
+
+def enable(*sinks):
+	"""Add sinks to the registry, enabling the metrics"""
+	for sink in sinks:
+		registry.add_sink(sink)
+
+def disable():
+	"""Remove all the sinks, disabling the metrics"""
+	registry.clear()
+
+def timed(name):
+	"""Decorate a function to report the time of its calls"""
+	def decorate(function):
+		@functools.wraps(function)
+		def timed_function(*args, **kwargs):
+			if not registry.enabled:
+				return function(*args, **kwargs)
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				registry.timing(name, time.time() - start)
+		return timed_function
+	return decorate
+
+def timed_iter(name, rows):
+	"""
+	Report the time taken producing rows, and their count
+
+	Reported when the iteration ends, or the iterator is
+	closed or discarded. Returns rows as is when disabled.
+	"""
+	if not registry.enabled:
+		return rows
+	return _timed_iter(name, iter(rows))
+
+def _timed_iter(name, rows):
+	n = 0
+	elapsed = 0.0
+	try:
+		while True:
+			start = time.time()
+			try:
+				row = rows.next()
+			finally:
+				elapsed += time.time() - start
+			n += 1
+			yield row
+	except StopIteration:
+		pass
+	finally:
+		registry.timing(name, elapsed, rows=n)
+		registry.increment(name + '.rows', n)
+
+class LoggingSink(object):
+	"""Log the metrics, by default at DEBUG level of 'pydatacube.metrics'"""
+	def __init__(self, logger=None, level=logging.DEBUG):
+		if logger is None:
+			logger = logging.getLogger('pydatacube.metrics')
+		self.logger = logger
+		self.level = level
+
+	def emit(self, kind, name, value, fields):
+		if not self.logger.isEnabledFor(self.level):
+			return
+		fields = " ".join("%s=%r"%(k, v) for (k, v) in sorted(fields.items()))
+		self.logger.log(self.level, "%s %s %s %s", kind, name, value, fields)
+
+class StatsSink(object):
+	"""
+	Aggregate the metrics in memory
+
+	Keeps the count, total and maximum of each timing
+	and the sum of each counter.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.timings = {}
+			self.counts = {}
+
+	def emit(self, kind, name, value, fields):
+		with self._lock:
+			if kind == 'count':
+				self.counts[name] = self.counts.get(name, 0) + value
+				return
+			stats = self.timings.get(name)
+			if stats is None:
+				stats = self.timings[name] = dict(count=0, total=0.0,
+					max=0.0)
+			stats['count'] += 1
+			stats['total'] += value
+			stats['max'] = max(stats['max'], value)
+
+	def stats(self):
+		"""A snapshot of the timings and the counts"""
+		with self._lock:
+			return dict(
+				timings=dict((k, dict(v)) for (k, v) in self.timings.iteritems()),
+				counts=dict(self.counts))
+
+class StatsdSink(object):
+	"""
+	Send the metrics to a statsd daemon over UDP
+
+	The timings are sent in milliseconds. The sends don't
+	block, and the errors are ignored, as for statsd in general.
+	"""
+	def __init__(self, host='127.0.0.1', port=8125, prefix='pydatacube.'):
+		self.address = (host, port)
+		self.prefix = prefix
+		self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._socket.setblocking(0)
+
+	def emit(self, kind, name, value, fields):
+		if kind == 'timing':
+			message = "%s%s:%.3f|ms"%(self.prefix, name, value*1000)
+		else:
+			message = "%s%s:%i|c"%(self.prefix, name, value)
+		try:
+			self._socket.sendto(message, self.address)
+		except socket.error:
+			pass
+
+	def close(self):
+		self._socket.close()
@@ -2,7 +2,8 @@
 from collections import OrderedDict
 import string
 from pydatacube.pydatacube import _DataCube
-import px_reader
+from pydatacube import metrics
+from pydatacube.pcaxis import px_reader
 
 # A bit scandinavian specific
 default_translate = dict(zip(
@@ -34,6 +35,7 @@ class Sluger(object):
 
 PxSyntaxError = px_reader.PxSyntaxError
 
+@metrics.timed('pcaxis.to_cube')
 def to_cube(pcaxis_data, origin_url=None, Sluger=Sluger):
 	px = px_reader.Px(pcaxis_data)
 	cube = OrderedDict()
@@ -20,16 +20,27 @@ from collections import defaultdict
 from itertools import izip_longest, cycle, repeat
 from operator import mul
 import datetime
+from pydatacube import metrics
 
-def get_logger(level=logging.DEBUG, handler=logging.StreamHandler):
+def get_logger(level=None, handler=None):
     """
-    Adapted from logging module's documentation.
+    The 'px_log' logger
+
+    The level and the handler are left to the application's
+    logging configuration unless given. Adapted from logging
+    module's documentation.
     """
     log = logging.getLogger('px_log')
-    log.setLevel(level)
-    ch = handler()
-    ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    ch.set_name('px_handler')
+    if level is not None:
+        log.setLevel(level)
+    if handler is None:
+        # Silences the "no handlers" warning without output
+        ch = logging.NullHandler()
+        ch.set_name('px_null_handler')
+    else:
+        ch = handler()
+        ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        ch.set_name('px_handler')
     existing_handlers = [h for h in log.handlers if h.name == ch.name]
     if not existing_handlers:
         log.addHandler(ch)
@@ -86,6 +97,7 @@ class Px(object):
         value = line[m.end():]
         return field.lower(), subkey, self._clean_value(value)
 
+    @metrics.timed('pcaxis.split_px')
     def _split_px(self, px_doc):
         """
         Parses metadata keywords from px_doc and inserts those into self object
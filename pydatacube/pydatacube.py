@@ -1,6 +1,12 @@
+from __future__ import absolute_import
 import itertools
 import copy
+import numbers
+import sys
+import functools
+import threading
 from collections import namedtuple, OrderedDict
+from pydatacube import metrics
 
 def cumprod(vals):
 	cum = [vals[0]]
@@ -11,6 +17,167 @@ def cumprod(vals):
 def dimension_magnitudes(sizes):
 	return cumprod((sizes[1:]+[1])[::-1])[::-1]
 
+def _mean(values):
+	return sum(values)/len(values)
+
+# Aggregate functions of the values of a group, called
+# only with non-empty lists of floats (any values for count),
+# so that missing values are skipped as in SQL.
+AGGREGATES = {
+	'sum': sum,
+	'avg': _mean,
+	'count': len,
+	'min': min,
+	'max': max,
+	}
+
+# Items of a container measured for its size estimate
+SIZE_SAMPLE = 16
+
+def _sampled_size(items, n_items, seen):
+	"""The size of n_items extrapolated from a sample of them"""
+	if len(items) == 0:
+		return 0
+	return sum(_estimate_size(v, seen) for v in items)*n_items//len(items)
+
+def _estimate_size(obj, seen=None):
+	"""
+	Rough size of obj and its contents in bytes
+
+	The items of containers are sampled, so that the
+	estimate is cheap also for long value lists.
+	"""
+	if seen is None:
+		seen = set()
+	if id(obj) in seen:
+		return 0
+	seen.add(id(obj))
+	if isinstance(obj, _DataCube):
+		return _estimate_size(obj._data, seen)
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		items = list(itertools.islice(obj.iteritems(), SIZE_SAMPLE))
+		size += _sampled_size(items, len(obj), seen)
+	elif isinstance(obj, (list, tuple)):
+		step = max(len(obj)//SIZE_SAMPLE, 1)
+		size += _sampled_size(obj[::step], len(obj), seen)
+	elif isinstance(obj, (set, frozenset)):
+		items = list(itertools.islice(obj, SIZE_SAMPLE))
+		size += _sampled_size(items, len(obj), seen)
+	return size
+
+class ResultCache(object):
+	"""
+	A least recently used cache of results, bounded by size
+
+	Attached to cubes with cached(), and shared by the
+	cubes filtered from them. The sizes of the results are
+	estimated, and results larger than max_bytes aren't cached.
+	The cached results are shared, so don't modify them.
+	"""
+	def __init__(self, max_bytes=64<<20):
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def get(self, key, compute):
+		with self._lock:
+			if key in self._entries:
+				self.hits += 1
+				entry = self._entries.pop(key)
+				self._entries[key] = entry
+				return entry[0]
+			self.misses += 1
+		
+		value = compute()
+		size = _estimate_size(value)
+		if size > self.max_bytes:
+			return value
+		with self._lock:
+			if key in self._entries:
+				self._bytes -= self._entries.pop(key)[1]
+			self._entries[key] = value, size
+			self._bytes += size
+			while self._bytes > self.max_bytes:
+				old_value, old_size = self._entries.popitem(last=False)[1]
+				self._bytes -= old_size
+				self.evictions += 1
+		return value
+	
+	def invalidate(self, source=None):
+		"""Drop the results of a cube source (eg. a dataset id), or all"""
+		with self._lock:
+			for key in self._entries.keys():
+				if source is None or key[0] == source:
+					self._bytes -= self._entries.pop(key)[1]
+	
+	def stats(self):
+		return dict(hits=self.hits, misses=self.misses,
+			evictions=self.evictions, entries=len(self._entries),
+			bytes=self._bytes)
+
+def _hashable(value):
+	if isinstance(value, (list, tuple)):
+		return tuple(map(_hashable, value))
+	if isinstance(value, (set, frozenset)):
+		return tuple(sorted(map(_hashable, value)))
+	return value
+
+def cached_result(method):
+	"""
+	Memoize a cube method in the cube's result cache
+
+	The results are keyed by the cube's _cache_source(), the
+	method, the normalized filters and the arguments.
+	"""
+	@functools.wraps(method)
+	def cached(self, *args, **kwargs):
+		if self._result_cache is None:
+			return method(self, *args, **kwargs)
+		key = (self._cache_source(), method.__name__,
+			self._filter_key(), _hashable(args),
+			tuple(sorted((k, _hashable(v)) for (k, v) in kwargs.iteritems())))
+		return self._result_cache.get(key,
+			lambda: method(self, *args, **kwargs))
+	return cached
+
+class _SpecCache(object):
+	"""
+	Memoized specifications of the cubes of the same data
+
+	The specifications are kept per filter for the
+	max_entries most recently used filters, so eg.
+	iterating over many groups doesn't keep them all.
+	The object itself identifies the data for the
+	result caches.
+	"""
+	def __init__(self, max_entries=64):
+		self.max_entries = max_entries
+		self._specs = OrderedDict()
+		self._lock = threading.Lock()
+		self.value_dimensions = None
+	
+	def __deepcopy__(self, memo):
+		# A copy of the cube has copies of the data
+		return _SpecCache(self.max_entries)
+	
+	def get(self, key, compute):
+		with self._lock:
+			spec = self._specs.pop(key, None)
+			if spec is not None:
+				self._specs[key] = spec
+				return spec
+		spec = compute()
+		with self._lock:
+			self._specs[key] = spec
+			while len(self._specs) > self.max_entries:
+				self._specs.popitem(last=False)
+		return spec
+
 class _Row(object):
 	def __init__(self, cube, indices):
 		self._cube = cube
@@ -37,13 +204,68 @@ class _Row(object):
 
 class DataCubeException(Exception): pass
 
+# Guards the appends to the shared lists of _AppendableValues
+_append_lock = threading.Lock()
+
+class _AppendableValues(object):
+	"""
+	A prefix of a list shared by cubes that extend each other
+
+	Each cube sees only its own prefix, so the one at the end
+	of the list can append to it in place, and growing a cube
+	along its leading dimension costs only the new values.
+	"""
+	def __init__(self, values, length=None):
+		self._values = values
+		if length is None:
+			length = len(values)
+		self._length = length
+	
+	@classmethod
+	def of(cls, values):
+		if isinstance(values, cls):
+			return values
+		# The first append copies the values, so that the
+		# original list and its cubes stay as they are.
+		return cls(list(values))
+	
+	def extended(self, new_values):
+		"""The values with new_values appended"""
+		with _append_lock:
+			values = self._values
+			if len(values) != self._length:
+				# Another cube has already appended to the list
+				values = values[:self._length]
+			values.extend(new_values)
+			return _AppendableValues(values, len(values))
+	
+	def __len__(self):
+		return self._length
+	
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return self._values[slice(*i.indices(self._length))]
+		if i < 0:
+			i += self._length
+		if not 0 <= i < self._length:
+			raise IndexError("Value index out of range")
+		return self._values[i]
+	
+	def __iter__(self):
+		return itertools.islice(self._values, self._length)
+
 class _DataCube(object):
-	def __init__(self, data, filters=None):
+	def __init__(self, data, filters=None, spec_cache=None,
+			result_cache=None, magnitudes=None):
 		self._data = data
 
 		self._dim_sizes = [len(d['categories'])
 			for d in data['dimensions']]
-		self._dim_magnitudes = dimension_magnitudes(self._dim_sizes)
+		# The values are in C-order of the dimensions, unless
+		# the cube is a transposed view of them.
+		if magnitudes is None:
+			magnitudes = dimension_magnitudes(self._dim_sizes)
+		self._dim_magnitudes = magnitudes
 		self._dim_indices = {d['id']: i
 			for (i, d) in enumerate(data['dimensions'])}
 		self._cat_indices = {}
@@ -55,6 +277,13 @@ class _DataCube(object):
 			self._filters = {}
 		else:
 			self._filters = filters
+		
+		# Specifications are memoized per filter and shared
+		# by all cubes derived from the same data.
+		if spec_cache is None:
+			spec_cache = _SpecCache()
+		self._spec_cache = spec_cache
+		self._result_cache = result_cache
 	
 	__hash__ = None
 
@@ -97,8 +326,16 @@ class _DataCube(object):
 	def _value_dimension_values(self):
 		if len(self._data['value_dimensions']) != 1:
 			raise DataCubeException("No unambiguous value dimension for this cube")
-		return self._data['value_dimensions'][0]['values']
+		if self._in_stored_order():
+			# The stored list itself, so there's nothing to cache
+			return self._data['value_dimensions'][0]['values']
+		return self._filtered_values()
+	
+	@cached_result
+	def _filtered_values(self):
+		return self._value_columns()[0]
 
+	@metrics.timed('cube.materialize')
 	def _materialize(self):
 		"""
 		Make a "standalone" version of a filtered datacube
@@ -110,7 +347,7 @@ class _DataCube(object):
 		materialized still reflect to the original. Keep in mind
 		that we should be considered immutable.
 		"""
-		if len(self._filters) == 0:
+		if self._in_stored_order():
 			return self
 		
 		data = copy.copy(self._data)
@@ -121,41 +358,85 @@ class _DataCube(object):
 			dim['categories'] = [dim['categories'][i] for i in cat_idx]
 		
 		valdims = data['value_dimensions'] = copy.copy(data['value_dimensions'])
-		validx = map(self._flatindex, itertools.product(*self._enabled_dim_ranges()))
-		for i in range(len(valdims)):
+		for i, values in enumerate(self._value_columns()):
 			valdim = valdims[i] = copy.copy(valdims[i])
-			values = valdim['values']
-			valdim['values'] = [values[i] for i in validx]
+			valdim['values'] = values
 
 		return _DataCube(data)
 	
+	def _in_stored_order(self):
+		"""Whether the rows are the stored values as they are"""
+		return len(self._filters) == 0 and \
+			self._dim_magnitudes == dimension_magnitudes(self._dim_sizes)
+
+	def _flat_indices(self):
+		return itertools.imap(self._flatindex,
+			itertools.product(*self._enabled_dim_ranges()))
+	
+	def _value_columns(self):
+		"""
+		Values of each value dimension in row order
+
+		For unfiltered cubes these are the stored lists
+		themselves, so don't modify them.
+		"""
+		columns = [d['values'] for d in self._data['value_dimensions']]
+		if self._in_stored_order():
+			return columns
+		validx = list(self._flat_indices())
+		return [[values[i] for i in validx] for values in columns]
+	
 	@property
 	def metadata(self):
 		return self._data['metadata']
 	
 	@property
 	def specification(self):
+		"""
+		The cube's structure without the values
+
+		The result is memoized and shares the unfiltered
+		dimensions with the underlying data, so it must
+		be treated as read-only.
+		"""
+		return self._spec_cache.get(self._filter_key(),
+			self._compute_specification)
+	
+	def _compute_specification(self):
 		spec = copy.copy(self._data)
+		del spec['value_dimensions']
 		spec['length'] = len(self)
-		enabled = self._enabled_dim_ranges()
 		spec['dimensions'] = []
 		for dim_i, origdim in enumerate(self._data['dimensions']):
+			if dim_i not in self._filters:
+				spec['dimensions'].append(origdim)
+				continue
 			dim = copy.copy(origdim)
-			origcats = dim['categories']
-			dim['categories'] = []
-			for cat_i in enabled[dim_i]:
-				dim['categories'].append(
-					origcats[cat_i])
+			origcats = origdim['categories']
+			dim['categories'] = [origcats[cat_i]
+				for cat_i in self._enabled_dim_ranges()[dim_i]]
 			spec['dimensions'].append(dim)
-
-		del spec['value_dimensions']
+		
+		spec['dimensions'].extend(self._value_dimension_specs())
+		return spec
+	
+	def _value_dimension_specs(self):
+		specs = self._spec_cache.value_dimensions
+		if specs is not None:
+			return specs
+		specs = []
 		for dim in self._data['value_dimensions']:
 			novals = OrderedDict(
 				(k, v) for (k, v) in dim.iteritems()
 					if k != 'values'
 				)
-			spec['dimensions'].append(novals)
-		return spec
+			specs.append(novals)
+		self._spec_cache.value_dimensions = specs
+		return specs
+	
+	def _filter_key(self):
+		return tuple((dim_i, tuple(sorted(cats)))
+			for dim_i, cats in sorted(self._filters.iteritems()))
 	
 	def _dimension(self, idx):
 		if not isinstance(idx, (int, long)):
@@ -175,6 +456,9 @@ class _DataCube(object):
 		return sum(i*m for i, m in zip(indices, self._dim_magnitudes))
 	
 	def __iter__(self):
+		return metrics.timed_iter('cube.iter', self._iter_rows())
+	
+	def _iter_rows(self):
 		dim_ranges = self._enabled_dim_ranges()
 		for indices in itertools.product(*dim_ranges):
 			yield _Row(self, indices)
@@ -196,11 +480,12 @@ class _DataCube(object):
 		dim_ranges = []
 		for i in range(len(self._dim_sizes)):
 			if i in self._filters:
-				dim_ranges.append(self._filters[i])
+				dim_ranges.append(sorted(self._filters[i]))
 			else:
 				dim_ranges.append(range(self._dim_sizes[i]))
 		return dim_ranges
 
+	@metrics.timed('cube.filter')
 	def filter(self, **kwargs):
 		filters = copy.deepcopy(self._filters)
 		for dim_id, categories in kwargs.items():
@@ -214,7 +499,112 @@ class _DataCube(object):
 			filters[dim_i] = set(categories)
 		# TODO: Do this without recalculating stuff by implementing
 		#	__new__ etc.
-		return _DataCube(self._data, filters)
+		return _DataCube(self._data, filters, self._spec_cache,
+			self._result_cache, self._dim_magnitudes)
+	
+	def cached(self, result_cache=None):
+		"""This cube with its results memoized in a ResultCache"""
+		if result_cache is None:
+			result_cache = ResultCache()
+		return _DataCube(self._data, self._filters, self._spec_cache,
+			result_cache, self._dim_magnitudes)
+	
+	def append_categories(self, dimension_id, categories, values):
+		"""
+		A cube with new categories appended to a dimension
+
+		The categories are ids or category dicts, and values has
+		the values of the new categories in row order; a list for
+		each value dimension if there are several. See concat.
+		"""
+		cube = self._materialize()
+		dim_i = cube._dim_indices[dimension_id]
+		categories = [c if isinstance(c, dict) else OrderedDict(id=c)
+			for c in categories]
+		value_dims = cube._data['value_dimensions']
+		if len(value_dims) == 1:
+			values = [values]
+		if len(values) != len(value_dims):
+			raise DataCubeException("Expected values for %i value dimensions"%(len(value_dims),))
+		
+		data = copy.copy(cube._data)
+		data['dimensions'] = list(data['dimensions'])
+		dim = data['dimensions'][dim_i] = copy.copy(data['dimensions'][dim_i])
+		dim['categories'] = categories
+		length = 1
+		for d in data['dimensions']:
+			length *= len(d['categories'])
+		data['value_dimensions'] = []
+		for value_dim, column in zip(value_dims, values):
+			if len(column) != length:
+				raise DataCubeException("Expected %i values, got %i"%(length, len(column)))
+			value_dim = copy.copy(value_dim)
+			value_dim['values'] = column
+			data['value_dimensions'].append(value_dim)
+		return concat([cube, _DataCube(data)], dimension_id)
+	
+	def transpose(self, *dim_ids):
+		"""
+		A view with the dimensions in another order
+
+		The given dimensions come first, followed by the rest
+		in their current order. The values aren't copied, the
+		view only reads them with permuted magnitudes.
+		"""
+		order = [self._dim_indices[id] for id in dim_ids]
+		if len(set(order)) != len(order):
+			raise DataCubeException("Repeated dimensions in %s"%(dim_ids,))
+		order += [i for i in range(len(self._dim_sizes)) if i not in order]
+		data = copy.copy(self._data)
+		data['dimensions'] = [self._data['dimensions'][i] for i in order]
+		filters = dict((new_i, set(self._filters[old_i]))
+			for (new_i, old_i) in enumerate(order)
+			if old_i in self._filters)
+		return _DataCube(data, filters, result_cache=self._result_cache,
+			magnitudes=[self._dim_magnitudes[i] for i in order])
+	
+	def pivot(self, rows, columns, category_labels=False):
+		"""
+		A wide table of the values
+
+		Returns the column keys, tuples of the categories of the
+		columns dimensions, and an iterator of the rows, which
+		have the categories of the rows dimensions followed by
+		the values of the columns. The other dimensions must be
+		filtered to a single category.
+		"""
+		n_rows, n_keys = len(rows), len(rows) + len(columns)
+		view = self.transpose(*(list(rows) + list(columns)))
+		ranges = view._enabled_dim_ranges()
+		other = [d['id'] for (d, r) in
+			zip(view._data['dimensions'], ranges)[n_keys:] if len(r) != 1]
+		if len(other) > 0:
+			raise DataCubeException("Dimensions %s are neither rows nor columns"%(other,))
+		value_dims = view._data['value_dimensions']
+		if len(value_dims) != 1:
+			raise DataCubeException("No unambiguous value dimension for this cube")
+		values = value_dims[0]['values']
+		if category_labels:
+			get_category = view._category_label
+		else:
+			get_category = view._category_id
+		
+		column_keys = [tuple(get_category(n_rows + i, c)
+				for (i, c) in enumerate(key))
+			for key in itertools.product(*ranges[n_rows:n_keys])]
+		def make_rows():
+			flat_indices = view._flat_indices()
+			for key in itertools.product(*ranges[:n_rows]):
+				row = [get_category(i, c) for (i, c) in enumerate(key)]
+				row.extend(values[i] for i in
+					itertools.islice(flat_indices, len(column_keys)))
+				yield row
+		return column_keys, make_rows()
+	
+	def _cache_source(self):
+		# The cubes of the same data share the spec cache,
+		# so it identifies the data.
+		return self._spec_cache
 	
 	def toTable(self, labels=False):
 		if labels:
@@ -238,6 +628,8 @@ class _DataCube(object):
 		for row in self:
 			yield (itertools.izip(dims, rowiter(row)))
 	
+	@metrics.timed('cube.to_columns')
+	@cached_result
 	def toColumns(self,
 			start=0, end=None,
 			dimension_labels=False, category_labels=False,
@@ -291,6 +683,211 @@ class _DataCube(object):
 			yield self.filter(**filt)
 
 	
+	@cached_result
+	def aggregate(self, grouping_columns, function='sum'):
+		"""
+		Aggregate the values over the non-grouping dimensions
+
+		Returns a cube of the grouping dimensions with the
+		aggregates of the groups as the values. The function
+		is one of AGGREGATES, and missing values are skipped.
+		"""
+		group_idx = sorted(self._dim_indices[id] for id in grouping_columns)
+		dim_ranges = self._enabled_dim_ranges()
+		keys = itertools.product(*[dim_ranges[i] for i in group_idx])
+		values = self._group_aggregates(dim_ranges, group_idx, keys, function)
+		
+		spec = self.specification
+		data = OrderedDict()
+		data['metadata'] = spec['metadata']
+		data['dimensions'] = [spec['dimensions'][i] for i in group_idx]
+		valdim = copy.copy(self._value_dimension_specs()[0])
+		valdim['values'] = values
+		data['value_dimensions'] = [valdim]
+		return _DataCube(data)
+	
+	def _group_aggregates(self, dim_ranges, group_idx, keys, function):
+		"""
+		Aggregate the groups of keys in a single pass
+
+		The keys are tuples of the category indices of the grouping
+		dimensions, and only the values of these groups are read.
+		"""
+		if function not in AGGREGATES:
+			raise ValueError("Unknown aggregate '%s'"%(function,))
+		aggregate = AGGREGATES[function]
+		value_dims = self._data['value_dimensions']
+		if len(value_dims) != 1:
+			raise DataCubeException("No unambiguous value dimension for this cube")
+		values = value_dims[0]['values']
+		convert = (lambda v: v) if function == 'count' else float
+		
+		groups = OrderedDict((key, []) for key in keys)
+		dim_ranges = list(dim_ranges)
+		for j, i in enumerate(group_idx):
+			in_groups = set(key[j] for key in groups)
+			dim_ranges[i] = [c for c in dim_ranges[i] if c in in_groups]
+		for indices in itertools.product(*dim_ranges):
+			group = groups.get(tuple(indices[i] for i in group_idx))
+			if group is None:
+				continue
+			value = values[self._flatindex(indices)]
+			if value is None:
+				continue
+			group.append(convert(value))
+		
+		result = []
+		for group in groups.itervalues():
+			if len(group) == 0:
+				result.append(0 if function == 'count' else None)
+			else:
+				result.append(aggregate(group))
+		return result
+
+	def _flat_array(self, values):
+		"""
+		An unfiltered value list as a flat NumPy array
+
+		Mapped numeric values and arrays are returned as views.
+		Numbers with missing values become floats with NaNs,
+		other values with missing ones stay as objects.
+		"""
+		import numpy as np
+		from pydatacube import binary
+		mapped = binary.numeric_buffer(values)
+		if mapped is not None:
+			array, missing = mapped
+			if missing is None:
+				return array
+			# The bitmap is least significant bit first
+			missing = np.unpackbits(np.frombuffer(missing, dtype=np.uint8))
+			missing = missing.reshape(-1, 8)[:, ::-1].reshape(-1)
+			missing = missing[:len(array)].astype(bool)
+			array = array.astype(float)
+			array[missing] = np.nan
+			return array
+		if isinstance(values, np.ndarray):
+			return values
+		array = np.array(values)
+		if array.dtype == object and all(v is None or
+				(isinstance(v, numbers.Real) and not isinstance(v, bool))
+				for v in values):
+			array = np.array(values, dtype=float)
+		return array
+
+	def to_numpy(self, value_dimension=None):
+		"""
+		The values as an array shaped by the (filtered) dimensions
+
+		Without filters the array is a view of the stored
+		values where their storage allows it.
+		"""
+		import numpy as np
+		value_dims = self._data['value_dimensions']
+		if value_dimension is None:
+			if len(value_dims) != 1:
+				raise DataCubeException("No unambiguous value dimension for this cube")
+			values = value_dims[0]['values']
+		else:
+			values = [d for d in value_dims
+				if d['id'] == value_dimension][0]['values']
+		array = self._flat_array(values)
+		if self._dim_magnitudes == dimension_magnitudes(self._dim_sizes):
+			array = array.reshape(self._dim_sizes)
+		else:
+			array = np.lib.stride_tricks.as_strided(array,
+				shape=self._dim_sizes, writeable=False,
+				strides=[m*array.strides[0] for m in self._dim_magnitudes])
+		if len(self._filters) == 0:
+			return array
+		return array[np.ix_(*self._enabled_dim_ranges())]
+
+	def to_dataframe(self, category_labels=False, index=True):
+		"""
+		The cube as a pandas.DataFrame of the value dimensions
+
+		The dimensions are a MultiIndex of their categories, or
+		with index=False, Categorical columns.
+		"""
+		import numpy as np
+		import pandas as pd
+		spec = self.specification
+		cat_dims = [d for d in spec['dimensions'] if 'categories' in d]
+		if category_labels:
+			get_cat = lambda c: c.get('label', c['id'])
+		else:
+			get_cat = lambda c: c['id']
+		categories = [map(get_cat, d['categories']) for d in cat_dims]
+		names = [d['id'] for d in cat_dims]
+		
+		columns = OrderedDict()
+		for dim in self._data['value_dimensions']:
+			columns[dim['id']] = self.to_numpy(dim['id']).reshape(-1)
+		
+		if index:
+			return pd.DataFrame(columns,
+				index=pd.MultiIndex.from_product(categories, names=names))
+		
+		sizes = [len(c) for c in categories]
+		rows = np.arange(len(self))
+		dim_columns = OrderedDict()
+		for name, cats, size, magnitude in zip(names, categories,
+				sizes, dimension_magnitudes(sizes)):
+			codes = (rows//magnitude) % size
+			dim_columns[name] = pd.Categorical.from_codes(codes, cats)
+		dim_columns.update(columns)
+		return pd.DataFrame(dim_columns)
+
+	def query(self):
+		"""A lazy Query of this cube"""
+		return Query(self)
+
+	def _query_rows(self, query, category_labels=False):
+		"""
+		Run a Query in a single pass over the values
+
+		The filters only narrow the index ranges and the page
+		is applied to the positions before any values are read,
+		so no intermediate cubes are built. Returns the column
+		ids and an iterator of the rows.
+		"""
+		ranges = self._enabled_dim_ranges()
+		for dim_id, cat_ids in query.filters.iteritems():
+			dim_i = self._dim_indices[dim_id]
+			indices = self._cat_indices[dim_id]
+			wanted = set(indices[c] for c in cat_ids if c in indices)
+			ranges[dim_i] = [c for c in ranges[dim_i] if c in wanted]
+		if category_labels:
+			get_category = self._category_label
+		else:
+			get_category = self._category_id
+		dims = self._data['dimensions']
+		value_dims = self._data['value_dimensions']
+		
+		if query.aggregation is None:
+			ids = [d['id'] for d in dims] + [d['id'] for d in value_dims]
+			positions = itertools.islice(itertools.product(*ranges),
+				query.start, query.end)
+			def make_row(indices):
+				flat_i = self._flatindex(indices)
+				return tuple([get_category(d, c)
+					for (d, c) in enumerate(indices)] +
+					[dim['values'][flat_i] for dim in value_dims])
+			return _select(ids, itertools.imap(make_row, positions),
+				query.selection)
+		
+		grouping, function = query.aggregation
+		group_idx = sorted(self._dim_indices[id] for id in grouping)
+		keys = list(itertools.islice(
+			itertools.product(*[ranges[i] for i in group_idx]),
+			query.start, query.end))
+		values = self._group_aggregates(ranges, group_idx, keys, function)
+		ids = [dims[i]['id'] for i in group_idx] + [value_dims[0]['id']]
+		rows = (tuple([get_category(i, c) for (i, c) in zip(group_idx, key)]
+				+ [value])
+			for (key, value) in zip(keys, values))
+		return _select(ids, rows, query.selection)
+
 	def __len__(self):
 		realsizes = [len(r) for r in self._enabled_dim_ranges()]
 		mylen = 1
@@ -298,3 +895,150 @@ class _DataCube(object):
 			mylen *= s
 		return mylen
 
+def concat(cubes, along):
+	"""
+	Concatenate cubes along a dimension
+
+	The cubes must have the same dimensions with the same
+	categories, except for those of the along dimension, which
+	are concatenated. Along the leading dimension the values
+	are appended to those of the first cube instead of copied,
+	so extending eg. a long time series costs only the new values.
+	"""
+	if len(cubes) == 0:
+		raise DataCubeException("No cubes to concatenate")
+	cubes = [cube._materialize() for cube in cubes]
+	first = cubes[0]
+	if along not in first._dim_indices:
+		raise DataCubeException("No dimension '%s' to concatenate along"%(along,))
+	along_i = first._dim_indices[along]
+	dims = first._data['dimensions']
+	value_ids = [d['id'] for d in first._data['value_dimensions']]
+	along_ids = set()
+	for cube in cubes:
+		other_dims = cube._data['dimensions']
+		if [d['id'] for d in other_dims] != [d['id'] for d in dims]:
+			raise DataCubeException("The dimensions of the cubes don't match")
+		if [d['id'] for d in cube._data['value_dimensions']] != value_ids:
+			raise DataCubeException("The value dimensions of the cubes don't match")
+		for i, (dim, other) in enumerate(zip(dims, other_dims)):
+			if i != along_i and dim['categories'] != other['categories']:
+				raise DataCubeException("The categories of '%s' don't match"%(dim['id'],))
+		cat_ids = set(c['id'] for c in other_dims[along_i]['categories'])
+		if len(cat_ids & along_ids) > 0:
+			raise DataCubeException("Repeated categories of '%s'"%(along,))
+		along_ids |= cat_ids
+	
+	data = copy.copy(first._data)
+	data['dimensions'] = list(dims)
+	along_dim = data['dimensions'][along_i] = copy.copy(dims[along_i])
+	along_dim['categories'] = [c for cube in cubes
+		for c in cube._data['dimensions'][along_i]['categories']]
+	outer = 1
+	for size in first._dim_sizes[:along_i]:
+		outer *= size
+	inner = 1
+	for size in first._dim_sizes[along_i + 1:]:
+		inner *= size
+	
+	data['value_dimensions'] = []
+	for value_i, value_dim in enumerate(first._data['value_dimensions']):
+		columns = [cube._data['value_dimensions'][value_i]['values']
+			for cube in cubes]
+		if along_i == 0:
+			values = _AppendableValues.of(columns[0])
+			for column in columns[1:]:
+				values = values.extended(column)
+		else:
+			# The blocks of the cubes are interleaved
+			values = []
+			blocks = [cube._dim_sizes[along_i]*inner for cube in cubes]
+			for o in xrange(outer):
+				for column, block in zip(columns, blocks):
+					values.extend(column[o*block:(o + 1)*block])
+		value_dim = copy.copy(value_dim)
+		value_dim['values'] = values
+		data['value_dimensions'].append(value_dim)
+	return _DataCube(data)
+
+def _select(column_ids, rows, selection):
+	"""Pick the selected columns of the rows"""
+	if selection is None:
+		return column_ids, rows
+	unknown = set(selection) - set(column_ids)
+	if len(unknown) > 0:
+		raise DataCubeException("No columns %s in the query"%(sorted(unknown),))
+	positions = [column_ids.index(c) for c in selection]
+	return list(selection), (tuple(row[i] for i in positions) for row in rows)
+
+class Query(object):
+	"""
+	A lazily evaluated chain of cube operations
+
+	The operations are only recorded, and the cube runs them
+	in one go when the rows or columns are asked for. The
+	filters apply before the aggregation and the page to
+	the final rows. Each method returns a new query.
+	"""
+	def __init__(self, cube):
+		self.cube = cube
+		self.filters = {}
+		self.selection = None
+		self.aggregation = None
+		self.start = 0
+		self.end = None
+	
+	def _derive(self, **changes):
+		new = copy.copy(self)
+		new.__dict__.update(changes)
+		return new
+	
+	def filter(self, **kwargs):
+		filters = dict(self.filters)
+		for dim_id, categories in kwargs.iteritems():
+			if isinstance(categories, basestring):
+				categories = [categories]
+			if self.aggregation is not None and \
+					dim_id not in self.aggregation[0]:
+				raise DataCubeException("Can't filter by '%s' after aggregating over it"%(dim_id,))
+			categories = set(categories)
+			if dim_id in filters:
+				categories &= filters[dim_id]
+			filters[dim_id] = categories
+		return self._derive(filters=filters)
+	
+	def select(self, *column_ids):
+		return self._derive(selection=list(column_ids))
+	
+	def aggregate(self, grouping_dim_ids, function='sum'):
+		if self.aggregation is not None:
+			raise DataCubeException("The query is already aggregated")
+		if function not in AGGREGATES:
+			raise ValueError("Unknown aggregate '%s'"%(function,))
+		return self._derive(aggregation=(tuple(grouping_dim_ids), function))
+	
+	def page(self, start, end=None):
+		"""Restrict to the rows start:end of the current rows"""
+		if start < 0 or (end is not None and end < start):
+			raise ValueError("Invalid page %s:%s"%(start, end))
+		new_end = self.end
+		if end is not None:
+			new_end = self.start + end
+			if self.end is not None:
+				new_end = min(new_end, self.end)
+		return self._derive(start=self.start + start, end=new_end)
+	
+	def rows(self, category_labels=False):
+		return self.cube._query_rows(self, category_labels)[1]
+	
+	def columns(self, category_labels=False):
+		ids, rows = self.cube._query_rows(self, category_labels)
+		columns = [[] for id in ids]
+		for row in rows:
+			for column, value in zip(columns, row):
+				column.append(value)
+		return OrderedDict(zip(ids, columns))
+	
+	def __iter__(self):
+		return iter(self.rows())
+
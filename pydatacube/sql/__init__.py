@@ -2,9 +2,20 @@ import itertools
 import copy
 import json
 import re
+import weakref
+import threading
+import uuid
+from collections import OrderedDict
 #import psycopg2
 #import psycopg2.extras
 import pydatacube.pydatacube
+from pydatacube.pydatacube import ResultCache, cached_result
+from pydatacube import metrics
+from pydatacube.sql.dialects import get_dialect, write_csv, value_kind, \
+	INSERT_BATCH_SIZE
+from pydatacube.sql.export import export_partitioned
+from pydatacube.sql.pool import ConnectionPool, checkout, cursor, is_pool
+from pydatacube.sql.async_cube import AsyncSqlDataCube
 
 class AlreadyExists(Exception): pass
 
@@ -22,10 +33,153 @@ TABLE_ID_MAX_LEN = 255
 TABLE_NAME_MAX_LEN = 50
 COLUMN_NAME_MAX_LEN = 50
 
+# Storage layouts of the cube data tables. The 'rows' layout
+# stores a row per cell, the 'dense' layout stores the values
+# in chunks of DENSE_CHUNK_SIZE values in flat index order.
+LAYOUTS = ('rows', 'dense')
+DENSE_CHUNK_SIZE = 4096
+# Rows fetched per round-trip when streaming query results
+ITERSIZE = 2000
+def _store_categories(dialect, cursor, categories):
+	"""Bulk insert categories, returns their surrogates"""
+	surrogates = dialect.allocate_surrogates(cursor, len(categories))
+	dialect.insert_many(cursor, """
+		INSERT INTO _categories
+		(surrogate, name, label) VALUES""",
+		[(surrogate, cat['id'], cat.get('label', None))
+			for surrogate, cat in zip(surrogates, categories)])
+	return surrogates
 
+def _link_categories(dialect, cursor, dataset_id, dimension_id, surrogates,
+		indices=None):
+	"""
+	Link categories to a dataset's dimension
+
+	The indices are the positions of the categories in
+	the dimension, by default in the order given.
+	"""
+	if indices is None:
+		indices = range(len(surrogates))
+	dialect.insert_many(cursor, """
+		INSERT INTO _dimension_categories
+		(dataset_id, dimension_id, category_surrogate, category_index)
+		VALUES""",
+		[(dataset_id, dimension_id, surrogate, index)
+			for surrogate, index in zip(surrogates, indices)])
+
+def _insert_categories(dialect, cursor, dataset_id, dimension_id, categories,
+		indices=None):
+	"""
+	Bulk insert the categories of a dimension
+
+	Returns a dict mapping the category ids to
+	their surrogates.
+	"""
+	surrogates = _store_categories(dialect, cursor, categories)
+	_link_categories(dialect, cursor, dataset_id, dimension_id, surrogates,
+		indices)
+	return dict((cat['id'], surrogate)
+		for (surrogate, cat) in zip(surrogates, categories))
+
+def _delete_categories(dialect, cursor, surrogates):
+	for batch in range(0, len(surrogates), INSERT_BATCH_SIZE):
+		batch = surrogates[batch:batch+INSERT_BATCH_SIZE]
+		where, args = dialect.in_clause('surrogate', batch)
+		dialect.execute(cursor, "DELETE from _categories WHERE %s"%where, args)
+
+def _stored_table_name(dialect, cursor, id):
+	dialect.execute(cursor, "SELECT table_name FROM _datasets WHERE id=%s",
+		[id])
+	return verify_sql_name(cursor.fetchone()[0])
+
+def _data_table_name(id):
+	return sql_name_cleanup(id)[:TABLE_NAME_MAX_LEN]
+
+def _shadow_table_name(id):
+	"""A new, unique data table name for id"""
+	suffix = uuid.uuid4().hex[:8]
+	base = sql_name_cleanup(id)[:TABLE_NAME_MAX_LEN - len(suffix) - 1]
+	return "%s_%s"%(base, suffix)
+
+def _drop_table(connection, table_name):
+	"""
+	Drop a replaced data table
+
+	With a connection pool it's done in the background, as the
+	drop has to wait for the readers still using the table.
+	"""
+	def drop():
+		with cursor(connection, commit=True) as c:
+			get_dialect(c.connection).execute(c, "DROP TABLE %s"%table_name)
+	if not is_pool(connection):
+		drop()
+		return None
+	thread = threading.Thread(target=drop)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+def _product(values):
+	result = 1
+	for value in values:
+		result *= value
+	return result
+
+def _dense_chunks(cube, chunk_size):
+	"""
+	Split the values of a cube to chunks of the dense layout
+
+	Each chunk is stored as a JSON list holding a list
+	of values per value dimension.
+	"""
+	if not hasattr(cube, '_value_columns'):
+		cube = cube._materialize()
+	columns = cube._value_columns()
+	for chunk_i, start in enumerate(range(0, len(cube), chunk_size)):
+		chunk = [list(col[start:start+chunk_size]) for col in columns]
+		yield chunk_i, json.dumps(chunk)
 
 def initialize_schema(connection):
-	c = connection.cursor()
+	"""
+	Create the metadata tables, or migrate existing ones
+
+	Safe to run on an initialized database, and needed on
+	one created by an earlier version of pydatacube.
+	"""
+	with cursor(connection, commit=True) as c:
+		dialect = get_dialect(c.connection)
+		_create_schema(dialect, c)
+		_migrate_schema(dialect, c)
+
+# Columns added to the metadata tables after their first version.
+# The existing rows get the default.
+_ADDED_COLUMNS = [
+	('_datasets', 'layout', "VARCHAR(16) NOT NULL DEFAULT 'rows'"),
+	('_datasets', 'chunk_size', "INTEGER"),
+	# The data tables of the first version are numbered
+	# from 1, the later ones by the flat index from 0.
+	('_datasets', 'row_number_base', "INTEGER NOT NULL DEFAULT 1"),
+	# Without the index, the categories were ordered by
+	# their surrogates, see _load_surrogate_maps.
+	('_dimension_categories', 'category_index', "INTEGER"),
+	# The value_kind of each value column of the rows layout,
+	# unknown for the tables loaded before it.
+	('_datasets', 'value_kinds', "TEXT"),
+	]
+
+def _table_columns(dialect, c, table_name):
+	dialect.execute(c, "SELECT * FROM %s WHERE 1=0"%(table_name))
+	c.fetchall()
+	return [d[0] for d in c.description]
+
+def _migrate_schema(dialect, c):
+	for table_name, column, definition in _ADDED_COLUMNS:
+		if column in _table_columns(dialect, c, table_name):
+			continue
+		dialect.execute(c, "ALTER TABLE %s ADD COLUMN %s %s"%(
+			table_name, column, definition))
+
+def _create_schema(dialect, c):
 	# TODO: No need to duplicate column info in
 	#	the specification
 	c.execute("""
@@ -33,7 +187,11 @@ def initialize_schema(connection):
 			id VARCHAR(%i) PRIMARY KEY,
 			table_name VARCHAR(%i) NOT NULL,
 			specification TEXT NOT NULL,
-			cube_value_column VARCHAR(%i)
+			cube_value_column VARCHAR(%i),
+			layout VARCHAR(16) NOT NULL DEFAULT 'rows',
+			chunk_size INTEGER,
+			row_number_base INTEGER NOT NULL DEFAULT 1,
+			value_kinds TEXT
 			)
 		"""%(TABLE_ID_MAX_LEN, TABLE_NAME_MAX_LEN, COLUMN_NAME_MAX_LEN))
 	
@@ -48,10 +206,10 @@ def initialize_schema(connection):
 	
 	c.execute("""
 		CREATE TABLE IF NOT EXISTS _categories (
-			surrogate serial PRIMARY KEY,
+			surrogate %s,
 			name TEXT,
 			label TEXT
-		)""")
+		)"""%(dialect.serial_primary_key))
 	
 
 	c.execute("""
@@ -59,148 +217,384 @@ def initialize_schema(connection):
 			dataset_id VARCHAR(%i),
 			dimension_id VARCHAR(%i),
 			category_surrogate INTEGER REFERENCES _categories(surrogate),
+			category_index INTEGER,
 			PRIMARY KEY(dataset_id, dimension_id, category_surrogate)
 			)
 		"""%(TABLE_ID_MAX_LEN, COLUMN_NAME_MAX_LEN))
 
 
 class ResultIter(object):
-	def __init__(self, dbresult):
+	def __init__(self, dbresult, length=None):
 		self.dbresult = dbresult
 		self.dbresult_iter = iter(dbresult)
+		self.length = length
 	
 	def next(self):
 		return self.dbresult_iter.next()
 	
 	def __len__(self):
+		if self.length is not None:
+			return self.length
 		return self.dbresult.rowcount
 	
 	def __iter__(self):
 		return self
 
+class MetadataCache(object):
+	"""
+	Parsed metadata of the datasets of a database
+
+	Shared by the SqlDataCubes of a connection, so that filtered
+	and grouped cubes don't query and parse the metadata again.
+	FromCube and Remove invalidate the datasets they change,
+	but changes made behind pydatacube's back need an
+	explicit invalidate(). The invalidations are passed on to
+	the attached ResultCaches.
+
+	If given, changes() returns a count of the writes to the
+	database, and the cache is invalidated when it changes.
+	"""
+	def __init__(self, changes=None):
+		self._datasets = {}
+		# Reentrant, as loading a value may need others
+		self._lock = threading.RLock()
+		self._result_caches = weakref.WeakSet()
+		self._changes = changes
+		self._seen_changes = changes() if changes is not None else None
+	
+	def _check_changes(self):
+		if self._changes is None:
+			return
+		changes = self._changes()
+		if changes != self._seen_changes:
+			self._seen_changes = changes
+			self.invalidate()
+	
+	def attach(self, result_cache):
+		self._result_caches.add(result_cache)
+	
+	def get(self, id, key, load):
+		self._check_changes()
+		with self._lock:
+			dataset = self._datasets.setdefault(id, {})
+			try:
+				return dataset[key]
+			except KeyError:
+				value = dataset[key] = load()
+				return value
+	
+	def invalidate(self, id=None):
+		with self._lock:
+			if id is None:
+				self._datasets.clear()
+			else:
+				self._datasets.pop(id, None)
+		for result_cache in list(self._result_caches):
+			result_cache.invalidate(id)
+
+_metadata_caches = weakref.WeakKeyDictionary()
+
+def get_metadata_cache(connection):
+	"""
+	The metadata cache of a connection or a pool
+
+	Some connections (eg. sqlite3's) can't be weakly referenced,
+	and get a new cache on every call. Those of sqlite3 are
+	invalidated when the connection has written since, so that
+	they don't outlive replaces through other cubes. Pass an
+	explicit MetadataCache to share one.
+	"""
+	try:
+		return _metadata_caches.setdefault(connection, MetadataCache())
+	except TypeError:
+		pass
+	if hasattr(connection, 'total_changes'):
+		return MetadataCache(lambda: connection.total_changes)
+	return MetadataCache()
+
+_pool_dialects = weakref.WeakKeyDictionary()
+
+def _source_dialect(source):
+	"""
+	The dialect of a connection or a pool
+
+	Detected once per pool, so that making cubes doesn't
+	need to check out a connection.
+	"""
+	if not is_pool(source):
+		return get_dialect(source)
+	try:
+		return _pool_dialects[source]
+	except (KeyError, TypeError):
+		# TypeError for pools that can't be weakly referenced,
+		# which are probed every time.
+		pass
+	with checkout(source) as connection:
+		dialect = get_dialect(connection)
+	try:
+		_pool_dialects[source] = dialect
+	except TypeError:
+		pass
+	return dialect
+
 class SqlDataCube(object):
 	@classmethod
 	def Exists(cls, connection, id):
-		c = connection.cursor()
-		c.execute("SELECT COUNT(*) from _datasets WHERE id=%s", [id])
-		return bool(c.fetchone()[0])
+		with cursor(connection) as c:
+			get_dialect(c.connection).execute(c,
+				"SELECT COUNT(*) from _datasets WHERE id=%s", [id])
+			return bool(c.fetchone()[0])
 	
 	@classmethod
-	def Remove(cls, connection, id):
-		if not cls.Exists(connection, id):
+	def Remove(cls, connection, id, metadata_cache=None):
+		if metadata_cache is None:
+			metadata_cache = get_metadata_cache(connection)
+		with cursor(connection, commit=True) as c:
+			cls._remove(c, id, metadata_cache)
+
+	@classmethod
+	def _remove(cls, c, id, metadata_cache):
+		if not cls.Exists(c.connection, id):
 			return
-		cube = cls(connection, id)
-		c = connection.cursor()
-		c.execute("DROP TABLE %s"%(cube._get_table_name()))
-		c.execute("DELETE from _dataset_dimensions WHERE dataset_id=%s", [id])
-		c.execute("DELETE from _datasets WHERE id=%s", [id])
-		
+		dialect = get_dialect(c.connection)
+		table_name = _stored_table_name(dialect, c, id)
+		dialect.execute(c, "DROP TABLE %s"%(table_name))
+		cls._remove_metadata(dialect, c, id)
+		metadata_cache.invalidate(id)
+	
+	@classmethod
+	def _remove_metadata(cls, dialect, c, id):
+		execute = dialect.execute
+		execute(c, """SELECT category_surrogate FROM _dimension_categories
+			WHERE dataset_id=%s""", [id])
+		surrogates = [r[0] for r in c.fetchall()]
+		execute(c, "DELETE from _dimension_categories WHERE dataset_id=%s", [id])
+		_delete_categories(dialect, c, surrogates)
+		execute(c, "DELETE from _dataset_dimensions WHERE dataset_id=%s", [id])
+		execute(c, "DELETE from _datasets WHERE id=%s", [id])
 
 	@classmethod
-	def FromCube(cls, connection, id, cube, replace=False):
-		if replace:
-			cls.Remove(connection, id)
+	def Open(cls, connection, id, metadata_cache=None):
+		"""Open a stored cube with the class matching its layout"""
+		cube = SqlDataCube(connection, id, metadata_cache=metadata_cache)
+		if cube._dataset()['layout'] == 'dense':
+			return DenseSqlDataCube(connection, id,
+				metadata_cache=cube._metadata, dialect=cube._dialect)
+		return cube
+
+	@classmethod
+	def FromCube(cls, connection, id, cube, replace=False,
+			layout='rows', chunk_size=DENSE_CHUNK_SIZE,
+			metadata_cache=None):
+		if layout not in LAYOUTS:
+			raise ValueError("Unknown layout '%s'"%(layout,))
+		if metadata_cache is None:
+			metadata_cache = get_metadata_cache(connection)
+		if replace and cls.Exists(connection, id):
+			cls._reload(connection, id, cube, layout, chunk_size,
+				metadata_cache)
+		else:
+			# Loaded in a single transaction over one connection
+			with cursor(connection, commit=True) as c:
+				cls._load(c, id, cube, layout, chunk_size, metadata_cache)
+		if layout == 'dense':
+			return DenseSqlDataCube(connection, id,
+				metadata_cache=metadata_cache)
+		return cls(connection, id, metadata_cache=metadata_cache)
+
+	@classmethod
+	def _load(cls, c, id, cube, layout, chunk_size, metadata_cache):
+		metadata_cache.invalidate(id)
+		dialect = get_dialect(c.connection)
+		table_name = _data_table_name(id)
+		spec, surrogates, value_kinds = cls._load_table(dialect, c,
+			table_name, cube, layout, chunk_size)
+		cls._register(dialect, c, id, table_name, spec, surrogates,
+			layout, chunk_size, value_kinds)
+	
+	@classmethod
+	def _reload(cls, connection, id, cube, layout, chunk_size,
+			metadata_cache):
+		"""
+		Replace a stored cube without taking it offline
 
+		The new version is loaded and indexed in a shadow table
+		first. Then a short transaction renames the old table
+		away and the shadow table to the cube's table name, and
+		swaps the metadata, so the readers see either version in
+		full. The table name stays the same, so that the readers
+		with cached metadata (eg. in other processes) still find
+		it. The old table is dropped after the swap. Over a plain
+		connection all this is in the caller's transaction,
+		except with SQLite, whose DDL ends transactions.
+		"""
+		table_name = _shadow_table_name(id)
+		with cursor(connection, commit=True) as c:
+			dialect = get_dialect(c.connection)
+			spec, surrogates, value_kinds = cls._load_table(dialect, c,
+				table_name, cube, layout, chunk_size)
+		old_table = _shadow_table_name(id)
+		try:
+			with checkout(connection, commit=True) as swap_connection:
+				with dialect.ddl_transaction(swap_connection) as c:
+					stored_table = _stored_table_name(dialect, c, id)
+					dialect.execute(c, "ALTER TABLE %s RENAME TO %s"%(
+						stored_table, old_table))
+					dialect.execute(c, "ALTER TABLE %s RENAME TO %s"%(
+						table_name, _data_table_name(id)))
+					cls._remove_metadata(dialect, c, id)
+					cls._register(dialect, c, id, _data_table_name(id),
+						spec, surrogates, layout, chunk_size, value_kinds)
+		except:
+			# With a plain connection everything is in the
+			# caller's transaction, and left for it to roll back.
+			if is_pool(connection):
+				with cursor(connection, commit=True) as c:
+					dialect.execute(c, "DROP TABLE %s"%table_name)
+					_delete_categories(dialect, c, list(itertools.chain(
+						*[s for (name, s) in surrogates])))
+			raise
+		finally:
+			metadata_cache.invalidate(id)
+		_drop_table(connection, old_table)
+	
+	@classmethod
+	def _load_table(cls, dialect, c, table_name, cube, layout, chunk_size):
+		"""
+		Create and fill a data table of cube
+
+		The indices are built and the statistics gathered after
+		the table is filled. The categories are stored, but not
+		linked to a dataset. Returns the specification, the
+		surrogates of the categories of each dimension column
+		and the value_kinds of the value columns (None for the
+		dense layout).
+		"""
+		cube = cube._materialize()
 		spec = copy.deepcopy(cube.specification)
 		if 'length' in spec:
 			del spec['length']
 		
-		c = connection.cursor()
 		columns_query = []
 		column_names = []
 		column_mappings = []
 		category_columns = []
+		surrogates = []
+		value_kinds = {}
+		if layout != 'dense':
+			value_kinds = dict(zip(
+				[d['id'] for d in cube._data['value_dimensions']],
+				map(value_kind, cube._value_columns())))
 		for dim in spec['dimensions']:
 			name = sql_name_cleanup(dim['id'])
 			column_names.append(name)
+			if layout == 'dense':
+				continue
 			if 'categories' not in dim:
-				columns_query.append("%s VARCHAR(255)"%name)
+				# Numeric values are stored as numbers, so they
+				# are read back as in the dense layout.
+				columns_query.append("%s %s"%(name,
+					dialect.value_column_type(value_kinds[dim['id']])))
 				column_mappings.append({})
 				continue
 			
 			category_columns.append(name)
 			columns_query.append("%s INTEGER"%name)
-			ids = []
-			surrogates = []
-			for cat in dim['categories']:
-				# Executemany's returning is broken :(
-				c.execute("""
-				INSERT INTO _categories
-				(name, label) VALUES (%s, %s)
-				RETURNING surrogate""",
-				[cat['id'], cat.get('label', None)])
-				ids.append(cat['id'])
-				surrogates.append(c.fetchone()[0])
-
-				c.execute("""
-				INSERT INTO _dimension_categories
-				(dataset_id, dimension_id, category_surrogate)
-				VALUES
-				(%s, %s, %s)
-				""", (id, name, surrogates[-1]))
-			mapping = dict(zip(ids, surrogates))
-			column_mappings.append(mapping)
-				
-				
-
-		columns_query = ",".join(columns_query)
-		table_name = sql_name_cleanup(id)[:TABLE_NAME_MAX_LEN]
-		
-		columns_query += ", _row_number serial"
-
-		create_query = "CREATE TABLE %s (%s)"%(table_name, columns_query)
-		c.execute(create_query)
-		dims = cube.specification['dimensions']
-		value_dims = [d['id'] for d in dims if 'categories' not in d]
+			dim_surrogates = _store_categories(dialect, c, dim['categories'])
+			surrogates.append((name, dim_surrogates))
+			column_mappings.append(dict((cat['id'], surrogate)
+				for (cat, surrogate)
+				in zip(dim['categories'], dim_surrogates)))
+
+		if layout == 'dense':
+			dialect.execute(c, """
+				CREATE TABLE %s (
+					chunk INTEGER PRIMARY KEY,
+					vals TEXT NOT NULL
+				)"""%(table_name))
+			dialect.insert_many(c,
+				"INSERT INTO %s (chunk, vals) VALUES"%(table_name),
+				_dense_chunks(cube, chunk_size))
+		else:
+			dialect.create_data_table(c, table_name, columns_query)
+			dialect.load_cube(c, table_name, column_names, cube,
+				column_mappings, [value_kinds[d['id']]
+					for d in cube._data['value_dimensions']])
+			dialect.create_indices(c, table_name, category_columns)
+		dialect.analyze(c, table_name)
+		return spec, surrogates, value_kinds or None
+	
+	@classmethod
+	def _register(cls, dialect, c, id, table_name, spec, surrogates,
+			layout, chunk_size, value_kinds):
+		"""Add the metadata of a loaded data table as dataset id"""
+		for name, dim_surrogates in surrogates:
+			_link_categories(dialect, c, id, name, dim_surrogates)
+		if layout != 'dense':
+			chunk_size = None
+		value_dims = [d['id'] for d in spec['dimensions']
+			if 'categories' not in d]
 		if value_dims == ['value']:
 			cube_value_column = 'value'
 		else:
 			cube_value_column = None
 
-		c.execute("""
+		dialect.execute(c, """
 			INSERT INTO _datasets
-			(id, table_name, specification, cube_value_column) VALUES
-			(%s, %s, %s, %s)""",
-			[id, table_name, json.dumps(spec), cube_value_column])
-		
+			(id, table_name, specification, cube_value_column,
+			layout, chunk_size, row_number_base, value_kinds) VALUES
+			(%s, %s, %s, %s, %s, %s, 0, %s)""",
+			[id, table_name, json.dumps(spec), cube_value_column,
+			layout, chunk_size,
+			json.dumps(value_kinds) if value_kinds else None])
 
 		dimension_labels = [[id, d['id'], d.get('label', None)]
 			for d in spec['dimensions']]
-		c.executemany("""
+		dialect.insert_many(c, """
 			INSERT INTO _dataset_dimensions
 			(dataset_id, dimension_id, dimension_label)
-			VALUES (%s, %s, %s)""", dimension_labels)
-
-		# MySQL hacks
-#		dumpfile = open('/tmp/sqlstatcube_dump.csv', 'w')
-#		for row in cube:
-#			dumpfile.write(",".join(row))
-#			dumpfile.write('\n')
-#		dumpfile.close()
-#		c.execute("""LOAD DATA INFILE '/tmp/sqlstatcube_dump.csv' INTO TABLE %s
-#			FIELDS TERMINATED BY ','"""%table_name)
-		fake_csv = CubeMappingCsv(cube, column_mappings)
-		c.copy_from(fake_csv, table_name, columns=column_names)
-
-		# Create index on the row number column, which speeds
-		# ORDER BY -operations of large queries a lot by avoiding
-		# disk sorts.
-		c.execute("""
-			CREATE INDEX ON %s (_row_number)
-			"""%(table_name))
-
-		for col in category_columns:
-			c.execute("""
-			CREATE INDEX ON %s (%s)
-			"""%(table_name, col))
-
-		return cls(connection, id)
-
-
-	def __init__(self, connection, id, filters={}):
+			VALUES""", dimension_labels)
+
+
+	def __init__(self, connection, id, filters={}, metadata_cache=None,
+			itersize=ITERSIZE, result_cache=None, dialect=None):
+		# A connection or a pool of them
 		self._connection = connection
+		if dialect is None:
+			dialect = _source_dialect(connection)
+		self._dialect = dialect
 		self._id = id
 		self._filters = filters
+		if metadata_cache is None:
+			metadata_cache = get_metadata_cache(connection)
+		self._metadata = metadata_cache
+		self.itersize = itersize
+		self._result_cache = result_cache
+		if result_cache is not None:
+			metadata_cache.attach(result_cache)
+	
+	def _execute(self, cursor, query, args=()):
+		return self._dialect.execute(cursor, query, args)
+	
+	def _cursor(self):
+		return cursor(self._connection)
+	
+	def _stream_batches(self, query, args):
+		"""
+		Stream the result rows in batches with a server side cursor
+
+		A pooled connection is kept until the iteration ends
+		or the iterator is discarded.
+		"""
+		with checkout(self._connection) as connection:
+			batches = self._dialect.stream_batches(connection, query,
+				args, self.itersize)
+			for batch in batches:
+				yield batch
+	
+	def _stream(self, query, args):
+		return itertools.chain.from_iterable(
+			self._stream_batches(query, args))
 	
 	@property
 	def specification(self):
@@ -214,29 +608,92 @@ class SqlDataCube(object):
 	def metadata(self):
 		return self._fast_specification()['metadata']
 	
+	def _dataset(self):
+		"""The (cached) _datasets entry. Don't modify."""
+		return self._metadata.get(self._id, 'dataset', self._load_dataset)
+	
+	def _load_dataset(self):
+		with self._cursor() as c:
+			self._execute(c, """
+				SELECT table_name, specification, cube_value_column,
+					layout, chunk_size, row_number_base, value_kinds
+				FROM _datasets
+				WHERE id=%s
+				""", [self._id])
+			row = c.fetchone()
+		dataset = dict(zip(('table_name', 'specification',
+			'cube_value_column', 'layout', 'chunk_size',
+			'row_number_base', 'value_kinds'), row))
+		dataset['table_name'] = verify_sql_name(dataset['table_name'])
+		dataset['specification'] = json.loads(dataset['specification'])
+		if dataset['value_kinds'] is not None:
+			dataset['value_kinds'] = json.loads(dataset['value_kinds'])
+		return dataset
+	
+	def _stored_specification(self):
+		"""The unfiltered specification. Don't modify."""
+		return self._dataset()['specification']
+	
+	def _value_column(self):
+		return self._dataset()['cube_value_column']
+	
 	def _fast_specification(self):
+		# Derived from the shared metadata, so recompute
+		# if that has been invalidated.
+		stored = self._stored_specification()
 		if hasattr(self, '_fast_specification_cache'):
-			return self._fast_specification_cache
+			source, spec = self._fast_specification_cache
+			if source is stored:
+				return spec
 		
-		c = self._connection.cursor()
-		try:
-			c.execute("""
-				SELECT specification FROM _datasets
-				WHERE id=%s
-				""", [self._id])
-			spec = json.loads(c.fetchone()[0])
-		finally:
-			c.close()
-
-		dims = {d['id']: d for d in spec['dimensions']}
-		for dim_id, cat_ids in self._filters.iteritems():
-			dim = dims[dim_id]
+		spec = copy.copy(stored)
+		spec['dimensions'] = dims = copy.copy(spec['dimensions'])
+		for i, dim in enumerate(dims):
+			if dim['id'] not in self._filters:
+				continue
+			cat_ids = self._filters[dim['id']]
+			dim = dims[i] = copy.copy(dim)
 			dim['categories'] = [cat for cat in dim['categories']
 				if cat['id'] in cat_ids]
 		
-		self._fast_specification_cache = spec
+		self._fast_specification_cache = stored, spec
 		return spec
 	
+	def _surrogate_maps(self):
+		"""
+		Map the category ids of each dimension to their surrogates
+		
+		The links store the index of each category, so the
+		mapping is built from the specification without
+		touching the shared _categories.
+		"""
+		return self._metadata.get(self._id, 'surrogate_maps',
+			self._load_surrogate_maps)
+	
+	def _load_surrogate_maps(self):
+		with self._cursor() as c:
+			self._execute(c, """
+				SELECT dimension_id, category_surrogate
+				FROM _dimension_categories
+				WHERE dataset_id=%s
+				ORDER BY COALESCE(category_index, -1), category_surrogate""",
+				[self._id])
+			surrogates = {}
+			for dim_id, surrogate in c:
+				surrogates.setdefault(dim_id, []).append(surrogate)
+		
+		maps = {}
+		for dim in self._stored_specification()['dimensions']:
+			if 'categories' not in dim:
+				continue
+			dim_surrogates = surrogates.get(sql_name_cleanup(dim['id']), [])
+			cat_ids = [cat['id'] for cat in dim['categories']]
+			if len(dim_surrogates) != len(cat_ids):
+				raise ValueError("Categories of dimension '%s' don't match the stored ones"%(dim['id'],))
+			maps[dim['id']] = dict(zip(cat_ids, dim_surrogates))
+		return maps
+	
+	@metrics.timed('sql.filter')
 	def filter(self, **kwargs):
 		filters = copy.deepcopy(self._filters)
 		# TODO: This allows filtering by categories, that may
@@ -247,22 +704,43 @@ class SqlDataCube(object):
 				categories = [categories]
 			filters[dim_id] = set(categories)
 		
-		new = SqlDataCube(self._connection, self._id, filters)
-		if hasattr(self, '_table_name_cache'):
-			new._table_name_cache = self._table_name_cache
-		
+		return self.__class__(self._connection, self._id, filters,
+			metadata_cache=self._metadata, itersize=self.itersize,
+			result_cache=self._result_cache, dialect=self._dialect)
+	
+	def cached(self, result_cache=None):
+		"""
+		This cube with its results memoized in a ResultCache
+
+		The cache is invalidated when the dataset is replaced
+		or removed through the cube's MetadataCache.
+		"""
+		if result_cache is None:
+			result_cache = ResultCache()
+		new = self.filter()
+		new._result_cache = result_cache
+		self._metadata.attach(result_cache)
 		return new
+	
+	def _cache_source(self):
+		return self._id
+	
+	def _filter_key(self):
+		return tuple((dim_id, tuple(sorted(cat_ids)))
+			for (dim_id, cat_ids) in sorted(self._filters.iteritems()))
 
 	def _get_where_clause(self):
 		parts = []
 		args = []
+		surrogate_maps = self._surrogate_maps()
 		for dim_id, cat_ids in self._filters.iteritems():
-			values = []
-			dim_id = verify_sql_name(dim_id)
-			ph = ",".join(["%s"]*len(cat_ids))
-			part = "%s IN (SELECT surrogate from _categories WHERE name IN (%s))"%(verify_sql_name(dim_id), ph)
+			mapping = surrogate_maps[dim_id]
+			# Unknown categories simply match nothing
+			surrogates = sorted(mapping[c] for c in cat_ids if c in mapping)
+			part, part_args = self._dialect.in_clause(
+				verify_sql_name(dim_id), surrogates)
 			parts.append(part)
-			args.extend(cat_ids)
+			args.extend(part_args)
 
 		# SQL doesn't accept an empty WHERE-clause
 		if len(parts) == 0:
@@ -270,115 +748,62 @@ class SqlDataCube(object):
 		return " AND ".join(parts), args
 	
 	def _get_table_name(self):
-		if hasattr(self, '_table_name_cache'):
-			return self._table_name_cache
+		return self._dataset()['table_name']
 
-		c = self._connection.cursor()
-		try:
-			c.execute("""
-				SELECT table_name FROM _datasets
-				WHERE id=%s""", [self._id])
-			table_name = verify_sql_name(c.fetchone()[0])
-		finally:
-			c.close()
-		self._table_name_cache = table_name
-		return table_name
-
-	def _get_row_labels_query(self, start=0, end=None):
-		# This is a bit black magic to get the DB
-		# to do the mapping from ids to labels.
-		dim_ids = [verify_sql_name(dim['id'])
-			for dim in self._fast_specification()['dimensions']]
+	def _decoders(self, category_labels=False):
+		"""
+		Map the stored surrogates of each column back to categories
 		
-		cols = []
-		label_joins = []
-		label_join_args = []
-		for dim_id in dim_ids:
-			label_join = """LEFT JOIN (
-				SELECT
-					category_label AS label,
-					category_id AS id
-				FROM _dimension_categories
-				WHERE
-					dataset_id=%%s AND
-					dimension_id=%%s
-				) _label_%(dim)s ON %(dim)s=_label_%(dim)s.id
-				
-				"""%dict(dim=dim_id)
-			label_joins.append(label_join)
-			label_join_args.append(self._id)
-			label_join_args.append(dim_id)
-			cols.append(
-				"COALESCE(_label_%s.label, %s) AS %s"%(
-					dim_id, dim_id, dim_id)
-				)
-				
-		
-		row_q, args = self._get_rows_query(start, end, category_labels=False)
-		dim_ids = ",".join(dim_ids)
-		from_query = " ".join(['(%s) subset'%row_q] + label_joins)
-		cols = ",".join(cols)
-		args = args + label_join_args
-		query = "SELECT %s FROM %s"%(
-			cols, from_query)
-	
-		return query, args
-	
-	def _get_row_labels_query(self, start=0, end=None, category_labels=False):
-		if category_labels:
-			return self._get_row_labels_query(start, end)
-		id_rows, args = self._get_row_ids_query(start, end)
-		mapping = """(SELECT COALESCE(label, name) FROM _categories
-				WHERE _categories.surrogate=rows.%(dim_id)s)
-				as %(dim_id)s"""
-
-		return self._get_mapping_query((id_rows, args), mapping)
+		The rows are queried as the raw surrogates, which are
+		decoded here to the category ids or labels. The value
+		columns have None as their decoder.
+		"""
+		key = 'surrogate_labels' if category_labels else 'surrogate_ids'
+		decoders = self._metadata.get(self._id, key,
+			lambda: self._load_decoders(category_labels))
+		return [decoders.get(dim['id'])
+			for dim in self._fast_specification()['dimensions']]
 	
-	def _get_rows_query(self, start=0, end=None, category_labels=False):
-		if category_labels:
-			return self._get_row_labels_query(start, end)
-		id_rows, args = self._get_row_ids_query(start, end)
-		mapping = """(SELECT name FROM _categories
-				WHERE _categories.surrogate=rows.%(dim_id)s)
-				as %(dim_id)s"""
-
-		return self._get_mapping_query((id_rows, args), mapping)
-		
-	def _get_mapping_query(self, (id_rows, args), mapping):
-		table_name = self._get_table_name()
-			
-		mappings = []
-		for dim in self._fast_specification()['dimensions']:
-			dim_id = verify_sql_name(dim['id'])
+	def _load_decoders(self, category_labels):
+		surrogate_maps = self._surrogate_maps()
+		decoders = {}
+		for dim in self._stored_specification()['dimensions']:
 			if 'categories' not in dim:
-				mappings.append(dim_id)
 				continue
+			mapping = surrogate_maps[dim['id']]
+			if category_labels:
+				get_value = lambda cat: cat.get('label', cat['id'])
+			else:
+				get_value = lambda cat: cat['id']
+			decoders[dim['id']] = dict((mapping[cat['id']], get_value(cat))
+				for cat in dim['categories'])
+		return decoders
+	
+	def _decode_rows(self, rows, category_labels=False):
+		"""Decode the surrogates of rows and drop the row numbers"""
+		decoders = list(enumerate(self._decoders(category_labels)))
+		decoders = [(i, d) for (i, d) in decoders if d is not None]
+		for row in rows:
+			row = list(row[:-1])
+			for i, decoder in decoders:
+				row[i] = decoder[row[i]]
+			yield tuple(row)
+	
+	def _get_row_ids_query(self, start=0, end=None, after=None,
+			columns=None):
+		"""
+		Query the rows start:end, or the end rows after a page token
 
-			mappings.append(mapping%dict(dim_id=dim_id))
-		cols = ",".join(mappings)
-		
-		# The query is marginally (~10%) faster on very large
-		# queries (eg. CSV dumps) if we
-		# preselect the categories like this, but probably
-		# not worth the complexity and inflexibilty.
-		# NOTE: At least with PostgreSQL 9.3, this should
-		#	be in the FROM-clause and the rows in a CTE,
-		#	otherwise the performance is horrible.
-		#cats_q = """SELECT _categories.* FROM _categories
-		#	JOIN _dimension_categories
-		#	ON category_surrogate=surrogate
-		#	WHERE dataset_id=%s"""
-		#args.append(self._id)
-
-
-		query = """
-		SELECT %s FROM (%s) rows
-		"""%(cols, id_rows)
-		return query, args
+		Selects the given dimension columns, or all of them
+		followed by the row number.
 
-		
-	
-	def _get_row_ids_query(self, start=0, end=None):
+		The rows are paged by their keys instead of OFFSET, which
+		would scan and discard all the preceding rows. The row
+		numbers are the flat indices of the stored cube (from
+		the dataset's row_number_base), so the row number of the
+		first requested row is computed here, and for an
+		unfiltered cube the whole range is.
+		"""
 		table_name = self._get_table_name()
 		where, args = self._get_where_clause()
 		if start is None:
@@ -390,60 +815,176 @@ class SqlDataCube(object):
 		
 		limit = None
 		if end is not None:
-			limit = end - start 
+			limit = end - start
 		
-		dim_ids = [verify_sql_name(dim['id'])
-			for dim in self._fast_specification()['dimensions']]
-
-		dim_ids = ",".join(dim_ids)
+		if after is not None:
+			where += " AND _row_number > %s"
+			args.append(after)
+		elif start >= len(self):
+			where = "1=0"
+			args = []
+		elif len(self._filters) == 0:
+			base = self._dataset()['row_number_base']
+			where = "_row_number >= %s"
+			args = [base + start]
+			if end is not None:
+				where += " AND _row_number < %s"
+				args.append(base + end)
+			limit = None
+		elif start > 0:
+			where += " AND _row_number >= %s"
+			args.append(self._row_number_at(start))
+		
+		if columns is None:
+			columns = [dim['id']
+				for dim in self._fast_specification()['dimensions']]
+			columns = map(verify_sql_name, columns) + ['_row_number']
+		else:
+			columns = map(verify_sql_name, columns)
+		dim_ids = ",".join(columns)
 		
 		query = "SELECT %s FROM %s WHERE %s ORDER BY _row_number"
 		query = query%(dim_ids, table_name, where)
 		
-		# MySQL hack, as it doesn't support OFFSET
-		# without LIMIT
-		#if limit is None:
-		#	limit = 18446744073709551615
 		if limit is not None:
 			query += " LIMIT %s"
 			args.append(limit)
-		query += " OFFSET %s"
-		args.append(start)
 
 		return query, args
+	
+	def _stored_positions(self):
+		"""Map the category ids of each dimension to their stored indices"""
+		return self._metadata.get(self._id, 'stored_positions',
+			self._load_stored_positions)
+	
+	def _load_stored_positions(self):
+		return dict((dim['id'], dict((cat['id'], i)
+				for (i, cat) in enumerate(dim['categories'])))
+			for dim in self._stored_specification()['dimensions']
+			if 'categories' in dim)
+
+	def _row_number_at(self, index):
+		"""The stored row number of the index'th (filtered) row"""
+		stored = [d for d in self._stored_specification()['dimensions']
+			if 'categories' in d]
+		dims = [d for d in self._fast_specification()['dimensions']
+			if 'categories' in d]
+		magnitudes = pydatacube.pydatacube.dimension_magnitudes(
+			[len(d['categories']) for d in dims])
+		stored_magnitudes = pydatacube.pydatacube.dimension_magnitudes(
+			[len(d['categories']) for d in stored])
+		positions = self._stored_positions()
+		row_number = self._dataset()['row_number_base']
+		for dim, magnitude, stored_magnitude in zip(dims,
+				magnitudes, stored_magnitudes):
+			cat_i, index = divmod(index, magnitude)
+			cat_id = dim['categories'][cat_i]['id']
+			row_number += positions[dim['id']][cat_id]*stored_magnitude
+		return row_number
 
 	def rows(self, start=0, end=None, category_labels=False):
-		query, args = self._get_rows_query(start, end, category_labels)
-		c = self._connection.cursor()
-		c.execute(query, args)
-		return ResultIter(c)
+		query, args = self._get_row_ids_query(start, end)
+		rows = self._decode_rows(self._stream(query, args), category_labels)
+		rows = metrics.timed_iter('sql.rows', rows)
+		return ResultIter(rows, self._range_length(start, end))
+	
+	def page(self, size, token=None, category_labels=False):
+		"""
+		Fetch the next size rows after a page token
+
+		Returns the rows and the token of the next page, which
+		is None after the last page. The token is opaque, but
+		stays valid as long as the cube isn't replaced.
+		"""
+		query, args = self._get_row_ids_query(0, size + 1, after=token)
+		rows = list(self._stream(query, args))
+		token = None
+		if len(rows) > size:
+			rows = rows[:size]
+			token = rows[-1][-1]
+		return list(self._decode_rows(rows, category_labels)), token
+	
+	def query(self):
+		"""A lazy Query, run as a single SQL statement"""
+		return pydatacube.pydatacube.Query(self)
+	
+	def _query_cube(self, query):
+		"""The cube narrowed by the filters of query"""
+		filters = {}
+		for dim_id, cat_ids in query.filters.iteritems():
+			if dim_id in self._filters:
+				cat_ids = cat_ids & self._filters[dim_id]
+			filters[dim_id] = cat_ids
+		return self.filter(**filters)
+	
+	def _query_rows(self, query, category_labels=False):
+		"""
+		Run a Query with a single SQL statement
+
+		The filters are merged to the WHERE clause and the page
+		to the row number range. An aggregate is grouped only
+		over the categories of the groups on the page.
+		"""
+		cube = self._query_cube(query)
+		select = pydatacube.pydatacube._select
+		if query.aggregation is None:
+			ids = cube.dimension_ids()
+			return select(ids, cube.rows(query.start, query.end,
+				category_labels), query.selection)
+		
+		grouping, function = query.aggregation
+		dims = [d for d in cube._fast_specification()['dimensions']
+			if d['id'] in grouping]
+		keys = list(itertools.islice(itertools.product(
+				*[[c['id'] for c in d['categories']] for d in dims]),
+			query.start, query.end))
+		ids = [d['id'] for d in dims] + [cube._value_column()]
+		if len(keys) == 0:
+			return select(ids, iter([]), query.selection)
+		
+		narrowed = cube.filter(**dict((d['id'], set(key[i] for key in keys))
+			for (i, d) in enumerate(dims)))
+		aggregated = narrowed.aggregate(grouping, function)
+		all_rows = aggregated.query()
+		positions = dict((row[:-1], i)
+			for (i, row) in enumerate(all_rows.rows()))
+		rows = list(all_rows.rows(category_labels))
+		return select(ids, (rows[positions[key]] for key in keys),
+			query.selection)
+	
+	def _range_length(self, start, end):
+		stop = len(self)
+		if end is not None:
+			stop = min(end, stop)
+		return max(stop - (start or 0), 0)
 
 	def __iter__(self):
-		return self.rows()
+		return iter(self.rows())
 	
 	def __getitem__(self, item):
-		if not (hasattr(item, 'start') and
-			hasattr(item, 'stop')):
-			return object.__getitem__(item)
-		if hasattr(item, 'step') and item.step != None:
-			raise NotImplemented('Slice step not implemented')
-		return self._get_iter(item.start, item.stop)
+		if not isinstance(item, slice):
+			n = len(self)
+			if item < 0:
+				item += n
+			if not 0 <= item < n:
+				raise IndexError('Row index out of range')
+			return list(self.rows(item, item + 1))[0]
+		if item.step is not None:
+			raise NotImplementedError('Slice step not implemented')
+		return self.rows(item.start, item.stop)
 	
 	def dimension_ids(self):
 		return [d['id'] for d in self._fast_specification()['dimensions']]
 	
 	def __len__(self):
-		c = self._connection.cursor()
-		try:
-			table_name = self._get_table_name()
-			where, args = self._get_where_clause()
-			query = "SELECT COUNT(*) FROM %s WHERE %s"%(
-				table_name, where)
-			c.execute(query, args)
-			return c.fetchone()[0]
-		finally:
-			c.close()
+		# The stored cubes are complete, so the length
+		# follows from the (filtered) categories.
+		return _product(len(d['categories'])
+			for d in self._fast_specification()['dimensions']
+			if 'categories' in d)
 	
+	@metrics.timed('sql.to_columns')
+	@cached_result
 	def toColumns(self, start=0, end=None, collapse_unique=True,
 			category_labels=False, dimension_labels=False):
 		dims = self._fast_specification()['dimensions']
@@ -465,48 +1006,28 @@ class SqlDataCube(object):
 				static_dims.append(
 					(d['id'], catval))
 				dim_ids.remove(d['id'])
-		# Postgres allows array_agg, but we'll have to use
-		# some hackery with MySQL. Just have to hope there
-		# are no pipes in the labels!
-		col_qs = ['array_agg(%(d)s) as %(d)s'%dict(d=verify_sql_name(d))
-			for d in dim_ids]
-		#col_qs = ["group_concat(%(d)s SEPARATOR '|') as %(d)s"%dict(d=verify_sql_name(d))
-		#	for d in dim_ids]
-		
-		rows_query, rows_args = self._get_rows_query(start, end,
-						category_labels)
-		
-		# PostgreSQL works with CTE's, but with MySQL we'll
-		# have to use a subselect.
-		query = "WITH rows_table AS (%s) SELECT %s FROM rows_table"%(
-			rows_query,
-			','.join(col_qs))
-		#query = "SELECT %s FROM (%s) rows_table"%(
-		#	','.join(col_qs), rows_query)
-		args = rows_args
-		
-		c = self._connection.cursor(
-			#cursor_factory=psycopg2.extras.RealDictCursor
-			)
-		# More MySQL hacks. Without this the result is just
-		# truncated silently.
-		#c = self._connection.cursor()
-		#c.execute("SET SESSION group_concat_max_len = 18446744073709551615;")
-		#c.close()
-
-		c = self._connection.cursor()
-		c.execute(query, args)
-		names = [d[0] for d in c.description]
-		result = c.fetchone()
-		# We have the delimiter hack on MySQL, so split
-		# to lists
-		#result = (col.split('|') for col in result)
-		result = dict(zip(names, result))
+		# The columns are built from batches of the surrogate rows,
+		# so neither the server nor the client holds the result
+		# as single huge rows. The static dimensions are known
+		# already and aren't queried.
+		decoders = dict(zip([d['id'] for d in dims],
+			self._decoders(category_labels)))
+		decoders = [decoders[d] for d in dim_ids]
+		rows_query, rows_args = self._get_row_ids_query(start, end,
+			columns=dim_ids)
+		
+		cols = [[] for d in dim_ids]
+		batches = self._stream_batches(rows_query, rows_args)
+		for batch in batches:
+			for col, decoder, values in zip(cols, decoders, zip(*batch)):
+				if decoder is not None:
+					values = map(decoder.__getitem__, values)
+				col.extend(values)
+		result = dict(zip(dim_ids, cols))
 		result.update(dict(static_dims))
 		if dimension_labels:
 			dim_labels = {d['id']: get_label(d) for d in dims}
 			result = {dim_labels[k]: v for (k,v) in result.iteritems()}
-		c.close()
 		return result
 	
 	def group_for(self, *as_values):
@@ -523,13 +1044,9 @@ class SqlDataCube(object):
 			groupings.append([c['id'] for c in dim['categories']])
 		
 		grouping_dim_ids = [d['id'] for d in grouping_dims]
-		c = self._connection.cursor()
-		cols = map(verify_sql_name, grouping_dim_ids)
-		where, args = self._get_where_clause()
-		c.execute("SELECT COUNT(DISTINCT(%s)) FROM %s WHERE %s"%(
-			",".join(cols), self._get_table_name(), where),
-			args)
-		n_groups = c.fetchone()[0]
+		# The stored cubes are complete, so every combination
+		# of the categories is a group.
+		n_groups = _product(len(g) for g in groupings)
 		grp_iter = self.__iter_groups(grouping_dim_ids, groupings)
 		return LengthIterator(grp_iter, n_groups)
 
@@ -537,11 +1054,109 @@ class SqlDataCube(object):
 		for grouping in itertools.product(*groupings):
 			yield self.filter(**dict(zip(grouping_dim_ids, grouping)))
 	
+	def _surrogate_positions(self, dim):
+		"""Map the surrogates of a (filtered) dimension to category indices"""
+		mapping = self._surrogate_maps()[dim['id']]
+		return dict((mapping[cat['id']], i)
+			for (i, cat) in enumerate(dim['categories']))
+	
+	def fetch_groups(self, *grouping_dim_ids):
+		"""
+		Fetch the groups of group_by as in-memory cubes
+		
+		All groups are read with a single query and streamed
+		as they arrive, instead of running queries for every group.
+		"""
+		dims = self._fast_specification()['dimensions']
+		grouping_dims = [d for d in dims if d['id'] in grouping_dim_ids]
+		n_groups = _product(len(d['categories']) for d in grouping_dims)
+		grp_iter = self.__iter_fetched_groups(grouping_dims)
+		return LengthIterator(grp_iter, n_groups)
+	
+	def __iter_fetched_groups(self, grouping_dims):
+		spec = self._fast_specification()
+		value_dims = [d for d in spec['dimensions'] if 'categories' not in d]
+		group_cols = [verify_sql_name(d['id']) for d in grouping_dims]
+		value_cols = [verify_sql_name(d['id']) for d in value_dims]
+		positions = map(self._surrogate_positions, grouping_dims)
+		
+		where, args = self._get_where_clause()
+		query = "SELECT %s FROM %s WHERE %s ORDER BY %s"%(
+			",".join(group_cols + value_cols), self._get_table_name(),
+			where, ",".join(group_cols + ['_row_number']))
+		rows = self._stream(query, args)
+		
+		grouping_idx = dict((d['id'], i) for (i, d) in enumerate(grouping_dims))
+		n_group_cols = len(group_cols)
+		group_key = lambda row: row[:n_group_cols]
+		for key, rows in itertools.groupby(rows, group_key):
+			columns = zip(*rows)[n_group_cols:]
+			data = copy.copy(spec)
+			data['dimensions'] = []
+			for dim in spec['dimensions']:
+				if 'categories' not in dim:
+					continue
+				if dim['id'] in grouping_idx:
+					i = grouping_idx[dim['id']]
+					dim = copy.copy(dim)
+					cat_i = positions[i][key[i]]
+					dim['categories'] = [dim['categories'][cat_i]]
+				data['dimensions'].append(dim)
+			data['value_dimensions'] = []
+			for value_dim, values in zip(value_dims, columns):
+				value_dim = copy.copy(value_dim)
+				value_dim['values'] = list(values)
+				data['value_dimensions'].append(value_dim)
+			yield pydatacube.pydatacube._DataCube(data)
+	
+	@cached_result
+	def aggregate(self, grouping_dim_ids, function='sum'):
+		"""
+		Aggregate the values with a single GROUP BY query
+
+		See _DataCube.aggregate. The values must be
+		numeric or NULL.
+		"""
+		if function not in pydatacube.pydatacube.AGGREGATES:
+			raise ValueError("Unknown aggregate '%s'"%(function,))
+		value_col = self._value_column()
+		if value_col is None:
+			raise NotImplementedError("The cube doesn't have an ordered single value column")
+		spec = self._fast_specification()
+		grouping_dims = [d for d in spec['dimensions']
+			if d['id'] in grouping_dim_ids]
+		group_cols = [verify_sql_name(d['id']) for d in grouping_dims]
+		positions = map(self._surrogate_positions, grouping_dims)
+		sizes = [len(d['categories']) for d in grouping_dims]
+		magnitudes = pydatacube.pydatacube.dimension_magnitudes(sizes)
+		
+		where, args = self._get_where_clause()
+		query = "SELECT %s FROM %s WHERE %s"%(
+			",".join(group_cols + [self._dialect.aggregate(
+				function, verify_sql_name(value_col))]),
+			self._get_table_name(), where)
+		if len(group_cols) > 0:
+			query += " GROUP BY %s"%(",".join(group_cols))
+		
+		values = [None]*_product(sizes)
+		with self._cursor() as c:
+			self._execute(c, query, args)
+			for row in c:
+				flat_i = sum(pos[surrogate]*m for (pos, surrogate, m)
+					in zip(positions, row, magnitudes))
+				values[flat_i] = row[-1]
+		
+		data = copy.copy(spec)
+		data['dimensions'] = grouping_dims
+		value_dim = [copy.copy(d) for d in spec['dimensions']
+			if d['id'] == value_col][0]
+		value_dim['values'] = values
+		data['value_dimensions'] = [value_dim]
+		return pydatacube.pydatacube._DataCube(data)
+	
+	@metrics.timed('sql.materialize')
 	def _materialize(self, allow_value_iterator=False):
-		c = self._connection.cursor()
-		c.execute("SELECT cube_value_column FROM _datasets WHERE id=%s",
-			[self._id])
-		value_col = c.fetchone()[0]
+		value_col = self._value_column()
 		if value_col is None:
 			raise NotImplementedError("Can't materialize this type of cube")
 		spec = copy.deepcopy(self.specification)
@@ -556,22 +1171,19 @@ class SqlDataCube(object):
 		q = "SELECT %s FROM %s WHERE %s ORDER BY _row_number"%(
 			verify_sql_name(value_col), self._get_table_name(),
 			where_clause)
-		c = self._connection.cursor()
-		c.execute(q, args)
+		values = (v[0] for v in self._stream(q, args))
 
 		# This way, with a proper encoder, the output can
 		# be streamed instead of read into memory
-		if allow_value_iterator:
-			val_dim['values'] = (v[0] for v in c)
-		val_dim['values'] = [v[0] for v in c]
+		if not allow_value_iterator:
+			values = list(values)
+		val_dim['values'] = values
 		spec['value_dimensions'] = [val_dim]
 		return pydatacube.pydatacube._DataCube(spec)
 	
+	@cached_result
 	def _value_dimension_values(self):
-		c = self._connection.cursor()
-		c.execute("SELECT cube_value_column FROM _datasets WHERE id=%s",
-			[self._id])
-		value_col = c.fetchone()[0]
+		value_col = self._value_column()
 		if value_col is None:
 			raise NotImplementedError("The cube doesn't have an ordered single value column")
 			
@@ -580,53 +1192,376 @@ class SqlDataCube(object):
 		q = "SELECT %s FROM %s WHERE %s ORDER BY _row_number"%(
 			verify_sql_name(value_col), self._get_table_name(),
 			where_clause)
-		c = self._connection.cursor()
-		c.execute(q, args)
-		return [r[0] for r in c]
+		return [r[0] for r in self._stream(q, args)]
 
 	
 	def dump_csv(self, output):
-		c = self._connection.cursor()
-		query = "(%s)"%c.mogrify(*self._get_rows_query())
-		c.copy_to(output, query, sep=',')
+		write_csv(self.rows(), output)
+	
+	def export(self, output, connect=None, format='csv', partitions=4,
+			category_labels=False, **kwargs):
+		"""Export in parallel partitions, see export_partitioned"""
+		export_partitioned(self, output, connect, format=format,
+			partitions=partitions, category_labels=category_labels,
+			**kwargs)
+	
+	def apply_delta(self, delta):
+		"""
+		Update the stored cube to the new version of a CubeDelta
 
-class LengthIterator(object):
-	def __init__(self, itr, length):
-		self.itr = itr
-		self.length = length
+		Only the differences are written if the cells keep their
+		row positions (see CubeDelta.keeps_row_numbers) and, in
+		the rows layout, the value columns keep their value_kind.
+		Otherwise the cube is reloaded. The whole stored cube is updated
+		regardless of the filters of this one.
+		"""
+		if not delta.matches(self._stored_specification()):
+			raise ValueError("The delta isn't from the stored version of the cube")
+		dataset = self._dataset()
+		incremental = delta.keeps_row_numbers()
+		if incremental and dataset['layout'] == 'rows':
+			# The value columns are typed by the values at load,
+			# so other kinds of values need a reload.
+			new = delta.new._materialize()
+			value_kinds = dict(zip(
+				[d['id'] for d in new._data['value_dimensions']],
+				map(value_kind, new._value_columns())))
+			incremental = value_kinds == dataset['value_kinds']
+		if incremental and dataset['layout'] == 'rows':
+			# Read before the update transaction, which
+			# may not see the pool's other connections.
+			maps = self._surrogate_maps()
+		
+		if not incremental:
+			# Loaded to a shadow table like FromCube(replace=True)
+			self._reload(self._connection, self._id, delta.new,
+				dataset['layout'], dataset['chunk_size'] or DENSE_CHUNK_SIZE,
+				self._metadata)
+			return
+		
+		with cursor(self._connection, commit=True) as c:
+			if dataset['layout'] == 'dense':
+				self._apply_dense_delta(c, delta)
+			else:
+				self._apply_row_delta(c, delta, maps)
+			spec = copy.deepcopy(delta.new.specification)
+			del spec['length']
+			self._execute(c, "UPDATE _datasets SET specification=%s WHERE id=%s",
+				[json.dumps(spec), self._id])
+		self._metadata.invalidate(self._id)
 	
-	def __iter__(self):
-		return iter(self.itr)
+	def _apply_row_delta(self, c, delta, maps):
+		dialect = self._dialect
+		table_name = self._get_table_name()
+		new = delta.new
+		dims = new._data['dimensions']
+		value_columns = [sql_name_cleanup(d['id'])
+			for d in new._data['value_dimensions']]
+		maps = dict((dim_id, dict(m)) for (dim_id, m) in maps.iteritems())
+		
+		for dim_id, cat_ids in delta.removed_categories.iteritems():
+			column = sql_name_cleanup(dim_id)
+			surrogates = [maps[dim_id][cat_id] for cat_id in cat_ids]
+			for batch in range(0, len(surrogates), INSERT_BATCH_SIZE):
+				batch = surrogates[batch:batch+INSERT_BATCH_SIZE]
+				where, args = dialect.in_clause(column, batch)
+				self._execute(c, "DELETE FROM %s WHERE %s"%(table_name, where),
+					args)
+				where, args = dialect.in_clause('category_surrogate', batch)
+				self._execute(c, """DELETE FROM _dimension_categories
+					WHERE dataset_id=%%s AND %s"""%where, [self._id] + args)
+				where, args = dialect.in_clause('surrogate', batch)
+				self._execute(c, "DELETE FROM _categories WHERE %s"%where, args)
+		
+		for dim_id, categories in delta.added_categories.iteritems():
+			maps[dim_id].update(_insert_categories(dialect, c, self._id,
+				sql_name_cleanup(dim_id), categories,
+				[new._cat_indices[dim_id][cat['id']] for cat in categories]))
+		
+		dialect.update_many(c, "UPDATE _categories SET label=%s WHERE surrogate=%s",
+			[(cat.get('label', None), maps[dim_id][cat['id']])
+				for (dim_id, categories) in delta.relabeled_categories.iteritems()
+				for cat in categories])
+		
+		base = self._dataset()['row_number_base']
+		def row_number(cat_ids):
+			return base + new._flatindex([new._cat_indices[dim['id']][cat_id]
+				for (dim, cat_id) in zip(dims, cat_ids)])
+		
+		dialect.update_many(c, "UPDATE %s SET %s WHERE _row_number=%%s"%(
+				table_name, ",".join("%s=%%s"%col for col in value_columns)),
+			[values + (row_number(cat_ids),)
+				for (cat_ids, values) in delta.changed_cells])
+		
+		columns = [sql_name_cleanup(d['id']) for d in dims] + value_columns
+		dialect.insert_many(c, "INSERT INTO %s (%s) VALUES"%(table_name,
+				",".join(columns + ['_row_number'])),
+			(tuple(maps[dim['id']][cat_id]
+					for (dim, cat_id) in zip(dims, cat_ids))
+				+ values + (row_number(cat_ids),)
+				for (cat_ids, values) in delta.added_cells()))
+	
+	def _apply_dense_delta(self, c, delta):
+		# The changed chunks are rewritten from the new version
+		new = delta.new
+		table_name = self._get_table_name()
+		chunk_size = self._dataset()['chunk_size']
+		old_length = _product(len(d['categories'])
+			for d in self._stored_specification()['dimensions']
+			if 'categories' in d)
+		n_chunks = (len(new) + chunk_size - 1)//chunk_size
+		chunks = set(new._flatindex([new._cat_indices[dim['id']][cat_id]
+				for (dim, cat_id) in zip(new._data['dimensions'], cat_ids)]
+			)//chunk_size for (cat_ids, values) in delta.changed_cells)
+		chunks.update(range(min(old_length, len(new))//chunk_size, n_chunks))
+		
+		self._execute(c, "DELETE FROM %s WHERE chunk >= %%s"%(table_name),
+			[n_chunks])
+		self._dialect.update_many(c,
+			"DELETE FROM %s WHERE chunk=%%s"%(table_name),
+			[(chunk_i,) for chunk_i in sorted(chunks)])
+		columns = new._value_columns()
+		self._dialect.insert_many(c,
+			"INSERT INTO %s (chunk, vals) VALUES"%(table_name),
+			[(chunk_i, json.dumps([list(col[chunk_i*chunk_size:
+					(chunk_i + 1)*chunk_size]) for col in columns]))
+				for chunk_i in sorted(chunks)])
+	
+	def _preload(self, category_labels=False):
+		"""Load the shared metadata needed for reading the rows"""
+		self._decoders(category_labels)
+	
+	def _with_connection(self, connection):
+		"""The same cube over another connection"""
+		return self.__class__(connection, self._id, self._filters,
+			metadata_cache=self._metadata, itersize=self.itersize,
+			result_cache=self._result_cache, dialect=self._dialect)
 
-	def __len__(self):
-		return self.length
+class _DenseChunks(object):
+	"""
+	Cache of the value chunks of a dense cube
 
-class CubeCsv(object):
-	def __init__(self, cube):
-		self.cube_iter = iter(cube)
+	Holds the chunks of the latest prefetch, and of the
+	earlier ones up to MAX_CHUNKS, the least recently
+	prefetched are dropped first.
+	"""
+	# Keep the IN-lists under SQLite's default variable limit
+	FETCH_BATCH_SIZE = 500
+	MAX_CHUNKS = 256
 
+	def __init__(self, cube, chunk_size):
+		self._cube = cube
+		self.chunk_size = chunk_size
+		self._chunks = OrderedDict()
 	
-	def readline(self, *args):
-		try:
-			return "\t".join(map(str, self.cube_iter.next()))+"\n"
-		except StopIteration:
-			return ""
+	def prefetch(self, flat_indices):
+		"""Fetch the chunks holding the given values in one go"""
+		size = self.chunk_size
+		wanted = sorted(set(i//size for i in flat_indices))
+		self._fetch([i for i in wanted if i not in self._chunks])
+		for chunk_i in wanted:
+			self._chunks[chunk_i] = self._chunks.pop(chunk_i)
+		while len(self._chunks) > max(self.MAX_CHUNKS, len(wanted)):
+			self._chunks.popitem(last=False)
 	
-	read = readline
+	def _fetch(self, needed):
+		if len(needed) == 0:
+			return
+		with self._cube._cursor() as c:
+			for batch in range(0, len(needed), self.FETCH_BATCH_SIZE):
+				batch = needed[batch:batch+self.FETCH_BATCH_SIZE]
+				ph = ",".join(["%s"]*len(batch))
+				self._cube._execute(c,
+					"SELECT chunk, vals FROM %s WHERE chunk IN (%s)"%(
+						self._cube._get_table_name(), ph), batch)
+				for chunk_i, vals in c:
+					self._chunks[chunk_i] = json.loads(vals)
 
-class CubeMappingCsv(object):
-	def __init__(self, cube, mappings):
-		self.cube_iter = iter(cube)
-		self.mappings = mappings
+	def value(self, column_i, flat_i):
+		chunk_i = flat_i//self.chunk_size
+		if chunk_i not in self._chunks:
+			self._fetch([chunk_i])
+		return self._chunks[chunk_i][column_i][flat_i%self.chunk_size]
+
+class _DenseValues(object):
+	"""Lazy sequence of the values of a dense cube's value dimension"""
+	def __init__(self, chunks, column_i, length):
+		self._chunks = chunks
+		self._column_i = column_i
+		self._length = length
 	
-	def readline(self, *args):
-		try:
-			row = self.cube_iter.next()
-		except StopIteration:
-			return ""
+	def __len__(self):
+		return self._length
+	
+	def __getitem__(self, flat_i):
+		if not 0 <= flat_i < self._length:
+			raise IndexError(flat_i)
+		return self._chunks.value(self._column_i, flat_i)
+	
+	def __iter__(self):
+		self._chunks.prefetch(xrange(self._length))
+		for i in xrange(self._length):
+			yield self[i]
 
-		row = [m.get(v, v) for m, v in zip(self.mappings, row)]
-		return "\t".join(map(str, row))+"\n"
+class DenseSqlDataCube(SqlDataCube):
+	"""
+	A cube stored in the dense layout
+
+	The values are stored in flat index order in chunks, so
+	there are no per-cell rows or category indices. The queries
+	are answered by an in-memory cube whose values are fetched
+	lazily, so that only the chunks covering the
+	filtered cells and requested rows are read.
+	"""
+	def _base(self):
+		# Kept per cube, but derived from the shared metadata,
+		# so rebuilt if that has been invalidated.
+		dataset = self._dataset()
+		if hasattr(self, '_base_cache'):
+			source, cube, chunks = self._base_cache
+			if source is dataset:
+				return cube, chunks
+		
+		spec = dataset['specification']
+		chunk_size = dataset['chunk_size']
+		data = copy.copy(spec)
+		data['dimensions'] = [d for d in spec['dimensions']
+			if 'categories' in d]
+		length = 1
+		for dim in data['dimensions']:
+			length *= len(dim['categories'])
+		
+		chunks = _DenseChunks(self, chunk_size)
+		data['value_dimensions'] = []
+		for dim in spec['dimensions']:
+			if 'categories' in dim:
+				continue
+			dim = copy.copy(dim)
+			dim['values'] = _DenseValues(chunks,
+				len(data['value_dimensions']), length)
+			data['value_dimensions'].append(dim)
 		
-	read = readline
+		cube = pydatacube.pydatacube._DataCube(data)
+		self._base_cache = dataset, cube, chunks
+		return cube, chunks
+	
+	def _cube(self):
+		base = self._base()[0]
+		if hasattr(self, '_cube_cache'):
+			source, cube = self._cube_cache
+			if source is base:
+				return cube
+		# Like in the row layout, unknown categories match nothing
+		filters = {}
+		for dim_id, cat_ids in self._filters.iteritems():
+			known = base._cat_indices[dim_id]
+			filters[dim_id] = [c for c in cat_ids if c in known]
+		cube = base.filter(**filters)
+		self._cube_cache = base, cube
+		return cube
+	
+	def _preload(self, category_labels=False):
+		# The categories are in the specification
+		self._stored_specification()
+	
+	def _prefetch(self, start=0, end=None):
+		indices = itertools.islice(self._cube()._flat_indices(), start, end)
+		self._base()[1].prefetch(indices)
+
+	def filter(self, **kwargs):
+		new = SqlDataCube.filter(self, **kwargs)
+		if hasattr(self, '_base_cache'):
+			new._base_cache = self._base_cache
+		return new
+	
+	def _query_rows(self, query, category_labels=False):
+		cube = self._query_cube(query)
+		if query.aggregation is None:
+			cube._prefetch(query.start, query.end)
+		else:
+			cube._prefetch()
+		return cube._cube()._query_rows(query, category_labels)
 
+	def __len__(self):
+		return len(self._cube())
+	
+	def rows(self, start=0, end=None, category_labels=False):
+		if start is None:
+			start = 0
+		self._prefetch(start, end)
+		# Sliced before reading the values, so that only the
+		# prefetched chunks are touched.
+		rows = itertools.islice(iter(self._cube()), start, end)
+		if category_labels:
+			rows = (tuple(row.labels()) for row in rows)
+		else:
+			rows = (tuple(row.ids()) for row in rows)
+		return ResultIter(rows, self._range_length(start, end))
+	
+	def page(self, size, token=None, category_labels=False):
+		# The rows are addressed directly, so the token is
+		# just the index of the next row.
+		start = token or 0
+		rows = list(self.rows(start, start + size, category_labels))
+		if start + size >= len(self):
+			return rows, None
+		return rows, start + size
+	
+	@cached_result
+	def toColumns(self, start=0, end=None, collapse_unique=True,
+			category_labels=False, dimension_labels=False):
+		self._prefetch(start, end)
+		columns = self._cube().toColumns(start, end,
+			dimension_labels=dimension_labels,
+			category_labels=category_labels,
+			collapse_unique=collapse_unique)
+		return {k: list(v) if isinstance(v, tuple) else v
+			for (k, v) in columns.iteritems()}
+	
+	def group_by(self, *grouping_dim_ids):
+		dims = [d for d in self._fast_specification()['dimensions']
+			if d['id'] in grouping_dim_ids]
+		groupings = [[c['id'] for c in d['categories']] for d in dims]
+		dim_ids = [d['id'] for d in dims]
+		n_groups = _product(len(g) for g in groupings)
+		grp_iter = (self.filter(**dict(zip(dim_ids, grouping)))
+			for grouping in itertools.product(*groupings))
+		return LengthIterator(grp_iter, n_groups)
+	
+	def fetch_groups(self, *grouping_dim_ids):
+		n_groups = len(self.group_by(*grouping_dim_ids))
+		groups = self._materialize().group_by(*grouping_dim_ids)
+		return LengthIterator((g._materialize() for g in groups), n_groups)
+	
+	@cached_result
+	def aggregate(self, grouping_dim_ids, function='sum'):
+		return self._materialize().aggregate(grouping_dim_ids, function)
+
+	def _materialize(self, allow_value_iterator=False):
+		self._prefetch()
+		materialized = self._cube()._materialize()
+		data = copy.copy(materialized._data)
+		data['value_dimensions'] = []
+		for dim in materialized._data['value_dimensions']:
+			dim = copy.copy(dim)
+			dim['values'] = list(dim['values'])
+			data['value_dimensions'].append(dim)
+		return pydatacube.pydatacube._DataCube(data)
+	
+	@cached_result
+	def _value_dimension_values(self):
+		value_dims = self._materialize()._data['value_dimensions']
+		if len(value_dims) != 1:
+			raise NotImplementedError("The cube doesn't have an ordered single value column")
+		return value_dims[0]['values']
+
+class LengthIterator(object):
+	def __init__(self, itr, length):
+		self.itr = itr
+		self.length = length
+	
+	def __iter__(self):
+		return iter(self.itr)
+
+	def __len__(self):
+		return self.length
@@ -0,0 +1,165 @@
+"""Non-blocking queries of SqlDataCubes
+
+Python 2 has no asyncio, so the queries are run in a thread
+pool, and the methods return multiprocessing.pool.AsyncResults
+instead of coroutines. The caller (eg. an event loop thread) is
+not blocked, and independent queries run concurrently. For
+actual concurrency in the database, the cube should be over
+a connection pool (see pydatacube.sql.pool).
+"""
+import itertools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+
+# Rows per batch of a RowStream
+STREAM_BATCH_SIZE = 2000
+
+class Gathered(object):
+	"""The results of several AsyncResults, in order"""
+	def __init__(self, results):
+		self._results = results
+
+	def ready(self):
+		return all(r.ready() for r in self._results)
+
+	def wait(self, timeout=None):
+		for result in self._results:
+			result.wait(timeout)
+
+	def get(self, timeout=None):
+		return [r.get(timeout) for r in self._results]
+
+class RowStream(object):
+	"""
+	Rows fetched in the background, batch by batch
+
+	At most prefetch batches are read ahead. The rows can be
+	iterated, which blocks only when the next batch hasn't
+	arrived, or taken with next_batch(timeout).
+	"""
+	_END = object()
+
+	def __init__(self, rows, batch_size=STREAM_BATCH_SIZE, prefetch=2):
+		self._batches = Queue.Queue(prefetch)
+		self._closed = threading.Event()
+		self._done = False
+		self._thread = threading.Thread(target=self._produce,
+			args=(rows, batch_size))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _produce(self, rows, batch_size):
+		try:
+			rows = iter(rows())
+			while not self._closed.is_set():
+				batch = list(itertools.islice(rows, batch_size))
+				if len(batch) == 0:
+					break
+				self._put(batch)
+		except Exception, e:
+			self._put(e)
+		self._put(self._END)
+
+	def _put(self, item):
+		# Don't block forever on a closed stream
+		while not self._closed.is_set():
+			try:
+				self._batches.put(item, timeout=0.1)
+				return
+			except Queue.Full:
+				pass
+
+	def next_batch(self, timeout=None):
+		"""The next list of rows, or None after the last one"""
+		if self._done:
+			return None
+		try:
+			item = self._batches.get(timeout=timeout)
+		except Queue.Empty:
+			raise threading.ThreadError("Timed out waiting for rows")
+		if item is self._END:
+			self._done = True
+			return None
+		if isinstance(item, Exception):
+			self._done = True
+			raise item
+		return item
+
+	def __iter__(self):
+		while True:
+			batch = self.next_batch()
+			if batch is None:
+				return
+			for row in batch:
+				yield row
+
+	def close(self):
+		self._closed.set()
+		self._done = True
+
+class AsyncSqlDataCube(object):
+	"""
+	A SqlDataCube with queries running in a thread pool
+
+	Mirrors the query methods of SqlDataCube, but returns
+	AsyncResults. The executor (a ThreadPool) is shared by
+	the filtered and grouped cubes.
+	"""
+	def __init__(self, cube, executor=None, workers=4):
+		self.cube = cube
+		if executor is None:
+			executor = ThreadPool(workers)
+		self._executor = executor
+
+	def _submit(self, function, *args, **kwargs):
+		return self._executor.apply_async(function, args, kwargs)
+
+	def _wrap(self, cube):
+		return AsyncSqlDataCube(cube, executor=self._executor)
+
+	def filter(self, **kwargs):
+		# Filtering is lazy, so there's nothing to wait for
+		return self._wrap(self.cube.filter(**kwargs))
+
+	def count(self):
+		return self._submit(len, self.cube)
+
+	def specification(self):
+		return self._submit(lambda: self.cube.specification)
+
+	def rows(self, start=0, end=None, category_labels=False):
+		return self._submit(lambda: list(
+			self.cube.rows(start, end, category_labels)))
+
+	def page(self, size, token=None, category_labels=False):
+		return self._submit(self.cube.page, size, token, category_labels)
+
+	def toColumns(self, *args, **kwargs):
+		return self._submit(self.cube.toColumns, *args, **kwargs)
+
+	def group_by(self, *grouping_dim_ids):
+		return self._submit(lambda: map(self._wrap,
+			self.cube.group_by(*grouping_dim_ids)))
+
+	def fetch_groups(self, *grouping_dim_ids):
+		return self._submit(lambda: list(
+			self.cube.fetch_groups(*grouping_dim_ids)))
+
+	def aggregate(self, grouping_dim_ids, function='sum'):
+		return self._submit(self.cube.aggregate, grouping_dim_ids, function)
+
+	def stream(self, start=0, end=None, category_labels=False,
+			batch_size=STREAM_BATCH_SIZE, prefetch=2):
+		"""Stream the rows in batches fetched in the background"""
+		return RowStream(lambda: self.cube.rows(start, end, category_labels),
+			batch_size, prefetch)
+
+	def overview(self, page_size):
+		"""
+		The length, specification and first page_size rows
+
+		The three are queried concurrently.
+		"""
+		return Gathered([self.count(), self.specification(),
+			self.rows(0, page_size)])
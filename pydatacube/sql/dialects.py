@@ -0,0 +1,421 @@
+"""SQL dialect specifics for pydatacube.sql
+
+The cube queries are written with DB-API "format" placeholders (%s)
+and the dialects translate them and implement the operations that
+differ between databases, most importantly the bulk loading.
+"""
+import itertools
+import contextlib
+import numbers
+import struct
+import csv
+import sqlite3
+import time
+from pydatacube import metrics
+
+# Rows per multi-row INSERT
+INSERT_BATCH_SIZE = 1000
+# Bytes per block handed to COPY
+COPY_BLOCK_SIZE = 1<<20
+
+_cursor_names = itertools.count()
+
+def _batches(items, size):
+	for i in range(0, len(items), size):
+		yield items[i:i+size]
+
+def _category_surrogates(cube, mappings):
+	dims = cube.specification['dimensions']
+	return [[mapping[cat['id']] for cat in dim['categories']]
+		for dim, mapping in zip(dims, mappings)
+		if 'categories' in dim]
+
+def value_kind(values):
+	"""
+	The kind of the values of a value dimension
+
+	'integer' or 'numeric' if all the values (besides missing
+	ones) are integers or numbers, 'text' otherwise.
+	"""
+	kind = None
+	for value in values:
+		if value is None:
+			continue
+		if isinstance(value, bool) or not isinstance(value, numbers.Real):
+			return 'text'
+		if not isinstance(value, numbers.Integral):
+			kind = 'numeric'
+		elif kind is None:
+			kind = 'integer'
+	return kind or 'text'
+
+def write_csv(rows, output):
+	writer = csv.writer(output)
+	for row in rows:
+		writer.writerow([v.encode('utf-8') if isinstance(v, unicode)
+			else v for v in row])
+
+def cube_rows(cube, mappings):
+	"""
+	Iterate the rows of a cube as loaded to the database
+
+	The categories are mapped to their surrogates and
+	the flat row number is appended as the last column.
+	"""
+	if not hasattr(cube, '_value_columns'):
+		cube = cube._materialize()
+	surrogates = itertools.product(*_category_surrogates(cube, mappings))
+	values = itertools.izip(*cube._value_columns())
+	for i, (cats, vals) in enumerate(itertools.izip(surrogates, values)):
+		yield cats + vals + (i,)
+
+_COPY_NULL = struct.pack('>i', -1)
+
+def _copy_text(value):
+	if value is None:
+		return _COPY_NULL
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	else:
+		value = str(value)
+	return struct.pack('>i', len(value)) + value
+
+def _copy_integer(value):
+	if value is None:
+		return _COPY_NULL
+	return struct.pack('>iq', 8, value)
+
+def _copy_numeric(value):
+	if value is None:
+		return _COPY_NULL
+	return struct.pack('>id', 8, value)
+
+# The binary COPY field encoders of the value kinds
+_COPY_ENCODERS = {
+	'text': _copy_text,
+	'integer': _copy_integer,
+	'numeric': _copy_numeric,
+	}
+
+class CubeCopyBinary(object):
+	"""
+	A file-like PostgreSQL binary COPY stream of a cube
+
+	The category columns are written as the integer
+	surrogates given in mappings, the value columns
+	as bigints, doubles or text by their value_kinds and
+	the flat row number as the last column.
+	The row encodings of the categories are built
+	once per dimension, so producing a row is just
+	a join of prebuilt strings.
+	"""
+	HEADER = "PGCOPY\n\xff\r\n\0" + struct.pack('>ii', 0, 0)
+	TRAILER = struct.pack('>h', -1)
+	NULL = _COPY_NULL
+
+	def __init__(self, cube, mappings, value_kinds=None,
+			rows_per_block=10000):
+		if not hasattr(cube, '_value_columns'):
+			cube = cube._materialize()
+		dims = cube.specification['dimensions']
+		if value_kinds is None:
+			value_kinds = ['text']*len(cube._data['value_dimensions'])
+		self._encoders = [_COPY_ENCODERS[kind] for kind in value_kinds]
+
+		category_fields = [[struct.pack('>ii', 4, s) for s in surrogates]
+			for surrogates in _category_surrogates(cube, mappings)]
+
+		self._row_header = struct.pack('>h', len(dims) + 1)
+		self._fields = itertools.product(*category_fields)
+		self._values = itertools.izip(*cube._value_columns())
+		self._rows_per_block = rows_per_block
+		self._blocks = self._iter_blocks()
+		self._buffer = ""
+
+	def _iter_blocks(self):
+		yield self.HEADER
+		encoders = self._encoders
+		header = self._row_header
+		rows = itertools.izip(self._fields, self._values)
+		row_number = 0
+		while True:
+			block = []
+			for fields, values in itertools.islice(rows, self._rows_per_block):
+				block.append(header)
+				block.extend(fields)
+				block.extend(e(v) for (e, v) in zip(encoders, values))
+				block.append(struct.pack('>iq', 8, row_number))
+				row_number += 1
+			if len(block) == 0:
+				break
+			yield "".join(block)
+		yield self.TRAILER
+
+	def read(self, size=-1):
+		while size < 0 or len(self._buffer) < size:
+			try:
+				self._buffer += self._blocks.next()
+			except StopIteration:
+				break
+		if size < 0:
+			size = len(self._buffer)
+		data, self._buffer = self._buffer[:size], self._buffer[size:]
+		return data
+
+class PostgresDialect(object):
+	name = 'postgresql'
+	serial_primary_key = "serial PRIMARY KEY"
+	numeric_type = "DOUBLE PRECISION"
+	integer_type = "BIGINT"
+	text_type = "VARCHAR(255)"
+
+	def execute(self, cursor, query, args=()):
+		"""Run a query, reporting it to pydatacube.metrics"""
+		if not metrics.registry.enabled:
+			return self._execute(cursor, query, args)
+		with metrics.registry.timer('sql.query', query=query) as fields:
+			self._execute(cursor, query, args)
+			fields['rows'] = cursor.rowcount
+		return cursor
+
+	def _execute(self, cursor, query, args):
+		cursor.execute(query, args)
+		return cursor
+
+	def streaming_cursor(self, connection, itersize):
+		# A named cursor is a server side cursor in psycopg2
+		cursor = connection.cursor(
+			name="pydatacube_%i"%_cursor_names.next())
+		cursor.itersize = itersize
+		return cursor
+
+	def stream_batches(self, connection, query, args, itersize):
+		"""
+		Iterate the result of a query as lists of itersize rows
+
+		The cursor is closed when the iteration ends
+		or the iterator is discarded.
+		"""
+		cursor = self.streaming_cursor(connection, itersize)
+		# Timed over the whole iteration, as the rows
+		# are fetched while iterating.
+		n_rows = 0
+		elapsed = 0.0
+		try:
+			start = time.time()
+			self._execute(cursor, query, args)
+			while True:
+				rows = cursor.fetchmany(itersize)
+				elapsed += time.time() - start
+				if len(rows) == 0:
+					break
+				n_rows += len(rows)
+				yield rows
+				start = time.time()
+		finally:
+			cursor.close()
+			if metrics.registry.enabled:
+				metrics.registry.timing('sql.query', elapsed, query=query,
+					rows=n_rows)
+
+	def stream(self, connection, query, args, itersize):
+		"""Iterate the rows of a query fetched in batches of itersize"""
+		return itertools.chain.from_iterable(
+			self.stream_batches(connection, query, args, itersize))
+
+	def insert_many(self, cursor, query, rows):
+		"""
+		Insert rows with a query ending in VALUES
+
+		Sent as multi-row VALUES lists of INSERT_BATCH_SIZE rows.
+		"""
+		rows = list(rows)
+		if len(rows) == 0:
+			return
+		ph = "(%s)"%",".join(["%s"]*len(rows[0]))
+		for batch in _batches(rows, INSERT_BATCH_SIZE):
+			args = list(itertools.chain.from_iterable(batch))
+			self.execute(cursor,
+				query + " " + ",".join([ph]*len(batch)), args)
+
+	def update_many(self, cursor, query, rows):
+		"""Run an UPDATE or DELETE query for each of the argument rows"""
+		from psycopg2.extras import execute_batch
+		rows = list(rows)
+		with metrics.registry.timer('sql.query', query=query,
+				rows=len(rows)):
+			execute_batch(cursor, query, rows, page_size=INSERT_BATCH_SIZE)
+
+	@contextlib.contextmanager
+	def ddl_transaction(self, connection):
+		"""
+		A cursor for statements that include DDL
+
+		PostgreSQL's DDL is transactional, so the statements
+		are in the connection's transaction as usual.
+		"""
+		cursor = connection.cursor()
+		try:
+			yield cursor
+		finally:
+			cursor.close()
+
+	def allocate_surrogates(self, cursor, n):
+		"""Reserve a block of n category surrogates from the sequence"""
+		self.execute(cursor, """
+			SELECT nextval(pg_get_serial_sequence('_categories', 'surrogate'))
+			FROM generate_series(1, %s)""", [n])
+		return [r[0] for r in cursor.fetchall()]
+
+	def create_data_table(self, cursor, table_name, columns):
+		columns = columns + ["_row_number BIGINT NOT NULL"]
+		self.execute(cursor, "CREATE TABLE %s (%s)"%(
+			table_name, ",".join(columns)))
+
+	def value_column_type(self, kind):
+		"""The column type for values of a value_kind"""
+		return {'integer': self.integer_type,
+			'numeric': self.numeric_type}.get(kind, self.text_type)
+
+	def load_cube(self, cursor, table_name, column_names, cube, mappings,
+			value_kinds):
+		column_names = column_names + ['_row_number']
+		copy_source = CubeCopyBinary(cube, mappings, value_kinds)
+		with metrics.registry.timer('sql.query', query="COPY %s"%table_name):
+			cursor.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT binary)"%(
+				table_name, ",".join(column_names)),
+				copy_source, size=COPY_BLOCK_SIZE)
+
+	def create_indices(self, cursor, table_name, category_columns):
+		# The row number index speeds ORDER BY -operations of
+		# large queries a lot by avoiding disk sorts.
+		self.execute(cursor, "CREATE UNIQUE INDEX ON %s (_row_number)"%(
+			table_name))
+		for col in category_columns:
+			self.execute(cursor, "CREATE INDEX ON %s (%s)"%(
+				table_name, col))
+
+	def analyze(self, cursor, table_name):
+		"""Gather the planner statistics of a freshly loaded table"""
+		self.execute(cursor, "ANALYZE %s"%(table_name))
+
+	def aggregate(self, function, column):
+		"""SQL for an aggregate of pydatacube.pydatacube.AGGREGATES"""
+		if function == 'count':
+			return "COUNT(%s)"%column
+		return "%s(CAST(%s AS %s))"%(function.upper(), column,
+			self.numeric_type)
+
+	def in_clause(self, column, values):
+		"""A predicate matching the column to any of the integer values"""
+		return "%s = ANY(%%s)"%column, [list(values)]
+
+class SqliteDialect(PostgresDialect):
+	"""
+	SQLite as a local, embeddable cube store
+
+	The data tables are WITHOUT ROWID tables clustered
+	by the flat row number, so the category indices
+	carry the row number and cover the filtered, ordered
+	row scans.
+	"""
+	name = 'sqlite'
+	serial_primary_key = "INTEGER PRIMARY KEY"
+	numeric_type = "REAL"
+	integer_type = "INTEGER"
+
+	def _translate(self, query):
+		return query.replace('%s', '?')
+
+	def _execute(self, cursor, query, args):
+		cursor.execute(self._translate(query), args)
+		return cursor
+
+	def streaming_cursor(self, connection, itersize):
+		# sqlite3 steps the statement as rows are fetched
+		return connection.cursor()
+
+	def insert_many(self, cursor, query, rows):
+		rows = iter(rows)
+		try:
+			first = rows.next()
+		except StopIteration:
+			return
+		ph = "(%s)"%",".join(["?"]*len(first))
+		with metrics.registry.timer('sql.query', query=query) as fields:
+			cursor.executemany(self._translate(query) + " " + ph,
+				itertools.chain([first], rows))
+			fields['rows'] = cursor.rowcount
+
+	def update_many(self, cursor, query, rows):
+		with metrics.registry.timer('sql.query', query=query) as fields:
+			cursor.executemany(self._translate(query), rows)
+			fields['rows'] = cursor.rowcount
+
+	@contextlib.contextmanager
+	def ddl_transaction(self, connection):
+		# sqlite3 commits its transaction before DDL statements,
+		# so the block runs in an explicit one, with the module's
+		# transaction handling off. A pending transaction is
+		# committed first.
+		connection.commit()
+		isolation_level = connection.isolation_level
+		connection.isolation_level = None
+		cursor = connection.cursor()
+		try:
+			cursor.execute("BEGIN IMMEDIATE")
+			try:
+				yield cursor
+			except:
+				cursor.execute("ROLLBACK")
+				raise
+			cursor.execute("COMMIT")
+		finally:
+			cursor.close()
+			connection.isolation_level = isolation_level
+
+	def allocate_surrogates(self, cursor, n):
+		# sqlite3 starts its transaction only at the first write,
+		# so the write lock is taken before reading the maximum.
+		# The block is then ours until the transaction ends. A
+		# transaction that has written already holds the lock.
+		try:
+			cursor.execute("BEGIN IMMEDIATE")
+		except sqlite3.OperationalError as e:
+			if 'within a transaction' not in str(e):
+				raise
+		self.execute(cursor, "SELECT COALESCE(MAX(surrogate), 0) FROM _categories")
+		last = cursor.fetchone()[0]
+		return range(last + 1, last + 1 + n)
+
+	def create_data_table(self, cursor, table_name, columns):
+		columns = columns + ["_row_number INTEGER PRIMARY KEY"]
+		self.execute(cursor, "CREATE TABLE %s (%s) WITHOUT ROWID"%(
+			table_name, ",".join(columns)))
+
+	def load_cube(self, cursor, table_name, column_names, cube, mappings,
+			value_kinds):
+		# The values are stored with their own types
+		column_names = column_names + ['_row_number']
+		self.insert_many(cursor, "INSERT INTO %s (%s) VALUES"%(
+			table_name, ",".join(column_names)),
+			cube_rows(cube, mappings))
+
+	def create_indices(self, cursor, table_name, category_columns):
+		for col in category_columns:
+			self.execute(cursor, "CREATE INDEX %s_%s ON %s (%s)"%(
+				table_name, col, table_name, col))
+
+	def in_clause(self, column, values):
+		# The values are integer surrogates, so they are inlined
+		# as literals instead of variables, whose number older
+		# SQLite builds limit to 999 per statement.
+		if len(values) == 0:
+			return "1=0", []
+		return "%s IN (%s)"%(column, ",".join("%i"%v for v in values)), []
+
+def get_dialect(connection):
+	"""Pick the dialect for a DB-API connection"""
+	if isinstance(connection, sqlite3.Connection):
+		return SqliteDialect()
+	return PostgresDialect()
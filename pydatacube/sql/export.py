@@ -0,0 +1,136 @@
+"""Partitioned parallel exports of SqlDataCubes
+
+The rows are split to contiguous ranges, which are read
+concurrently over separate connections and written to the
+output in order. The ranges are row number range scans,
+so a large export is spread over several database backends
+instead of running as a single query.
+"""
+import copy
+import json
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from pydatacube import jsonstat, binary
+import pydatacube.pydatacube
+from pydatacube.sql.dialects import write_csv
+from pydatacube.sql.pool import is_pool
+
+EXPORT_FORMATS = ('csv', 'jsonstat', 'binary')
+
+def partition_ranges(length, partitions):
+	"""Split range(length) to at most partitions contiguous ranges"""
+	partitions = max(min(partitions, length), 1)
+	bounds = [length*i//partitions for i in range(partitions + 1)]
+	return zip(bounds[:-1], bounds[1:])
+
+def _close(connection):
+	connection.close()
+
+def _write_csv_part(cube, start, end, output, category_labels):
+	write_csv(cube.rows(start, end, category_labels), output)
+
+def _write_jsonstat_part(cube, start, end, output, category_labels):
+	dims = cube.specification['dimensions']
+	value_i = [i for (i, d) in enumerate(dims) if 'categories' not in d][0]
+	values = (json.dumps(row[value_i]) for row in cube.rows(start, end))
+	# The parts are concatenated to a single value list
+	if start > 0:
+		output.write(",")
+	output.write(",".join(values))
+
+def _read_values_part(cube, start, end):
+	"""The value columns of the rows start:end"""
+	dims = cube.specification['dimensions']
+	value_i = [i for (i, d) in enumerate(dims) if 'categories' not in d]
+	columns = [[] for i in value_i]
+	for row in cube.rows(start, end):
+		for column, i in zip(columns, value_i):
+			column.append(row[i])
+	return columns
+
+def _write_binary(cube, parts, output):
+	"""Write the value columns of the parts as a binary cube file"""
+	spec = cube.specification
+	data = copy.copy(spec)
+	del data['length']
+	data['dimensions'] = [d for d in spec['dimensions']
+		if 'categories' in d]
+	data['value_dimensions'] = [copy.copy(d) for d in spec['dimensions']
+		if 'categories' not in d]
+	for dim in data['value_dimensions']:
+		dim['values'] = []
+	for columns in parts:
+		for dim, column in zip(data['value_dimensions'], columns):
+			dim['values'].extend(column)
+	binary.dump(pydatacube.pydatacube._DataCube(data), output)
+
+def export_partitioned(cube, output, connect=None, format='csv',
+		partitions=4, category_labels=False, release=_close):
+	"""
+	Export the rows of cube to the file-like output in parallel
+
+	Each partition is read in its own thread over a connection
+	given by connect(), which is given back with release(connection)
+	when the partition is done. A cube over a connection pool
+	doesn't need connect, as it checks out connections itself.
+	The partitions are spooled to temporary files and written
+	out in order.
+
+	The 'binary' format writes a pydatacube.binary cube file.
+	Its value blocks span all the rows, so the partitions are
+	read in parallel, but the values are gathered in memory
+	before writing.
+	"""
+	if format not in EXPORT_FORMATS:
+		raise ValueError("Unknown export format '%s'"%(format,))
+	if connect is None and not is_pool(cube._connection):
+		raise ValueError("Partitioned exports need a connection pool or connect()")
+
+	if format == 'jsonstat':
+		write_part = _write_jsonstat_part
+		ds = json.dumps(jsonstat._dataset_structure(cube))
+		output.write('{"dataset": %s, "value": ['%(ds[:-1],))
+	elif format == 'binary':
+		write_part = None
+	else:
+		write_part = _write_csv_part
+
+	# Load the shared metadata here, so that the partitions
+	# don't all race to do it.
+	ranges = partition_ranges(len(cube), partitions)
+	cube._preload(category_labels)
+
+	def run_part(run, start, end, *args):
+		if connect is None:
+			return run(cube, start, end, *args)
+		connection = connect()
+		try:
+			part_cube = cube._with_connection(connection)
+			return run(part_cube, start, end, *args)
+		finally:
+			release(connection)
+
+	def export_part((start, end)):
+		if write_part is None:
+			return run_part(_read_values_part, start, end)
+		part = tempfile.TemporaryFile()
+		run_part(write_part, start, end, part, category_labels)
+		part.seek(0)
+		return part
+
+	pool = ThreadPool(len(ranges))
+	try:
+		parts = pool.imap(export_part, ranges)
+		if write_part is None:
+			_write_binary(cube, parts, output)
+		else:
+			for part in parts:
+				shutil.copyfileobj(part, output)
+				part.close()
+	finally:
+		pool.terminate()
+
+	if format == 'jsonstat':
+		output.write(']}}')
@@ -0,0 +1,99 @@
+"""Connection pooling for pydatacube.sql
+
+The SqlDataCubes accept either a DB-API connection or a pool
+with the getconn/putconn interface of psycopg2.pool. With
+a pool, a connection is checked out for each operation, or for
+the life of a streaming iterator, so the cubes can be shared
+between threads.
+"""
+import contextlib
+import threading
+
+class ConnectionPool(object):
+	"""
+	A thread-safe pool of connections made with connect()
+
+	At most maxconn connections are checked out at a time,
+	further getconn() calls wait until one is put back.
+	"""
+	def __init__(self, connect, maxconn=None):
+		self._connect = connect
+		self.maxconn = maxconn
+		self._idle = []
+		self._n_out = 0
+		self._lock = threading.Condition()
+		self.closed = False
+
+	def getconn(self):
+		with self._lock:
+			while len(self._idle) == 0 and self.maxconn is not None \
+					and self._n_out >= self.maxconn:
+				self._lock.wait()
+			self._n_out += 1
+			if len(self._idle) > 0:
+				return self._idle.pop()
+		try:
+			return self._connect()
+		except:
+			self._release()
+			raise
+
+	def putconn(self, connection, close=False):
+		if close or self.closed:
+			connection.close()
+		else:
+			with self._lock:
+				self._idle.append(connection)
+		self._release()
+
+	def _release(self):
+		with self._lock:
+			self._n_out -= 1
+			self._lock.notify()
+
+	def closeall(self):
+		with self._lock:
+			self.closed = True
+			idle, self._idle = self._idle, []
+		for connection in idle:
+			connection.close()
+
+def is_pool(source):
+	return hasattr(source, 'getconn') and hasattr(source, 'putconn')
+
+@contextlib.contextmanager
+def checkout(source, commit=False):
+	"""
+	A connection of source for the duration of the block
+
+	Plain connections are used as they are, and the transactions
+	are left to the caller. Pooled connections are committed if
+	commit is set and rolled back otherwise, so they are put
+	back without an open transaction.
+	"""
+	if not is_pool(source):
+		yield source
+		return
+
+	connection = source.getconn()
+	try:
+		yield connection
+		if commit:
+			connection.commit()
+		else:
+			connection.rollback()
+	except:
+		connection.rollback()
+		raise
+	finally:
+		source.putconn(connection)
+
+@contextlib.contextmanager
+def cursor(source, commit=False):
+	"""A cursor of a checked out connection, closed after the block"""
+	with checkout(source, commit) as connection:
+		c = connection.cursor()
+		try:
+			yield c
+		finally:
+			c.close()
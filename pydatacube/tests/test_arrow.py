@@ -0,0 +1,74 @@
+import pytest
+from test_jsonstat import sample_cube
+from test_binary import numeric_cube, dump_and_load
+from testutils import *
+
+pa = pytest.importorskip('pyarrow')
+from pydatacube import arrow
+
+def test_to_arrow(sample_cube):
+	filtered = sample_filtering(sample_cube)
+	table = arrow.to_arrow(filtered)
+	assert table.num_rows == len(filtered)
+	columns = filtered.toColumns(collapse_unique=False)
+	for name in table.column_names:
+		assert table.column(name).to_pylist() == list(columns[name])
+	assert pa.types.is_dictionary(table.schema.field('A').type)
+
+def test_category_labels(sample_cube):
+	table = arrow.to_arrow(sample_cube, category_labels=True)
+	labels = sample_cube.toColumns(category_labels=True)
+	assert table.column('A').to_pylist() == list(labels['A'])
+
+def test_roundtrip(sample_cube):
+	for cube in [sample_cube, sample_filtering(sample_cube)]:
+		assert arrow.from_arrow(arrow.to_arrow(cube)) == cube
+
+def test_without_specification(sample_cube):
+	table = arrow.to_arrow(sample_cube).replace_schema_metadata(None)
+	cube = arrow.from_arrow(table)
+	assert cube.dimension_ids() == sample_cube.dimension_ids()
+	assert map(list, cube) == map(list, sample_cube)
+
+def test_mapped_values(tmpdir):
+	cube = numeric_cube()
+	loaded = dump_and_load(cube, tmpdir)
+	table = arrow.to_arrow(loaded)
+	assert table.column('value').to_pylist() == \
+		[1.5, None, 3.0, -4.25, 5.0, None]
+	assert table.column('count').to_pylist() == [1, 2, None, 4, 5, 6]
+	assert arrow.from_arrow(table) == cube
+
+def test_parquet(sample_cube, tmpdir):
+	pytest.importorskip('pyarrow.parquet')
+	import pyarrow.parquet as pq
+	path = str(tmpdir.join('cube.parquet'))
+	arrow.write_parquet(sample_cube, path)
+	assert pq.ParquetFile(path).num_row_groups == 3
+	assert arrow.read_parquet(path) == sample_cube
+
+def _reorder_rows(table, order):
+	arrays = []
+	for name in table.column_names:
+		column = table.column(name).chunk(0)
+		if pa.types.is_dictionary(column.type):
+			indices = column.indices.to_pylist()
+			arrays.append(pa.DictionaryArray.from_arrays(
+				pa.array([indices[i] for i in order], type=pa.int32()),
+				column.dictionary))
+		else:
+			values = column.to_pylist()
+			arrays.append(pa.array([values[i] for i in order]))
+	return pa.Table.from_arrays(arrays, names=table.column_names)\
+		.replace_schema_metadata(table.schema.metadata)
+
+def test_reordered_rows(sample_cube):
+	table = arrow.to_arrow(sample_cube, category_labels=True)
+	order = list(reversed(range(table.num_rows)))
+	assert arrow.from_arrow(_reorder_rows(table, order)) == sample_cube
+
+def test_duplicate_rows(sample_cube):
+	table = arrow.to_arrow(sample_cube)
+	order = [0] + range(table.num_rows - 1)
+	with pytest.raises(arrow.ArrowConversionError):
+		arrow.from_arrow(_reorder_rows(table, order))
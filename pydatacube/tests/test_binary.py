@@ -0,0 +1,81 @@
+import pytest
+from collections import OrderedDict
+from pydatacube import binary
+from pydatacube.pydatacube import _DataCube
+from test_jsonstat import sample_cube
+from testutils import *
+
+def numeric_cube():
+	data = OrderedDict()
+	data['metadata'] = {'label': 'Numbers'}
+	data['dimensions'] = [
+		dict(id='x', categories=[dict(id=str(i)) for i in range(3)]),
+		dict(id='y', categories=[dict(id='a', label='A'), dict(id='b')]),
+		]
+	data['value_dimensions'] = [
+		dict(id='value', values=[1.5, None, 3.0, -4.25, 5.0, None]),
+		dict(id='count', values=[1, 2, None, 4, 5, 6]),
+		]
+	return _DataCube(data)
+
+def dump_and_load(cube, tmpdir):
+	path = str(tmpdir.join('cube.bin'))
+	with open(path, 'wb') as output:
+		binary.dump(cube, output)
+	return binary.load(path)
+
+def test_roundtrip(sample_cube, tmpdir):
+	loaded = dump_and_load(sample_cube, tmpdir)
+	assert loaded == sample_cube
+	assert loaded.metadata == sample_cube.metadata
+	assert sample_filtering(loaded) == sample_filtering(sample_cube)
+	assert sample_filtering(loaded)._materialize() == \
+		sample_filtering(sample_cube)
+
+def test_numeric_values(tmpdir):
+	cube = numeric_cube()
+	loaded = dump_and_load(cube, tmpdir)
+	assert loaded == cube
+	values = loaded._data['value_dimensions']
+	assert list(values[0]['values']) == [1.5, None, 3.0, -4.25, 5.0, None]
+	assert values[1]['values'][2] is None
+	assert values[1]['values'][-1] == 6
+	assert values[1]['values'][1:4] == [2, None, 4]
+	assert loaded.toColumns()['count'] == cube.toColumns()['count']
+
+def test_mixed_values(tmpdir):
+	data = numeric_cube()._data
+	data['value_dimensions'] = [
+		dict(id='value', values=[1.5, u'..', None, 2, u'\xe4', 3.0]),
+		dict(id='count', values=[1, 2, None, 4.5, 5, 6]),
+		]
+	cube = _DataCube(data)
+	loaded = dump_and_load(cube, tmpdir)
+	assert loaded == cube
+	for loaded_dim, dim in zip(loaded._data['value_dimensions'],
+			data['value_dimensions']):
+		assert map(type, loaded_dim['values']) == map(type, dim['values'])
+		assert list(loaded_dim['values']) == dim['values']
+	assert loaded._data['value_dimensions'][1]['values'][1:4] == [2, None, 4.5]
+
+def test_missing_values(tmpdir):
+	values = [None if i%7 == 0 or 100 < i < 120 else i for i in range(1000)]
+	data = numeric_cube()._data
+	data['dimensions'] = [dict(id='x',
+		categories=[dict(id=str(i)) for i in range(len(values))])]
+	data['value_dimensions'] = [dict(id='value', values=values)]
+	loaded = dump_and_load(_DataCube(data), tmpdir)
+	loaded_values = loaded._data['value_dimensions'][0]['values']
+	assert list(loaded_values) == values
+	assert loaded_values[95:130] == values[95:130]
+	assert loaded_values[-1] == values[-1]
+
+def test_filtered_dump(sample_cube, tmpdir):
+	filtered = sample_filtering(sample_cube)
+	assert dump_and_load(filtered, tmpdir) == filtered
+
+def test_not_a_cube_file(tmpdir):
+	path = tmpdir.join('other.bin')
+	path.write('something else')
+	with pytest.raises(binary.BinaryFormatException):
+		binary.load(str(path))
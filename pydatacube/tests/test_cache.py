@@ -0,0 +1,69 @@
+import sys
+from pydatacube.pydatacube import ResultCache
+from pydatacube import jsonstat
+from test_jsonstat import sample_cube
+from testutils import *
+
+def test_cached_results(sample_cube):
+	cache = ResultCache()
+	cube = sample_cube.cached(cache)
+	columns = sample_filtering(cube).toColumns()
+	assert columns == sample_filtering(sample_cube).toColumns()
+	assert sample_filtering(cube).toColumns() is columns
+	assert cache.stats()['hits'] == 1
+	assert cache.stats()['misses'] == 1
+	
+	# Different parameters and filters are different results
+	sample_filtering(cube).toColumns(category_labels=True)
+	sample_filtering(cube, cat_i=0).toColumns()
+	assert cache.misses == 3
+	
+	# The filters are normalized
+	a, b, c = [cat['id'] for cat in
+		sample_cube.specification['dimensions'][0]['categories']]
+	cube.filter(A=[a, b]).toColumns()
+	cube.filter(A=[b, a]).toColumns()
+	assert cache.hits == 2
+
+def test_cached_jsonstat(sample_cube):
+	cube = sample_filtering(sample_cube.cached())
+	js = jsonstat.to_jsonstat(cube)
+	assert jsonstat.to_jsonstat(cube) == js
+	assert cube._result_cache.hits == 1
+	assert js == jsonstat.to_jsonstat(sample_filtering(sample_cube))
+
+def test_eviction(sample_cube):
+	cube = sample_cube.cached(ResultCache())
+	cube.toColumns()
+	one = cube._result_cache.stats()['bytes']
+	cache = ResultCache(max_bytes=int(one*1.5))
+	cube = sample_cube.cached(cache)
+	cube.toColumns()
+	cube.toColumns(category_labels=True)
+	assert cache.evictions == 1
+	assert cache.stats()['entries'] == 1
+	assert cache.stats()['bytes'] <= cache.max_bytes
+	cube.toColumns(category_labels=True)
+	assert cache.hits == 1
+	
+	# Too large results aren't cached at all
+	cache = ResultCache(max_bytes=10)
+	sample_cube.cached(cache).toColumns()
+	assert cache.stats()['entries'] == 0
+
+def test_stored_values_not_cached(sample_cube):
+	cache = ResultCache()
+	cube = sample_cube.cached(cache)
+	values = cube._value_dimension_values()
+	assert values is sample_cube._data['value_dimensions'][0]['values']
+	assert cache.stats()['entries'] == 0
+	sample_filtering(cube)._value_dimension_values()
+	assert cache.stats()['entries'] == 1
+
+def test_sampled_size_estimate():
+	cache = ResultCache()
+	values = [float(i) for i in range(100000)]
+	cache.get('values', lambda: values)
+	size = cache.stats()['bytes']
+	exact = sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values)
+	assert exact*0.9 < size < exact*1.1
@@ -0,0 +1,57 @@
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube import jsonstat
+from pydatacube.pydatacube import concat, DataCubeException
+
+def split(cube, dim_i, at):
+	dim = cube.specification['dimensions'][dim_i]
+	cat_ids = [c['id'] for c in dim['categories']]
+	return (cube.filter(**{dim['id']: cat_ids[:at]}),
+		cube.filter(**{dim['id']: cat_ids[at:]}))
+
+@pytest.mark.parametrize('dim_i', [0, 1, 2])
+def test_concat(sample_cube, dim_i):
+	along = sample_cube.dimension_ids()[dim_i]
+	head, tail = split(sample_cube, dim_i, 1)
+	cube = concat([head, tail], along)
+	assert cube == sample_cube
+	assert jsonstat.to_jsonstat(cube) == jsonstat.to_jsonstat(sample_cube)
+
+def test_concat_validation(sample_cube):
+	a, b = sample_cube.dimension_ids()[:2]
+	head, tail = split(sample_cube, 0, 1)
+	with pytest.raises(DataCubeException):
+		concat([head, head], a)
+	with pytest.raises(DataCubeException):
+		concat([head, sample_filtering(tail)], a)
+	with pytest.raises(DataCubeException):
+		concat([head, tail], 'nonexistent')
+
+def test_append_categories(sample_cube):
+	a = sample_cube.dimension_ids()[0]
+	head, tail = split(sample_cube, 0, 1)
+	tail_cats = tail.specification['dimensions'][0]['categories']
+	tail_values = tail._value_dimension_values()
+
+	middle = head.append_categories(a, tail_cats[:1],
+		tail_values[:len(tail_values)//2])
+	cube = middle.append_categories(a, tail_cats[1:],
+		tail_values[len(tail_values)//2:])
+	assert cube == sample_cube
+	# The appends share the values without changing the earlier cubes
+	values = lambda c: c._data['value_dimensions'][0]['values']
+	assert values(cube)._values is values(middle)._values
+	assert len(values(middle)) < len(values(cube))
+	assert head == split(sample_cube, 0, 1)[0]
+
+	# Appending to an earlier cube doesn't clobber the later ones
+	head2 = middle.append_categories(a, tail_cats[1:],
+		[None]*(len(tail_values) - len(tail_values)//2))
+	assert len(values(head2)) == len(values(cube))
+	assert values(head2)._values is not values(cube)._values
+	assert cube == sample_cube
+	assert list(list(head2)[-1])[-1] is None
+
+	with pytest.raises(DataCubeException):
+		head.append_categories(a, tail_cats[:1], [1, 2])
@@ -0,0 +1,134 @@
+import sqlite3
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.delta import diff, DeltaException
+from pydatacube.sql import SqlDataCube, initialize_schema
+from test_sql import CountingConnection
+
+@pytest.fixture
+def versions(sample_cube):
+	a = sample_cube.dimension_ids()[0]
+	old = sample_cube.filter(**{a: categories(sample_cube, 0)[:2]})
+	old = with_values(old._materialize(), lambda i, v: i)
+	# One new period, one changed cell and one new label
+	new = with_values(old, lambda i, v: -1 if i == 3 else v)
+	new = new.append_categories(a, ['new'], range(100, 100 +
+		len(new)//2))
+	new._data['dimensions'][1] = dict(new._data['dimensions'][1])
+	new._data['dimensions'][1]['categories'] = [dict(c, label='relabeled')
+		if i == 0 else c for (i, c) in
+		enumerate(new._data['dimensions'][1]['categories'])]
+	return old, type(new)(new._data)
+
+def test_diff(versions):
+	old, new = versions
+	a, b = old.dimension_ids()[:2]
+	delta = diff(old, new)
+	assert not delta.is_empty()
+	assert delta.added_categories == {a: [{'id': 'new'}]}
+	assert delta.removed_categories == {}
+	assert delta.relabeled_categories.keys() == [b]
+	assert len(delta.changed_cells) == 1
+	cat_ids, values = delta.changed_cells[0]
+	assert values == (-1,)
+	assert list(list(new.filter(**dict(zip(old.dimension_ids(),
+		cat_ids))))[0])[-1] == -1
+	added = list(delta.added_cells())
+	assert len(added) == len(new) - len(old)
+	assert all(ids[0] == 'new' for (ids, values) in added)
+	assert delta.keeps_row_numbers()
+
+	assert diff(old, old).is_empty()
+	# Only the cells in both are compared
+	delta = diff(new, old)
+	assert delta.removed_categories == {a: ['new']}
+	assert len(delta.changed_cells) == 1
+	with pytest.raises(DeltaException):
+		diff(old, old.transpose(b))
+
+def test_diff_not_keeping_rows(versions):
+	old, new = versions
+	c = old.dimension_ids()[2]
+	smaller = new.filter(**{c: categories(new, 2)[1:]})
+	delta = diff(old, smaller)
+	assert delta.removed_categories == {c: [categories(new, 2)[0]]}
+	assert not delta.keeps_row_numbers()
+
+@pytest.mark.parametrize('layout', ['rows', 'dense'])
+def test_apply_delta(versions, layout):
+	old, new = versions
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'versions', old,
+		layout=layout, chunk_size=5)
+	list(cube)
+	del connection.queries[:]
+	cube.apply_delta(diff(old, new))
+	assert not any('DROP' in q or 'CREATE' in q for q in connection.queries)
+	assert cube.specification == new.specification
+	assert map(list, cube) == map(list, new)
+	a = new.dimension_ids()[0]
+	assert map(list, cube.filter(**{a: 'new'})) == \
+		map(list, new.filter(**{a: 'new'}))
+
+	# Back to the old version, and to one needing a reload
+	cube.apply_delta(diff(new, old))
+	assert map(list, cube) == map(list, old)
+	c = old.dimension_ids()[2]
+	smaller = old.filter(**{c: categories(old, 2)[1:]})
+	cube.apply_delta(diff(old, smaller))
+	assert map(list, cube) == map(list, smaller)
+	with pytest.raises(ValueError):
+		cube.apply_delta(diff(old, new))
+
+def test_added_category_index(versions):
+	old, new = versions
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'versions', old)
+	cube.apply_delta(diff(old, new))
+	a = new.dimension_ids()[0]
+	c = connection.cursor()
+	c.execute("""SELECT c.name FROM _dimension_categories d
+		JOIN _categories c ON c.surrogate=d.category_surrogate
+		WHERE d.dataset_id='versions' AND d.dimension_id=?
+		ORDER BY d.category_index""", [a])
+	assert [r[0] for r in c.fetchall()] == categories(new, 0)
+	maps = SqlDataCube(connection, 'versions')._surrogate_maps()
+	c.execute("SELECT surrogate, name FROM _categories")
+	names = dict(c.fetchall())
+	assert all(names[s] == cat_id for (cat_id, s) in maps[a].iteritems())
+
+	# Reloads go through a shadow table
+	table_name = cube._get_table_name()
+	smaller = new.filter(**{a: categories(new, 0)[1:]})
+	del connection.queries[:]
+	cube.apply_delta(diff(new, smaller))
+	assert any('RENAME' in q for q in connection.queries)
+	assert cube._get_table_name() == table_name
+	assert map(list, cube) == map(list, smaller)
+
+def test_diff_text_values(sample_cube):
+	old = with_values(sample_cube, lambda i, v: None if i == 1 else str(i))
+	new = with_values(old, lambda i, v: '0.0' if i == 0 else v)
+	delta = diff(old, new)
+	assert [values for (ids, values) in delta.changed_cells] == [('0.0',)]
+
+def test_apply_delta_value_kinds(versions):
+	old, new = versions
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'versions', old)
+	# Integers to floats, and to text
+	floats = with_values(old, lambda i, v: 3.5 if i == 0 else v)
+	del connection.queries[:]
+	cube.apply_delta(diff(old, floats))
+	assert any('RENAME' in q for q in connection.queries)
+	assert map(list, cube) == map(list, floats)
+	
+	text = with_values(floats, lambda i, v: 'text' if i == 0 else v)
+	del connection.queries[:]
+	cube.apply_delta(diff(floats, text))
+	assert any('RENAME' in q for q in connection.queries)
+	assert list(list(cube)[0])[-1] == 'text'
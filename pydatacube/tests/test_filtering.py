@@ -37,3 +37,25 @@ def test_materialization(sample_cube):
 	assert orig_data == sample_cube._data
 	assert orig_items == map(list, sample_cube)
 	
+
+def test_specification_is_memoized(sample_cube):
+	assert sample_cube.specification is sample_cube.specification
+	filtered = sample_filtering(sample_cube)
+	assert filtered.specification is sample_filtering(sample_cube).specification
+
+def test_filtered_specification_shares_dimensions(sample_cube):
+	spec = sample_cube.specification
+	filtered = sample_filtering(sample_cube, 1, 1).specification
+	assert filtered['length'] == len(sample_filtering(sample_cube))
+	for i, (dim, fdim) in enumerate(zip(spec['dimensions'], filtered['dimensions'])):
+		if i == 1:
+			assert fdim['categories'] == [dim['categories'][1]]
+		else:
+			assert fdim is dim
+
+def test_specification_cache_is_bounded(sample_cube):
+	spec_cache = sample_cube._spec_cache
+	for group in sample_cube.group_for(sample_cube.dimension_ids()[-1]):
+		group.specification
+	assert 0 < len(spec_cache._specs) <= spec_cache.max_entries
+	assert sample_cube.specification is sample_cube.specification
@@ -1,6 +1,7 @@
 import pytest
 
 from test_jsonstat import sample_cube
+from testutils import with_values
 
 def test_group_for_vs_group_by(sample_cube):
 	all_cols = sample_cube.dimension_ids()
@@ -25,3 +26,15 @@ def test_no_value_grouping(sample_cube):
 		list(sample_cube.group_by(*value_cols))
 	with pytest.raises(NotImplementedError):
 		list(sample_cube.group_for(*nonvalue_cols))
+
+def test_aggregate(sample_cube):
+	cube = with_values(sample_cube, lambda i, v: i)
+	group_cols = cube.dimension_ids()[:1]
+	sums = cube.aggregate(group_cols)
+	assert sums.dimension_ids() == group_cols + ['value']
+	groups = list(cube.group_by(*group_cols))
+	expected = [sum(map(float, g._value_columns()[0])) for g in groups]
+	assert sums._value_columns()[0] == expected
+	counts = cube.aggregate(group_cols, 'count')
+	assert counts._value_columns()[0] == [len(g) for g in groups]
+	assert cube.aggregate([], 'max')._value_columns()[0] == [len(cube) - 1]
@@ -0,0 +1,88 @@
+import logging
+import socket
+import sqlite3
+import pytest
+from test_jsonstat import sample_cube, jsonstat_sample_dataset
+from testutils import *
+from pydatacube import metrics, jsonstat
+from pydatacube.pcaxis import px_reader
+from pydatacube.sql import SqlDataCube, initialize_schema
+
+@pytest.fixture
+def stats(request):
+	stats = metrics.StatsSink()
+	metrics.enable(stats)
+	request.addfinalizer(metrics.disable)
+	return stats
+
+def test_cube_metrics(stats, sample_cube):
+	cube = jsonstat.to_cube(jsonstat_sample_dataset())
+	rows = list(sample_filtering(cube))
+	cube.toColumns()
+	result = stats.stats()
+	assert set(['jsonstat.to_cube', 'cube.filter', 'cube.iter',
+		'cube.to_columns']) <= set(result['timings'])
+	# toColumns iterates the rows too
+	assert result['counts']['cube.iter.rows'] == len(rows) + len(cube)
+	assert result['timings']['cube.filter']['count'] == 1
+
+def test_sql_metrics(stats, sample_cube):
+	events = []
+	class Recorder(object):
+		def emit(self, *event):
+			events.append(event)
+	metrics.enable(Recorder())
+	connection = sqlite3.connect(':memory:')
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	del events[:]
+	rows = list(sample_filtering(cube))
+	queries = [fields for (kind, name, value, fields) in events
+		if name == 'sql.query']
+	assert any('_row_number' in q['query'] and q['rows'] == len(rows)
+		for q in queries)
+	assert stats.stats()['counts']['sql.rows.rows'] == len(rows)
+
+def test_disabled(sample_cube):
+	stats = metrics.StatsSink()
+	metrics.enable(stats)
+	metrics.disable()
+	assert not metrics.registry.enabled
+	list(sample_cube)
+	assert stats.stats() == dict(timings={}, counts={})
+	rows = iter([1, 2])
+	assert metrics.timed_iter('rows', rows) is rows
+
+def test_statsd_sink(request):
+	server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	server.bind(('127.0.0.1', 0))
+	server.settimeout(5)
+	request.addfinalizer(server.close)
+	sink = metrics.StatsdSink(port=server.getsockname()[1])
+	metrics.enable(sink)
+	request.addfinalizer(metrics.disable)
+	metrics.registry.increment('test.count', 3)
+	metrics.registry.timing('test.time', 0.25)
+	assert server.recv(1024) == 'pydatacube.test.count:3|c'
+	assert server.recv(1024) == 'pydatacube.test.time:250.000|ms'
+	sink.close()
+
+def test_logging_sink(request):
+	records = []
+	class Handler(logging.Handler):
+		def emit(self, record):
+			records.append(record.getMessage())
+	logger = logging.getLogger('pydatacube.test_metrics')
+	logger.setLevel(logging.DEBUG)
+	logger.addHandler(Handler())
+	metrics.enable(metrics.LoggingSink(logger))
+	request.addfinalizer(metrics.disable)
+	with metrics.registry.timer('test.block', query='SELECT 1') as fields:
+		fields['rows'] = 1
+	assert len(records) == 1
+	assert records[0].startswith('timing test.block ')
+	assert "query='SELECT 1' rows=1" in records[0]
+
+def test_px_logger_has_no_output_handler():
+	log = px_reader.get_logger()
+	assert not any(isinstance(h, logging.StreamHandler) for h in log.handlers)
@@ -0,0 +1,52 @@
+import pytest
+from test_jsonstat import sample_cube
+from test_binary import numeric_cube, dump_and_load
+from testutils import *
+
+np = pytest.importorskip('numpy')
+
+def test_to_numpy(sample_cube):
+	array = sample_cube.to_numpy()
+	assert array.shape == (3, 2, 4)
+	assert list(array.reshape(-1)) == list(sample_cube._value_dimension_values())
+	filtered = sample_filtering(sample_cube)
+	array = filtered.to_numpy()
+	assert array.shape == (3, 1, 4)
+	assert list(array.reshape(-1)) == list(filtered._value_dimension_values())
+
+def test_numeric_values(tmpdir):
+	cube = numeric_cube()
+	values = cube.to_numpy('value')
+	assert values.dtype == float
+	assert np.isnan(values[0, 1])
+	assert values[1, 1] == -4.25
+	
+	loaded = dump_and_load(cube, tmpdir)
+	assert np.array_equal(np.isnan(loaded.to_numpy('value')), np.isnan(values))
+	counts = loaded.to_numpy('count')
+	assert np.isnan(counts[1, 0])
+	assert list(loaded.filter(y='a').to_numpy('value').reshape(-1)) == [1.5, 3.0, 5.0]
+
+def test_views(tmpdir):
+	data = numeric_cube()._data
+	data['value_dimensions'] = [dict(id='value', values=np.arange(6.0))]
+	cube = numeric_cube().__class__(data)
+	assert np.shares_memory(cube.to_numpy(), data['value_dimensions'][0]['values'])
+	
+	data['value_dimensions'][0]['values'] = range(6)
+	loaded = dump_and_load(cube.__class__(data), tmpdir)
+	mapped = loaded._data['value_dimensions'][0]['values']
+	assert np.shares_memory(loaded.to_numpy(), mapped._ndarray())
+
+def test_to_dataframe(sample_cube):
+	pytest.importorskip('pandas')
+	filtered = sample_filtering(sample_cube)
+	df = filtered.to_dataframe()
+	assert df.index.names == filtered.dimension_ids()[:-1]
+	assert list(df['value']) == list(filtered._value_dimension_values())
+	assert list(df.index[0]) == list(filtered.toTable())[0][:-1]
+	
+	df = filtered.to_dataframe(category_labels=True, index=False)
+	expected = filtered.toColumns(category_labels=True, collapse_unique=False)
+	for name in df.columns:
+		assert list(df[name]) == list(expected[name])
@@ -0,0 +1,59 @@
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.pydatacube import DataCubeException
+
+@pytest.fixture
+def number_cube(sample_cube):
+	return with_values(sample_cube, lambda i, v: i)
+
+def test_query_rows(number_cube):
+	a, b, c = number_cube.dimension_ids()[:3]
+	query = number_cube.query()
+	assert map(list, query) == map(list, number_cube)
+
+	b_cats = categories(number_cube, 1)[:2]
+	filtered = number_cube.filter(**{b: b_cats})
+	query = query.filter(**{b: b_cats})
+	assert map(list, query.rows()) == map(list, filtered)
+	assert map(list, query.rows(category_labels=True)) == \
+		map(list, filtered.toTable(labels=True))
+	assert map(list, query.page(3, 9)) == map(list, filtered)[3:9]
+	# Pages are relative to the previous ones
+	assert map(list, query.page(3, 9).page(1, 100)) == \
+		map(list, filtered)[4:9]
+
+	columns = query.select(c, a).page(2, 4).columns()
+	assert columns.keys() == [c, a]
+	assert zip(columns[c], columns[a]) == \
+		[(row[2], row[0]) for row in map(list, filtered)[2:4]]
+
+def test_query_filters_intersect(number_cube):
+	b = number_cube.dimension_ids()[1]
+	b_cats = categories(number_cube, 1)
+	query = number_cube.query().filter(**{b: b_cats[:2]}).filter(
+		**{b: b_cats[1:]})
+	expected = number_cube.filter(**{b: b_cats[1:2]})
+	assert map(list, query) == map(list, expected)
+
+def test_query_aggregate(number_cube):
+	a, b = number_cube.dimension_ids()[:2]
+	b_cats = categories(number_cube, 1)[:2]
+	filtered = number_cube.filter(**{b: b_cats})
+	for function in ('sum', 'count', 'max'):
+		expected = map(list, filtered.aggregate([a, b], function))
+		query = number_cube.query().filter(**{b: b_cats}).aggregate(
+			[b, a], function)
+		assert map(list, query) == expected
+		assert map(list, query.page(1, 4)) == expected[1:4]
+
+	query = number_cube.query().aggregate([b], 'sum')
+	assert query.select(b).columns().keys() == [b]
+	with pytest.raises(DataCubeException):
+		query.filter(**{a: categories(number_cube, 0)[0]})
+	with pytest.raises(DataCubeException):
+		query.aggregate([b])
+	with pytest.raises(ValueError):
+		number_cube.query().aggregate([b], 'median')
+	with pytest.raises(DataCubeException):
+		list(query.select(a).rows())
@@ -0,0 +1,478 @@
+import sqlite3
+import sys
+import StringIO
+import csv
+import pytest
+import pydatacube
+from pydatacube.delta import diff
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.sql import SqlDataCube, MetadataCache, ResultCache, \
+	initialize_schema, get_metadata_cache, _DenseChunks
+
+@pytest.fixture
+def connection():
+	connection = sqlite3.connect(':memory:')
+	initialize_schema(connection)
+	return connection
+
+@pytest.fixture(params=['rows', 'dense'])
+def sql_cube(request, connection, sample_cube):
+	return SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout=request.param, chunk_size=5)
+
+def test_from_cube(sql_cube, sample_cube):
+	assert len(sql_cube) == len(sample_cube)
+	assert map(list, sql_cube) == map(list, sample_cube)
+	assert sql_cube.specification == sample_cube.specification
+
+def test_filtered_rows(sql_cube, sample_cube):
+	filtered = sample_filtering(sample_cube)
+	sql_filtered = sample_filtering(sql_cube)
+	assert len(sql_filtered) == len(filtered)
+	assert map(list, sql_filtered) == map(list, filtered)
+
+def test_row_range(sql_cube, sample_cube):
+	assert map(list, sql_cube.rows(3, 7)) == map(list, sample_cube)[3:7]
+	assert map(list, sql_cube.rows(20)) == map(list, sample_cube)[20:]
+
+def test_filtered_row_range(sql_cube, sample_cube):
+	expected = map(list, sample_filtering(sample_cube))
+	filtered = sample_filtering(sql_cube)
+	for start, end in [(0, 3), (2, 7), (5, None), (11, 20), (30, None)]:
+		assert map(list, filtered.rows(start, end)) == expected[start:end]
+	assert map(list, filtered[2:7]) == expected[2:7]
+	assert list(filtered[-1]) == expected[-1]
+
+def test_row_queries_avoid_offset(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	del connection.queries[:]
+	list(sample_filtering(cube).rows(3, 6))
+	list(cube.rows(3, 6))
+	assert not any('OFFSET' in q for q in connection.queries)
+
+def test_page(sql_cube, sample_cube):
+	for cube, expected in [(sql_cube, sample_cube),
+			(sample_filtering(sql_cube), sample_filtering(sample_cube))]:
+		rows = []
+		token = None
+		while True:
+			page, token = cube.page(5, token)
+			assert len(page) <= 5
+			rows.extend(map(list, page))
+			if token is None:
+				break
+		assert rows == map(list, expected)
+
+def test_category_labels(sql_cube, sample_cube):
+	labels = map(list, sample_cube.toTable(labels=True))
+	assert map(list, sql_cube.rows(category_labels=True)) == labels
+
+def test_rows_decoded_on_client(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = sample_filtering(
+		SqlDataCube.FromCube(connection, 'order_cube', sample_cube))
+	list(cube.rows())
+	del connection.queries[:]
+	labels = map(list, sample_filtering(sample_cube).toTable(labels=True))
+	assert map(list, cube.rows(category_labels=True)) == labels
+	assert cube.page(3, category_labels=True)[0] == map(tuple, labels[:3])
+	assert not any('_categories' in q for q in connection.queries)
+
+@pytest.mark.parametrize('labels', [False, True])
+def test_to_columns(sql_cube, sample_cube, labels):
+	filtered = sample_filtering(sample_cube)
+	expected = filtered.toColumns(category_labels=labels)
+	columns = sample_filtering(sql_cube).toColumns(category_labels=labels)
+	assert set(columns.keys()) == set(expected.keys())
+	for key, values in expected.iteritems():
+		if isinstance(values, tuple):
+			values = list(values)
+		assert columns[key] == values
+
+def test_materialize(sql_cube, sample_cube):
+	filtered = sample_filtering(sample_cube)
+	assert sample_filtering(sql_cube)._materialize() == filtered
+
+def test_group_by(sql_cube, sample_cube):
+	group_cols = sample_cube.dimension_ids()[:2]
+	groups = sql_cube.group_by(*group_cols)
+	expected = list(sample_cube.group_by(*group_cols))
+	assert len(groups) == len(expected)
+	for group, expected_group in zip(groups, expected):
+		assert map(list, group) == map(list, expected_group)
+
+def test_dump_csv(sql_cube, sample_cube):
+	output = StringIO.StringIO()
+	sql_cube.dump_csv(output)
+	output.seek(0)
+	assert list(csv.reader(output)) == map(list, sample_cube)
+
+def test_replace_and_remove(connection, sql_cube, sample_cube):
+	filtered = sample_filtering(sample_cube)
+	replaced = SqlDataCube.FromCube(connection, 'order_cube', filtered,
+		replace=True)
+	assert map(list, replaced) == map(list, filtered)
+	refiltered = sample_filtering(filtered, 0, 1)
+	assert map(list, sample_filtering(replaced, 0, 1)) == map(list, refiltered)
+	SqlDataCube.Remove(connection, 'order_cube')
+	assert not SqlDataCube.Exists(connection, 'order_cube')
+	c = connection.cursor()
+	c.execute("SELECT COUNT(*) FROM _categories")
+	assert c.fetchone()[0] == 0
+
+def test_schema_migration(sample_cube):
+	connection = sqlite3.connect(':memory:')
+	# The _datasets table of the earlier versions
+	connection.execute("""
+		CREATE TABLE _datasets (
+			id VARCHAR(255) PRIMARY KEY,
+			table_name VARCHAR(50) NOT NULL,
+			specification TEXT NOT NULL,
+			cube_value_column VARCHAR(50)
+			)""")
+	connection.execute("""INSERT INTO _datasets VALUES
+		('old', 'old', '{}', 'value')""")
+	initialize_schema(connection)
+	initialize_schema(connection)
+	c = connection.cursor()
+	c.execute("SELECT layout, chunk_size FROM _datasets WHERE id='old'")
+	assert c.fetchall() == [('rows', None)]
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout='dense')
+	opened = SqlDataCube.Open(connection, 'order_cube')
+	assert type(opened) is type(cube)
+	assert map(list, opened) == map(list, sample_cube)
+
+def test_one_based_row_numbers(connection, sample_cube):
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	# Renumber as the serial column of the first version
+	table_name = cube._get_table_name()
+	connection.execute("UPDATE %s SET _row_number=_row_number + 100000"%(
+		table_name))
+	connection.execute("UPDATE %s SET _row_number=_row_number - 99999"%(
+		table_name))
+	connection.execute("UPDATE _datasets SET row_number_base=1")
+	get_metadata_cache(connection).invalidate('order_cube')
+	cube = SqlDataCube(connection, 'order_cube')
+	expected = map(list, sample_cube)
+	assert map(list, cube.rows(3, 7)) == expected[3:7]
+	assert map(list, cube.rows(20)) == expected[20:]
+	filtered = map(list, sample_filtering(sample_cube))
+	assert map(list, sample_filtering(cube).rows(2, 7)) == filtered[2:7]
+	
+	changed = with_values(sample_cube, lambda i, v: unicode(i))
+	cube.apply_delta(diff(sample_cube, changed))
+	assert map(list, cube) == map(list, changed)
+
+def test_unknown_category_filter(sql_cube):
+	dim_id = sql_cube.dimension_ids()[0]
+	assert list(sql_cube.filter(**{dim_id: 'nonexistent'})) == []
+
+def test_open(connection, sql_cube):
+	assert type(SqlDataCube.Open(connection, 'order_cube')) is type(sql_cube)
+
+def test_dense_fetches_only_needed_chunks(connection, sample_cube):
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout='dense', chunk_size=4)
+	dim = sample_cube.specification['dimensions'][0]
+	filtered = cube.filter(**{dim['id']: dim['categories'][0]['id']})
+	expected = sample_cube.filter(**{dim['id']: dim['categories'][0]['id']})
+	assert map(list, filtered) == map(list, expected)
+	chunks = filtered._base()[1]._chunks
+	assert sorted(chunks) == range(len(expected)//4)
+
+def test_dense_deep_rows(sample_cube, monkeypatch):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout='dense', chunk_size=1)
+	cube._preload()
+	del connection.queries[:]
+	assert list(cube.rows(20, 23)) == map(tuple, sample_cube)[20:23]
+	assert len(connection.queries) == 1
+	
+	monkeypatch.setattr(_DenseChunks, 'MAX_CHUNKS', 4)
+	list(cube.rows(0, 10))
+	list(cube.rows(10, 12))
+	assert len(cube._base()[1]._chunks) == 4
+
+class CountingCursor(sqlite3.Cursor):
+	def execute(self, query, args=()):
+		self.connection.queries.append(query)
+		return sqlite3.Cursor.execute(self, query, args)
+	
+	def executemany(self, query, rows):
+		self.connection.queries.append(query)
+		return sqlite3.Cursor.executemany(self, query, rows)
+
+class CountingConnection(sqlite3.Connection):
+	"""Records the queries run through the connection"""
+	def __init__(self, *args, **kwargs):
+		sqlite3.Connection.__init__(self, *args, **kwargs)
+		self.queries = []
+	
+	def cursor(self):
+		return sqlite3.Connection.cursor(self, CountingCursor)
+
+def test_bulk_category_load(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	dims = [d for d in sample_cube.specification['dimensions']
+		if 'categories' in d]
+	# One insert per dimension to _categories and _dimension_categories
+	# instead of one per category
+	inserts = [q for q in connection.queries
+		if 'INSERT' in q and '_categories' in q]
+	assert len(inserts) == 2*len(dims)
+	c = connection.cursor()
+	c.execute("SELECT name, label FROM _categories ORDER BY surrogate")
+	assert c.fetchall() == [(cat['id'], cat.get('label'))
+		for d in dims for cat in d['categories']]
+	assert map(list, cube.rows(category_labels=True)) == \
+		map(list, sample_cube.toTable(labels=True))
+
+def test_metadata_cache(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cache = MetadataCache()
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		metadata_cache=cache)
+	cube._surrogate_maps()
+	del connection.queries[:]
+	group_cols = sample_cube.dimension_ids()[:2]
+	for group in cube.group_by(*group_cols):
+		group.specification
+		group._materialize()
+	assert len(connection.queries) > 0
+	assert not any('_datasets' in q or '_dimension_categories' in q
+		for q in connection.queries)
+	
+	SqlDataCube.FromCube(connection, 'order_cube',
+		sample_filtering(sample_cube), replace=True,
+		metadata_cache=cache)
+	assert len(cube) == len(sample_filtering(sample_cube))
+
+def test_fetch_groups(sql_cube, sample_cube):
+	group_cols = sample_cube.dimension_ids()[:2]
+	groups = sql_cube.fetch_groups(*group_cols)
+	expected = list(sample_cube.group_by(*group_cols))
+	assert len(groups) == len(expected)
+	groups = list(groups)
+	assert len(groups) == len(expected)
+	for group, expected_group in zip(groups, expected):
+		assert group == expected_group
+
+def test_aggregate(connection, sample_cube):
+	cube = with_values(sample_cube, lambda i, v: i)
+	group_cols = cube.dimension_ids()[1:2]
+	for layout in ('rows', 'dense'):
+		sql_cube = SqlDataCube.FromCube(connection, 'numbers', cube,
+			replace=True, layout=layout)
+		for function in ('sum', 'avg', 'count', 'min', 'max'):
+			expected = sample_filtering(cube, 0, 1).aggregate(group_cols, function)
+			result = sample_filtering(sql_cube, 0, 1).aggregate(group_cols, function)
+			assert result._value_columns() == expected._value_columns()
+			assert result.specification == expected.specification
+
+def test_numeric_values(connection, sample_cube):
+	cube = with_values(sample_cube, lambda i, v: i*0.5 if i%3 else None)
+	rows = SqlDataCube.FromCube(connection, 'rows', cube)
+	dense = SqlDataCube.FromCube(connection, 'dense', cube, layout='dense')
+	assert map(list, rows) == map(list, dense) == map(list, cube)
+	assert rows._materialize() == dense._materialize() == cube
+
+def test_filter_many_categories(connection):
+	n = 2000
+	data = dict(metadata={},
+		dimensions=[dict(id='x', categories=[dict(id=str(i))
+			for i in range(n)])],
+		value_dimensions=[dict(id='value', values=range(n))])
+	cube = SqlDataCube.FromCube(connection, 'large',
+		pydatacube.pydatacube._DataCube(data))
+	cat_ids = [str(i) for i in range(0, n, 2)]
+	assert [list(r)[1] for r in cube.filter(x=cat_ids)] == range(0, n, 2)
+
+def test_batched_streaming(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cache = MetadataCache()
+	SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		metadata_cache=cache)
+	cube = SqlDataCube(connection, 'order_cube', metadata_cache=cache,
+		itersize=5)
+	filtered = sample_filtering(cube)
+	assert filtered.itersize == 5
+	assert map(list, filtered) == map(list, sample_filtering(sample_cube))
+	assert filtered._materialize() == sample_filtering(sample_cube)
+	
+	del connection.queries[:]
+	assert len(filtered) == len(sample_filtering(sample_cube))
+	assert len(filtered.rows(2, 100)) == len(filtered) - 2
+	assert connection.queries == []
+
+def test_streamed_column_pages(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	cube = sample_filtering(SqlDataCube(connection, 'order_cube', itersize=4))
+	expected = sample_filtering(sample_cube).toColumns(3, 10)
+	del connection.queries[:]
+	columns = cube.toColumns(3, 10)
+	assert columns == {k: list(v) if isinstance(v, tuple) else v
+		for (k, v) in expected.iteritems()}
+	# The collapsed dimension isn't queried
+	static_dim = sample_cube.specification['dimensions'][1]['id']
+	assert static_dim not in connection.queries[-1].split('FROM')[0]
+	assert not any('OFFSET' in q for q in connection.queries)
+
+def test_result_cache(connection, sample_cube):
+	metadata = MetadataCache()
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		metadata_cache=metadata)
+	cache = ResultCache()
+	cached = sample_filtering(cube.cached(cache))
+	columns = cached.toColumns()
+	assert cached.toColumns() is columns
+	assert cache.hits == 1
+	
+	categories = sample_cube.specification['dimensions'][2]['categories']
+	changed = sample_cube.filter(C=[c['id'] for c in categories[:2]])
+	SqlDataCube.FromCube(connection, 'order_cube', changed, replace=True,
+		metadata_cache=metadata)
+	assert cache.stats()['entries'] == 0
+	expected = sample_filtering(changed).toColumns()
+	assert cached.toColumns() == {k: list(v) if isinstance(v, tuple) else v
+		for (k, v) in expected.iteritems()}
+
+def test_query(connection, sample_cube):
+	cube = with_values(sample_cube, lambda i, v: i)
+	a, b, c = cube.dimension_ids()[:3]
+	b_cats = categories(cube, 1)[:2]
+	for layout in ('rows', 'dense'):
+		sql_cube = SqlDataCube.FromCube(connection, 'numbers', cube,
+			replace=True, layout=layout)
+		for base in (cube, sql_cube):
+			query = sample_filtering(base, 0, 1).query().filter(
+				**{b: b_cats})
+			expected = sample_filtering(cube, 0, 1).filter(**{b: b_cats})
+			assert map(list, query.page(2, 7)) == map(list, expected)[2:7]
+			assert query.select(c, a).columns(True).keys() == [c, a]
+			aggregated = query.aggregate([b, c], 'sum').page(1, 3)
+			expected = sample_filtering(cube, 0, 1).filter(
+				**{b: b_cats}).aggregate([b, c], 'sum')
+			assert map(list, aggregated) == map(list, expected)[1:3]
+
+def test_query_single_statement(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	a, b = cube.dimension_ids()[:2]
+	query = sample_filtering(cube).query().filter(
+		**{a: sample_filtering(cube).specification['dimensions'][0]
+			['categories'][0]['id']})
+	list(query.rows())
+	del connection.queries[:]
+	list(query.page(1, 3).rows())
+	assert len(connection.queries) == 1
+	del connection.queries[:]
+	list(query.aggregate([a], 'count').rows())
+	assert len(connection.queries) == 1
+	assert 'GROUP BY' in connection.queries[0]
+
+def test_dense_replace_shared_cache(sample_cube):
+	connection = sqlite3.connect(':memory:')
+	initialize_schema(connection)
+	cache = MetadataCache()
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout='dense', chunk_size=5, metadata_cache=cache)
+	filtered = sample_filtering(cube, 0, 1)
+	list(cube)
+	list(filtered)
+	
+	smaller = sample_filtering(sample_cube)
+	SqlDataCube.FromCube(connection, 'order_cube', smaller, replace=True,
+		layout='dense', chunk_size=5, metadata_cache=cache)
+	assert len(cube) == len(smaller)
+	assert map(list, cube) == map(list, smaller)
+	assert map(list, sample_filtering(cube, 0, 1)) == \
+		map(list, sample_filtering(smaller, 0, 1))
+	assert map(list, filtered) == map(list, sample_filtering(smaller, 0, 1))
+	
+	changed = with_values(smaller._materialize(), lambda i, v: i)
+	other = SqlDataCube.Open(connection, 'order_cube', metadata_cache=cache)
+	other.apply_delta(diff(smaller, changed))
+	assert map(list, cube) == map(list, changed)
+
+def test_replace_plain_connection(sample_cube):
+	# sqlite3's own connections can't be weakly referenced
+	connection = sqlite3.connect(':memory:')
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	reader = sample_filtering(SqlDataCube(connection, 'order_cube'), 0, 1)
+	assert len(cube) == len(sample_cube)
+	list(reader)
+	
+	smaller = sample_filtering(sample_cube)
+	SqlDataCube.FromCube(connection, 'order_cube', smaller, replace=True)
+	assert len(cube) == len(smaller)
+	assert map(list, cube) == map(list, smaller)
+	assert map(list, reader) == map(list, sample_filtering(smaller, 0, 1))
+	
+	# The caches don't keep the connections alive
+	refs = sys.getrefcount(connection)
+	get_metadata_cache(connection)
+	assert sys.getrefcount(connection) == refs
+
+def table_names(connection):
+	c = connection.cursor()
+	c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+	return set(r[0] for r in c.fetchall())
+
+def test_shadow_table_replace(sample_cube):
+	connection = sqlite3.connect(':memory:', factory=CountingConnection)
+	initialize_schema(connection)
+	cube = SqlDataCube.FromCube(connection, 'order_cube', sample_cube)
+	reader = sample_filtering(cube)
+	list(reader)
+	tables = table_names(connection)
+	del connection.queries[:]
+	filtered = sample_filtering(sample_cube, 0, 1)
+	SqlDataCube.FromCube(connection, 'order_cube', filtered, replace=True)
+	queries = connection.queries
+	# The table is loaded, indexed and analyzed before the swap
+	swap = [i for (i, q) in enumerate(queries) if 'INSERT' in q
+		and '_datasets' in q][0]
+	assert max(i for (i, q) in enumerate(queries) if 'CREATE' in q
+		or 'ANALYZE' in q) < swap
+	assert not any('DROP' in q for q in queries[:swap])
+	assert map(list, reader) == map(list, sample_filtering(filtered))
+	# The new table has the old one's name
+	assert table_names(connection) == tables
+	assert len([q for q in queries if 'RENAME' in q]) == 2
+
+def test_replace_other_connection(tmpdir, sample_cube):
+	path = str(tmpdir.join('cubes.sqlite'))
+	writer = sqlite3.connect(path)
+	initialize_schema(writer)
+	SqlDataCube.FromCube(writer, 'order_cube', sample_cube)
+	writer.commit()
+	reader_connection = sqlite3.connect(path)
+	cache = MetadataCache()
+	reader = SqlDataCube(reader_connection, 'order_cube',
+		metadata_cache=cache)
+	list(reader)
+	
+	smaller = sample_filtering(sample_cube)
+	SqlDataCube.FromCube(writer, 'order_cube', smaller, replace=True)
+	writer.commit()
+	# The table name in the other connection's metadata is valid
+	assert reader._get_table_name() == 'order_cube'
+	cube = SqlDataCube(reader_connection, 'order_cube')
+	assert map(list, cube) == map(list, smaller)
+	cache.invalidate()
+	assert map(list, reader) == map(list, smaller)
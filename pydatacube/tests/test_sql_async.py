@@ -0,0 +1,46 @@
+import sqlite3
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.sql import SqlDataCube, AsyncSqlDataCube, \
+	ConnectionPool, initialize_schema
+
+@pytest.fixture
+def async_cube(tmpdir, sample_cube):
+	path = str(tmpdir.join('cubes.sqlite'))
+	pool = ConnectionPool(
+		lambda: sqlite3.connect(path, check_same_thread=False))
+	initialize_schema(pool)
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	return AsyncSqlDataCube(cube, workers=3)
+
+def test_queries(async_cube, sample_cube):
+	dim = sample_cube.specification['dimensions'][1]
+	filtered = async_cube.filter(**{dim['id']: dim['categories'][1]['id']})
+	expected = sample_filtering(sample_cube)
+	assert filtered.count().get() == len(expected)
+	assert map(list, filtered.rows(2, 5).get()) == map(list, expected)[2:5]
+	columns = filtered.toColumns().get()
+	assert columns['value'] == list(expected.toColumns()['value'])
+	groups = async_cube.group_by('A').get()
+	assert [g.count().get() for g in groups] == [8, 8, 8]
+	aggregated = async_cube.aggregate(['A'], 'count').get()
+	assert list(aggregated._value_dimension_values()) == [8, 8, 8]
+
+def test_overview(async_cube, sample_cube):
+	length, spec, rows = async_cube.overview(5).get()
+	assert length == len(sample_cube)
+	assert spec['length'] == length
+	assert map(list, rows) == map(list, sample_cube)[:5]
+
+def test_stream(async_cube, sample_cube):
+	stream = async_cube.stream(batch_size=5)
+	assert len(stream.next_batch()) == 5
+	rows = list(stream)
+	assert map(list, rows) == map(list, sample_cube)[5:]
+	assert stream.next_batch() is None
+	
+	stream = async_cube.stream(batch_size=5, prefetch=1)
+	stream.next_batch()
+	stream.close()
+	assert list(stream) == []
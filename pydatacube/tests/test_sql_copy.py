@@ -0,0 +1,75 @@
+import struct
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.sql.dialects import CubeCopyBinary
+
+def decode_copy_binary(data):
+	assert data.startswith(CubeCopyBinary.HEADER)
+	pos = len(CubeCopyBinary.HEADER)
+	rows = []
+	while True:
+		n_fields, = struct.unpack_from('>h', data, pos)
+		pos += 2
+		if n_fields == -1:
+			break
+		row = []
+		for i in range(n_fields):
+			length, = struct.unpack_from('>i', data, pos)
+			pos += 4
+			if length == -1:
+				row.append(None)
+				continue
+			row.append(data[pos:pos+length])
+			pos += length
+		rows.append(row)
+	assert pos == len(data)
+	return rows
+
+def surrogate_mappings(cube):
+	mappings = []
+	for dim in cube.specification['dimensions']:
+		cats = dim.get('categories', [])
+		mappings.append(dict((c['id'], i) for i, c in enumerate(cats)))
+	return mappings
+
+def check_copy_binary(cube, mappings, data):
+	rows = decode_copy_binary(data)
+	assert len(rows) == len(cube)
+	for i, (row, cube_row) in enumerate(zip(rows, cube)):
+		cube_row = list(cube_row)
+		assert len(row) == len(cube_row) + 1
+		assert struct.unpack('>q', row[-1])[0] == i
+		for field, mapping, value in zip(row, mappings, cube_row):
+			if mapping:
+				assert struct.unpack('>i', field)[0] == mapping[value]
+			elif value is None:
+				assert field is None
+			else:
+				assert field == str(value)
+
+def test_copy_binary(sample_cube):
+	mappings = surrogate_mappings(sample_cube)
+	data = CubeCopyBinary(sample_cube, mappings).read()
+	check_copy_binary(sample_cube, mappings, data)
+
+def test_filtered_copy_binary_in_small_reads(sample_cube):
+	cube = sample_filtering(sample_cube)
+	mappings = surrogate_mappings(sample_cube)
+	source = CubeCopyBinary(cube, mappings, rows_per_block=3)
+	chunks = []
+	while True:
+		chunk = source.read(7)
+		if not chunk:
+			break
+		assert len(chunk) <= 7
+		chunks.append(chunk)
+	check_copy_binary(cube, mappings, "".join(chunks))
+
+def test_typed_copy_binary(sample_cube):
+	cube = with_values(sample_cube, lambda i, v: i*0.5 if i%3 else None)
+	mappings = surrogate_mappings(cube)
+	rows = decode_copy_binary(CubeCopyBinary(cube, mappings,
+		['numeric']).read())
+	values = [struct.unpack('>d', row[-2])[0] if row[-2] else None
+		for row in rows]
+	assert values == cube._data['value_dimensions'][0]['values']
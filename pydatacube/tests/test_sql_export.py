@@ -0,0 +1,63 @@
+import sqlite3
+import json
+import StringIO
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.sql import SqlDataCube, initialize_schema
+from pydatacube.sql.export import partition_ranges
+from pydatacube.jsonstat import to_jsonstat
+from pydatacube import binary
+
+@pytest.fixture(params=['rows', 'dense'])
+def database(request, tmpdir, sample_cube):
+	path = str(tmpdir.join('cubes.sqlite'))
+	connection = sqlite3.connect(path)
+	initialize_schema(connection)
+	SqlDataCube.FromCube(connection, 'order_cube', sample_cube,
+		layout=request.param, chunk_size=5)
+	connection.commit()
+	return path, connection
+
+def test_partition_ranges():
+	assert partition_ranges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+	assert partition_ranges(2, 4) == [(0, 1), (1, 2)]
+	assert partition_ranges(0, 4) == [(0, 0)]
+
+def test_export_csv(database, sample_cube):
+	path, connection = database
+	opened = []
+	def connect():
+		opened.append(sqlite3.connect(path))
+		return opened[-1]
+	
+	for cube in [SqlDataCube.Open(connection, 'order_cube'),
+			sample_filtering(SqlDataCube.Open(connection, 'order_cube'))]:
+		expected = StringIO.StringIO()
+		cube.dump_csv(expected)
+		output = StringIO.StringIO()
+		cube.export(output, connect, partitions=3)
+		assert output.getvalue() == expected.getvalue()
+	assert len(opened) == 6
+
+def test_export_jsonstat(database, sample_cube):
+	path, connection = database
+	cube = sample_filtering(SqlDataCube.Open(connection, 'order_cube'))
+	output = StringIO.StringIO()
+	cube.export(output, lambda: sqlite3.connect(path), format='jsonstat',
+		partitions=5)
+	expected = to_jsonstat(sample_filtering(sample_cube))
+	assert json.loads(output.getvalue()) == json.loads(json.dumps(expected))
+
+def test_export_binary(database, sample_cube, tmpdir):
+	path, connection = database
+	cube = sample_filtering(SqlDataCube.Open(connection, 'order_cube'))
+	output_path = str(tmpdir.join('cube.bin'))
+	with open(output_path, 'wb') as output:
+		cube.export(output, lambda: sqlite3.connect(path), format='binary',
+			partitions=3)
+	# The stored specification doesn't keep the key order of the
+	# sample cube's, so compare to the stored one.
+	loaded = binary.load(output_path)
+	assert loaded == cube._materialize()
+	assert map(list, loaded) == map(list, sample_filtering(sample_cube))
@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+import StringIO
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.sql import SqlDataCube, ConnectionPool, initialize_schema, \
+	checkout
+
+@pytest.fixture
+def pool(tmpdir):
+	path = str(tmpdir.join('cubes.sqlite'))
+	pool = ConnectionPool(
+		lambda: sqlite3.connect(path, check_same_thread=False),
+		maxconn=3)
+	initialize_schema(pool)
+	pool.path = path
+	return pool
+
+@pytest.mark.parametrize('layout', ['rows', 'dense'])
+def test_pooled_cube(pool, sample_cube, layout):
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube,
+		layout=layout, chunk_size=5)
+	# The load is committed
+	other = sqlite3.connect(pool.path)
+	assert SqlDataCube.Exists(other, 'order_cube')
+	
+	expected = map(list, sample_filtering(sample_cube))
+	results = []
+	def read():
+		results.append(map(list, sample_filtering(cube)))
+	threads = [threading.Thread(target=read) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert results == [expected]*8
+	assert pool._n_out == 0
+
+def test_streaming_keeps_connection(pool, sample_cube):
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	rows = iter(cube.rows())
+	rows.next()
+	assert pool._n_out == 1
+	assert len(list(rows)) == len(sample_cube) - 1
+	assert pool._n_out == 0
+	
+	rows = iter(cube.rows())
+	rows.next()
+	del rows
+	assert pool._n_out == 0
+
+def test_filter_while_streaming(tmpdir, sample_cube):
+	path = str(tmpdir.join('cubes.sqlite'))
+	pool = ConnectionPool(
+		lambda: sqlite3.connect(path, check_same_thread=False),
+		maxconn=1)
+	initialize_schema(pool)
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	cube._preload()
+	rows = iter(cube.rows())
+	rows.next()
+	# Holds the only connection, which the filters don't need
+	filtered = sample_filtering(SqlDataCube(pool, 'order_cube',
+		metadata_cache=cube._metadata))
+	groups = list(cube.group_by(*cube.dimension_ids()[:1]))
+	assert len(filtered) == len(sample_filtering(sample_cube))
+	assert len(list(rows)) == len(sample_cube) - 1
+	assert map(list, filtered) == map(list, sample_filtering(sample_cube))
+	assert sum(len(list(g)) for g in groups) == len(sample_cube)
+
+def test_pooled_export(pool, sample_cube):
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	expected = StringIO.StringIO()
+	cube.dump_csv(expected)
+	output = StringIO.StringIO()
+	cube.export(output, partitions=5)
+	assert output.getvalue() == expected.getvalue()
+	
+	unpooled = SqlDataCube(sqlite3.connect(pool.path), 'order_cube')
+	with pytest.raises(ValueError):
+		unpooled.export(output)
+
+def test_pool_limits_connections():
+	made = []
+	def connect():
+		made.append(sqlite3.connect(':memory:', check_same_thread=False))
+		return made[-1]
+	pool = ConnectionPool(connect, maxconn=1)
+	first = pool.getconn()
+	got = []
+	waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+	waiter.start()
+	waiter.join(0.1)
+	assert got == []
+	pool.putconn(first)
+	waiter.join()
+	assert got == [first]
+	assert len(made) == 1
+
+def table_names(pool):
+	with checkout(pool) as connection:
+		c = connection.cursor()
+		c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+		return set(r[0] for r in c.fetchall())
+
+def test_pooled_replace(pool, sample_cube):
+	cube = SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	tables = table_names(pool)
+	filtered = sample_filtering(sample_cube)
+	replaced = SqlDataCube.FromCube(pool, 'order_cube', filtered,
+		replace=True)
+	assert map(list, cube) == map(list, filtered)
+	assert map(list, replaced) == map(list, filtered)
+	# The old table is renamed away and dropped in the background
+	for i in range(100):
+		if table_names(pool) == tables:
+			break
+		time.sleep(0.05)
+	assert table_names(pool) == tables
+
+def test_failed_replace(pool, sample_cube, monkeypatch):
+	SqlDataCube.FromCube(pool, 'order_cube', sample_cube)
+	tables = table_names(pool)
+	def fail(*args):
+		raise RuntimeError("Failed swap")
+	monkeypatch.setattr(SqlDataCube, '_register', classmethod(fail))
+	with pytest.raises(RuntimeError):
+		SqlDataCube.FromCube(pool, 'order_cube',
+			sample_filtering(sample_cube), replace=True)
+	monkeypatch.undo()
+	assert table_names(pool) == tables
+	assert map(list, SqlDataCube(pool, 'order_cube')) == \
+		map(list, sample_cube)
+	SqlDataCube.Remove(pool, 'order_cube')
+	with checkout(pool) as connection:
+		c = connection.cursor()
+		c.execute("SELECT COUNT(*) FROM _categories")
+		assert c.fetchone()[0] == 0
+
+def test_concurrent_loads(tmpdir, sample_cube):
+	path = str(tmpdir.join('cubes.sqlite'))
+	pool = ConnectionPool(
+		lambda: sqlite3.connect(path, check_same_thread=False),
+		maxconn=8)
+	initialize_schema(pool)
+	errors = []
+	def load(i):
+		try:
+			SqlDataCube.FromCube(pool, 'cube_%i'%i, sample_cube)
+		except Exception as e:
+			errors.append(e)
+	threads = [threading.Thread(target=load, args=(i,)) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert errors == []
+	for i in range(8):
+		cube = SqlDataCube(pool, 'cube_%i'%i)
+		assert map(list, cube) == map(list, sample_cube)
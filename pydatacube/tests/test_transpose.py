@@ -0,0 +1,64 @@
+import pytest
+from test_jsonstat import sample_cube
+from testutils import *
+from pydatacube.pydatacube import DataCubeException
+
+def test_transpose(sample_cube):
+	a, b, c, value = sample_cube.dimension_ids()
+	transposed = sample_cube.transpose(c, a)
+	assert transposed.dimension_ids() == [c, a, b, value]
+	assert transposed._data['value_dimensions'] is \
+		sample_cube._data['value_dimensions']
+	expected = sorted(map(list, sample_cube),
+		key=lambda row: (row[2], row[0]))
+	expected = [[row[2], row[0], row[1], row[3]] for row in expected]
+	assert map(list, transposed) == expected
+	# Transposing back gives the original
+	assert transposed.transpose(a, b) == sample_cube
+
+def test_filtered_transpose(sample_cube):
+	a, b, c, value = sample_cube.dimension_ids()
+	filtered = sample_filtering(sample_cube, 0, 1)
+	transposed = filtered.transpose(b)
+	assert transposed.specification['dimensions'][1] == \
+		filtered.specification['dimensions'][0]
+	assert transposed.transpose(a) == filtered
+	assert transposed.filter(**{c: transposed.specification['dimensions']
+		[2]['categories'][0]['id']}).transpose(a) == \
+		filtered.filter(**{c: filtered.specification['dimensions']
+			[2]['categories'][0]['id']})
+	assert transposed._materialize()._in_stored_order()
+	assert transposed._materialize() == transposed
+	with pytest.raises(DataCubeException):
+		sample_cube.transpose(a, a)
+
+def test_transposed_numpy(sample_cube):
+	np = pytest.importorskip('numpy')
+	a, b, c, value = sample_cube.dimension_ids()
+	array = sample_cube.to_numpy()
+	transposed = sample_cube.transpose(c, a).to_numpy()
+	assert (transposed == array.transpose(2, 0, 1)).all()
+	filtered = sample_filtering(sample_cube).transpose(c)
+	assert (filtered.to_numpy() ==
+		filtered._materialize().to_numpy()).all()
+
+def test_pivot(sample_cube):
+	a, b, c, value = sample_cube.dimension_ids()
+	cube = sample_filtering(sample_cube, 1, 0)
+	column_keys, rows = cube.pivot(rows=[c], columns=[a, b])
+	rows = list(rows)
+	categories = [[cat['id'] for cat in dim['categories']]
+		for dim in cube.specification['dimensions'][:3]]
+	assert column_keys == [(x, y) for x in categories[0]
+		for y in categories[1]]
+	assert [row[0] for row in rows] == categories[2]
+	for row in rows:
+		for key, value in zip(column_keys, row[1:]):
+			cell = cube.filter(**{a: key[0], b: key[1], c: row[0]})
+			assert value == list(list(cell)[0])[3]
+
+	column_keys, rows = cube.pivot(rows=[a], columns=[c],
+		category_labels=True)
+	assert len(list(rows)) == len(categories[0])
+	with pytest.raises(DataCubeException):
+		sample_cube.pivot(rows=[a], columns=[c])
@@ -1,4 +1,5 @@
 import itertools
+import copy
 
 def sample_filtering(cube, dim_i=1, cat_i=1):
 	spec = cube.specification
@@ -7,3 +8,16 @@ def sample_filtering(cube, dim_i=1, cat_i=1):
 	filt = {dimension['id']: category['id']}
 	filtered = cube.filter(**filt)
 	return filtered
+
+def with_values(cube, change):
+	"""An unfiltered cube with the values v at flat index i as change(i, v)"""
+	data = copy.copy(cube._data)
+	valdim = dict(data['value_dimensions'][0])
+	valdim['values'] = [change(i, v) for (i, v) in
+		enumerate(valdim['values'])]
+	data['value_dimensions'] = [valdim]
+	return type(cube)(data)
+
+def categories(cube, dim_i):
+	return [c['id'] for c in
+		cube.specification['dimensions'][dim_i]['categories']]